@@ -0,0 +1,318 @@
+# # !/usr/bin/env python3
+
+# -------------------------------------------------------------------
+# Cross-run analytics
+#	Parses run logs (log_<expt>_<date>.txt) and structured journals
+#	(journal_<expt>_<date>.jsonl) into one columnar step table and
+#	computes per-step duration distributions, overhead against the
+#	nominal (commanded) time, imaging time trends per protocol and
+#	pumping time corrections.
+#
+#	Logs only have start times, so a step lasts until the next step
+#	starts there. Journals record measured and nominal times; when a
+#	log has a journal next to it, the journal is used instead.
+#
+#	python analytics.py log_*.txt journal_*.jsonl
+# -------------------------------------------------------------------
+
+# -------------------------------------------------------------------
+# Import
+# -------------------------------------------------------------------
+import glob
+import os
+import re
+import sys
+import time
+
+import numpy as np
+
+from journal import read_journal
+
+# nominal: commanded seconds of the whole step, pumping: commanded pumping
+#	seconds, pumped: measured pumping seconds, primed: pumping seconds
+#	saved by a primed line (NaN where not known)
+columns = ['run', 'kind', 'name', 'round', 'repeat', 'start', 'duration', 'nominal', 'pumping', 'pumped',
+		   'primed']
+
+reaction_line = re.compile(r'>>>>> (?P<name>\S+) reaction (?P<repeat>\d+)/(?P<repeats>\d+) started at (?P<time>.+)$')
+priming_line = re.compile(r'>>>>> (?P<name>\S+) priming started at (?P<time>.+)$')
+imaging_line = re.compile(r'>>>>> Round #(?P<round>\d+), imaging(?: \((?P<name>[^)]*)\))? started at (?P<time>.+)$')
+imaging_end_line = re.compile(r'(?:>>>>>|!!!!!) (?:Round #(?P<round>\d+), imaging finished'
+	r'|Error running Fusion protocol for Round #(?P<error_round>\d+)) at (?P<time>.+)$')
+log_date = re.compile(r'_(\d\d-\d\d-\d{4})\.txt$')
+
+# -------------------------------------------------------------------
+# Log timestamps: '%m-%d-%Y %H:%M:%S', older logs only '%H:%M:%S'
+#	(the date then comes from the file name, rolling over at midnight)
+# -------------------------------------------------------------------
+def _parse_time(text, date, previous):
+	text = text.strip()
+	try:
+		return time.mktime(time.strptime(text, '%m-%d-%Y %H:%M:%S'))
+	except ValueError:
+		pass
+	if date is None:
+		return None
+	seconds = time.mktime(time.strptime(date + ' ' + text, '%m-%d-%Y %H:%M:%S'))
+	while previous is not None and seconds < previous:
+		seconds += 24 * 3600
+	return seconds
+
+# -------------------------------------------------------------------
+# Steps of one free-text log: [{column: value}, ...] for run `run`
+# -------------------------------------------------------------------
+def parse_log(path, run=0):
+	match = log_date.search(os.path.basename(path))
+	date = match.group(1) if match else None
+
+	steps = []
+	previous = None
+	open_steps = [] # steps waiting for the next start to end them
+	with open(path, errors='replace') as log_file:
+		for line in log_file:
+			line = line.strip()
+			for kind, pattern in (('reaction', reaction_line), ('priming', priming_line),
+								  ('imaging', imaging_line), ('imaging_end', imaging_end_line)):
+				match = pattern.search(line)
+				if match:
+					break
+			else:
+				continue
+			seconds = _parse_time(match.group('time'), date, previous)
+			if seconds is None:
+				continue
+			previous = seconds
+
+			# priming runs inside the last incubation of a reaction, so it only
+			#	ends an earlier priming step, not the reaction
+			for step in list(open_steps):
+				if (kind == 'imaging_end' and step['kind'] == 'imaging'
+						or kind not in ('imaging_end', 'priming') or step['kind'] == 'priming'):
+					step['duration'] = seconds - step['start']
+					open_steps.remove(step)
+			if kind == 'imaging_end':
+				continue
+			step = {'run': run, 'kind': kind, 'name': match.groupdict().get('name') or '',
+					'round': int(match.group('round')) - 1 if kind == 'imaging' else -1,
+					'repeat': int(match.group('repeat')) - 1 if kind == 'reaction' else -1,
+					'start': seconds, 'duration': np.nan, 'nominal': np.nan, 'pumping': np.nan,
+					'pumped': np.nan, 'primed': np.nan}
+			steps.append(step)
+			open_steps.append(step)
+	return steps
+
+# -------------------------------------------------------------------
+# Steps of a journal, one run per 'run_started' record
+#	Returns [[steps of run 0], [steps of run 1], ...]
+# -------------------------------------------------------------------
+def parse_journal(path):
+	runs = []
+	steps = None
+	imaging = {} # round -> open imaging step
+	for entry in read_journal(path):
+		event = entry.get('event')
+		if event == 'run_started' or steps is None:
+			steps = []
+			runs.append(steps)
+			imaging = {}
+		if event == 'flow':
+			steps.append({'kind': 'reaction', 'name': entry['reagent'], 'round': -1,
+						  'repeat': entry['repeat'], 'start': entry['started'], 'duration': entry['seconds'],
+						  'nominal': entry['time_pumping'] + entry['time_reaction'],
+						  'pumping': entry['time_pumping'], 'pumped': entry['pumped'],
+						  'primed': entry.get('primed', 0.0)})
+		elif event == 'prime' and 'started' in entry:
+			steps.append({'kind': 'priming', 'name': entry['reagent'], 'round': -1, 'repeat': -1,
+						  'start': entry['started'], 'duration': entry['seconds'],
+						  'nominal': entry['time_priming'], 'pumping': entry['time_priming'],
+						  'pumped': entry['seconds'], 'primed': 0.0})
+		elif event == 'imaging_started':
+			step = {'kind': 'imaging', 'name': entry.get('protocol') or '', 'round': entry['round'],
+					'repeat': -1, 'start': entry['time'], 'duration': np.nan, 'nominal': np.nan,
+					'pumping': np.nan, 'pumped': np.nan, 'primed': np.nan}
+			steps.append(step)
+			imaging[entry['round']] = step
+		elif event in ('imaging_finished', 'imaging_error') and entry.get('round') in imaging:
+			step = imaging.pop(entry['round'])
+			step['duration'] = entry['time'] - step['start']
+	return [run for run in runs if run]
+
+# -------------------------------------------------------------------
+# Step table of many runs, as {column: numpy array}
+#	paths: log and journal files; a log is skipped if the journal of
+#		the same run (journal_<expt>_<date>.jsonl) is also given
+# -------------------------------------------------------------------
+def load_runs(paths):
+	paths = sorted(set(paths))
+	journals = set(os.path.abspath(path) for path in paths if path.endswith('.jsonl'))
+
+	runs = [] # (source, steps)
+	for path in paths:
+		if path.endswith('.jsonl'):
+			for steps in parse_journal(path):
+				runs.append((path, steps))
+			continue
+		directory, name = os.path.split(os.path.abspath(path))
+		if name.startswith('log_') and os.path.join(directory, 'journal_' + name[4:-4] + '.jsonl') in journals:
+			continue
+		runs.append((path, parse_log(path)))
+
+	rows = []
+	for run, (source, steps) in enumerate(runs):
+		for step in steps:
+			step['run'] = run
+			rows.append(step)
+	table = {'source': np.array([source for source, steps in runs], dtype=object)}
+	for column in columns:
+		values = [row[column] for row in rows]
+		if column in ('kind', 'name'):
+			table[column] = np.array(values, dtype=object)
+		elif column in ('run', 'round', 'repeat'):
+			table[column] = np.array(values, dtype=np.int64)
+		else:
+			table[column] = np.array(values, dtype=np.float64)
+	return table
+
+# -------------------------------------------------------------------
+# Rows of a table where mask is True
+# -------------------------------------------------------------------
+def select(table, mask):
+	selected = {column: table[column][mask] for column in columns}
+	selected['source'] = table['source']
+	return selected
+
+# -------------------------------------------------------------------
+# Distribution of `values` per group key, vectorized over all groups
+#	Returns {key: {'count', 'mean', 'median', 'p10', 'p90', 'max', 'total'}}
+#	NaN values are left out
+# -------------------------------------------------------------------
+def group_statistics(keys, values):
+	valid = ~np.isnan(values)
+	keys, values = keys[valid], values[valid]
+	if len(values) == 0:
+		return {}
+	groups, group_index = np.unique(keys.astype(str), return_inverse=True)
+	order = np.lexsort((values, group_index)) # by group, then value
+	sorted_values = values[order]
+	counts = np.bincount(group_index, minlength=len(groups))
+	starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+	totals = np.bincount(group_index, weights=values, minlength=len(groups))
+
+	def quantile(q): # linear interpolation inside each group's sorted run
+		position = starts + q * (counts - 1)
+		lower = np.floor(position).astype(np.int64)
+		upper = np.minimum(lower + 1, starts + counts - 1)
+		fraction = position - lower
+		return sorted_values[lower] * (1 - fraction) + sorted_values[upper] * fraction
+
+	p10, median, p90 = quantile(0.1), quantile(0.5), quantile(0.9)
+	maximum = sorted_values[starts + counts - 1]
+	return {key: {'count': int(counts[i]), 'mean': float(totals[i] / counts[i]),
+				  'median': float(median[i]), 'p10': float(p10[i]), 'p90': float(p90[i]),
+				  'max': float(maximum[i]), 'total': float(totals[i])}
+			for i, key in enumerate(groups)}
+
+# -------------------------------------------------------------------
+# Duration distribution per step (kind and reagent/protocol)
+# -------------------------------------------------------------------
+def step_durations(table):
+	keys = table['kind'].astype(str) + ':' + table['name'].astype(str)
+	return group_statistics(keys, table['duration'])
+
+# -------------------------------------------------------------------
+# Overhead (measured - nominal seconds) per step, where nominal is known
+# -------------------------------------------------------------------
+def step_overheads(table):
+	keys = table['kind'].astype(str) + ':' + table['name'].astype(str)
+	return group_statistics(keys, table['duration'] - table['nominal'])
+
+# -------------------------------------------------------------------
+# Imaging time per protocol: distribution, per-run medians and the
+#	linear trend (seconds per day) over the runs
+# -------------------------------------------------------------------
+def imaging_trends(table):
+	imaging = select(table, (table['kind'] == 'imaging') & ~np.isnan(table['duration']))
+	trends = {}
+	for protocol, statistics in group_statistics(imaging['name'], imaging['duration']).items():
+		rows = imaging['name'].astype(str) == protocol
+		start, duration = imaging['start'][rows], imaging['duration'][rows]
+		runs = group_statistics(imaging['run'][rows], duration)
+		slope = np.nan
+		if len(np.unique(np.round(start))) > 1:
+			slope = float(np.polyfit(start / (24 * 3600), duration, 1)[0])
+		trends[protocol] = dict(statistics, per_run={str(table['source'][int(run)]): result['median']
+													for run, result in runs.items()},
+								seconds_per_day=slope)
+	return trends
+
+# -------------------------------------------------------------------
+# Pumping time corrections per reagent (journals only)
+#	Measured pumping includes the pump command latency, so more than
+#	time_pumping worth of volume is delivered; the suggestion takes the
+#	median excess off. A reagent is pumped for multiples of its
+#	time_pumping entry (e.g. 2x SSC washes), shortened when its line was
+#	primed: pumps are scaled back to one entry first (the multiple is
+#	the unprimed time over the reagent's shortest unprimed time,
+#	rounded). Returns {reagent: (nominal, measured, suggested)} as
+#	median seconds of one time_pumping entry
+# -------------------------------------------------------------------
+def pumping_corrections(table):
+	reactions = select(table, (table['kind'] == 'reaction') & ~np.isnan(table['pumped']))
+	primed = np.nan_to_num(reactions['primed'])
+	commanded = reactions['pumping'] + primed # before priming shortened it
+	measured = reactions['pumped'] + primed
+	names = reactions['name'].astype(str)
+	valid = commanded > 0
+	names, commanded, measured = names[valid], commanded[valid], measured[valid]
+	if len(names) == 0:
+		return {}
+
+	shortest = {name: commanded[names == name].min() for name in np.unique(names)}
+	multiple = np.maximum(1.0, np.round(commanded / np.array([shortest[name] for name in names])))
+	nominal = group_statistics(names, commanded / multiple)
+	excess = group_statistics(names, (measured - commanded) / multiple)
+	return {reagent: (nominal[reagent]['median'], nominal[reagent]['median'] + excess[reagent]['median'],
+					  max(0.0, nominal[reagent]['median'] - excess[reagent]['median']))
+			for reagent in excess}
+
+# -------------------------------------------------------------------
+# The n slowest single steps: [(seconds, source, kind, name, round, repeat)]
+# -------------------------------------------------------------------
+def slowest_steps(table, n=10):
+	durations = np.nan_to_num(table['duration'], nan=-np.inf)
+	order = np.argsort(durations)[::-1][:n]
+	return [(float(table['duration'][i]), str(table['source'][table['run'][i]]), table['kind'][i],
+			 table['name'][i], int(table['round'][i]), int(table['repeat'][i]))
+			for i in order if np.isfinite(durations[i])]
+
+# -------------------------------------------------------------------
+# Print a report: python analytics.py log_*.txt journal_*.jsonl
+# -------------------------------------------------------------------
+def format_trend(protocol, trend):
+	seconds_per_day = trend['seconds_per_day']
+	slope = 'n/a' if np.isnan(seconds_per_day) else '%+.1f s/day' % seconds_per_day # needs 2 acquisitions
+	return '   %-30s median %.1f s, trend %s over %d acquisitions' % (protocol or '(unnamed)',
+		trend['median'], slope, trend['count'])
+
+def format_statistics(title, statistics):
+	lines = [title, '   %-30s %6s %9s %9s %9s %9s %9s' % ('step', 'count', 'mean', 'median', 'p10', 'p90', 'max')]
+	for key, result in sorted(statistics.items(), key=lambda item: -item[1]['total']):
+		lines.append('   %-30s %6d %9.1f %9.1f %9.1f %9.1f %9.1f' % (key, result['count'], result['mean'],
+			result['median'], result['p10'], result['p90'], result['max']))
+	return '\n'.join(lines)
+
+if __name__ == '__main__':
+	paths = [path for pattern in sys.argv[1:] for path in glob.glob(pattern)]
+	table = load_runs(paths)
+	print(f'{len(table["source"])} runs, {len(table["run"])} steps')
+	print(format_statistics('Step durations (s)', step_durations(table)))
+	print(format_statistics('Overhead over nominal time (s)', step_overheads(table)))
+	print('Imaging time per protocol')
+	for protocol, trend in imaging_trends(table).items():
+		print(format_trend(protocol, trend))
+	print('Pumping time per reagent and time_pumping entry (nominal -> measured, suggested time_pumping)')
+	for reagent, (nominal, measured, suggested) in sorted(pumping_corrections(table).items()):
+		print('   %-30s %6.1f -> %6.1f s, suggest %6.1f s' % (reagent, nominal, measured, suggested))
+	print('Slowest steps')
+	for seconds, source, kind, name, round, repeat in slowest_steps(table):
+		print('   %9.1f s  %-10s %-15s round %3d repeat %2d  %s' % (seconds, kind, name, round + 1, repeat + 1, source))
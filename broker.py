@@ -0,0 +1,280 @@
+# # !/usr/bin/env python3
+
+# -------------------------------------------------------------------
+# Device broker
+#	One process owns the serial ports (HamiltonMVP, APump) and serves
+#	any number of local clients over a socket, one JSON request per
+#	line, one JSON reply per line:
+#		{"command": "call", "device": "valves", "method": "changePort", "args": [0, 3]}
+#		{"command": "get", "device": "pump", "name": "flow_status"}
+#		{"command": "status"}
+#	Calls to a device are serialized. Status and attributes come from
+#	the drivers' cached state without touching the ports. Identical
+#	queries that arrive while one is in flight share its answer, and
+#	answers are reused for query_max_age seconds. Every command bumps
+#	its device's generation when it starts and when it ends; a query
+#	answer is only shared or reused within the generation it was asked
+#	in, so no client gets an answer older than a command it saw.
+#	Remote control of the pump belongs to the broker: clients cannot
+#	release it (closeRemote), the broker does when it stops.
+#	Device timeouts (deadline.DeviceTimeout and the drivers' subclasses)
+#	are raised again as the same type in the client, so a run's
+#	@recoverable waits recover devices behind the broker too.
+#
+#	python broker.py [valve_com_port] [pump_com_port] [port]
+# -------------------------------------------------------------------
+
+# -------------------------------------------------------------------
+# Import
+# -------------------------------------------------------------------
+import json
+import socket
+import socketserver
+import sys
+import threading
+import time
+
+from deadline import DeviceTimeout
+from gilsonMP3 import PumpTimeout
+from hamilton import ValveTimeout
+
+default_port = 15150
+
+# Methods clients may call, and the read-only ones among them (queries
+#	are coalesced and cached, commands always run)
+device_methods = {
+	'valves': {'commands': ['changePort', 'changePorts', 'initializeValve', 'resetChain',
+							'waitUntilNotMoving', 'recoverConnection'],
+			   'queries': ['getStatus', 'getChainStatus', 'whereIsValve', 'isMovementFinished', 'isValveOverloaded',
+						   'isValidPort', 'isValidValve', 'howIsValveConfigured',
+						   'getDefaultPortNames', 'getRotationDirections']},
+	'pump': {'commands': ['startFlow', 'resumeFlow', 'stopFlow', 'setSpeed', 'setFlowDirection',
+						  'verifyMirror', 'disconnect', 'recoverConnection'],
+			 'queries': ['getStatus', 'readDisplay', 'confirmRemoteControl', 'getIdentification']}}
+# Errors raised again as their own type in the client (by class name)
+remote_errors = {error.__name__: error for error in (DeviceTimeout, ValveTimeout, PumpTimeout)}
+device_attributes = {
+	'valves': ['current_port', 'num_valves', 'max_ports_per_valve', 'valve_configs'],
+	'pump': ['flow_status', 'speed', 'direction', 'pump_ID', 'mirror']}
+
+# -------------------------------------------------------------------
+# Device Broker Class Definition
+#	devices: {'valves': HamiltonMVP, 'pump': APump}
+# -------------------------------------------------------------------
+class DeviceBroker():
+	def __init__(self, devices, port=default_port, query_max_age=0.5):
+		self.devices = devices
+		self.query_max_age = query_max_age
+		self.locks = {name: threading.Lock() for name in devices}
+		self.pending_lock = threading.Lock()
+		self.pending = {} # (query key, generation) -> [event, reply] of the query in flight
+		self.answers = {} # query key -> (time.monotonic(), reply, generation)
+		self.generations = {name: 0 for name in devices} # bumped by every command
+		self.counts = {'calls': 0, 'coalesced': 0, 'cached': 0}
+
+		self.server = BrokerServer(('127.0.0.1', port), BrokerHandler)
+		self.server.broker = self
+		self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+		self.thread.start()
+
+	# ------------------------------------------------------------------
+	# Handle one request (from a handler thread)
+	# ------------------------------------------------------------------
+	def handleRequest(self, request):
+		command = request.get('command')
+		if command == 'status':
+			return {'ok': True, 'result': self.status()}
+		device = request.get('device')
+		if device not in self.devices:
+			return {'ok': False, 'error': 'Unknown device: ' + str(device)}
+		if command == 'get':
+			name = request.get('name')
+			if name not in device_attributes[device]:
+				return {'ok': False, 'error': 'Unknown attribute: ' + str(name)}
+			return {'ok': True, 'result': getattr(self.devices[device], name)}
+		if command == 'call':
+			method = request.get('method')
+			args = request.get('args', [])
+			kwargs = request.get('kwargs', {})
+			if method in device_methods[device]['queries']:
+				return self.query(device, method, args, kwargs)
+			if method in device_methods[device]['commands']:
+				return self.call(device, method, args, kwargs)
+			return {'ok': False, 'error': 'Unknown method: ' + str(method)}
+		return {'ok': False, 'error': 'Unknown command: ' + str(command)}
+
+	# ------------------------------------------------------------------
+	# Run a method on a device, one call per device at a time
+	# ------------------------------------------------------------------
+	def call(self, device, method, args, kwargs):
+		command = method not in device_methods[device]['queries']
+		with self.pending_lock:
+			self.counts['calls'] += 1
+			if command: # answers to queries in flight are stale from now on
+				self.generations[device] += 1
+		try:
+			with self.locks[device]:
+				result = getattr(self.devices[device], method)(*args, **kwargs)
+		except Exception as ex:
+			reply = {'ok': False, 'error': type(ex).__name__ + ': ' + str(ex), 'error_type': type(ex).__name__}
+			if isinstance(ex, DeviceTimeout):
+				reply.update(what=ex.what, seconds=ex.seconds)
+			return reply
+		finally:
+			if command:
+				with self.pending_lock: # state changed, cached answers are stale
+					self.generations[device] += 1
+					self.answers = {key: answer for key, answer in self.answers.items() if key[0] != device}
+		return {'ok': True, 'result': result}
+
+	# ------------------------------------------------------------------
+	# Read-only call: reuse a recent answer or join an identical query
+	#	in flight instead of sending it to the device again
+	# ------------------------------------------------------------------
+	def query(self, device, method, args, kwargs):
+		key = (device, method, json.dumps(args), json.dumps(kwargs, sort_keys=True))
+		with self.pending_lock:
+			generation = self.generations[device]
+			answer = self.answers.get(key)
+			if (answer is not None and answer[2] == generation
+					and time.monotonic() - answer[0] < self.query_max_age):
+				self.counts['cached'] += 1
+				return answer[1]
+			entry = self.pending.get((key, generation))
+			leader = entry is None
+			if leader:
+				entry = [threading.Event(), None]
+				self.pending[(key, generation)] = entry
+			else:
+				self.counts['coalesced'] += 1
+		if not leader:
+			entry[0].wait()
+			return entry[1]
+
+		try:
+			reply = self.call(device, method, args, kwargs)
+		finally:
+			with self.pending_lock:
+				del self.pending[(key, generation)]
+		if reply['ok']:
+			with self.pending_lock: # not if a command started since the query was asked
+				if self.generations[device] == generation:
+					self.answers[key] = (time.monotonic(), reply, generation)
+		entry[1] = reply
+		entry[0].set()
+		return reply
+
+	# ------------------------------------------------------------------
+	# Cached device state, never touches the ports
+	# ------------------------------------------------------------------
+	def status(self):
+		status = {name: {attribute: getattr(device, attribute, None)
+						 for attribute in device_attributes[name]}
+				  for name, device in self.devices.items()}
+		status['broker'] = dict(self.counts)
+		return status
+
+	# ------------------------------------------------------------------
+	# Stop serving
+	# ------------------------------------------------------------------
+	def close(self):
+		self.server.shutdown()
+		self.server.server_close()
+
+class BrokerServer(socketserver.ThreadingTCPServer):
+	daemon_threads = True
+	allow_reuse_address = True
+
+class BrokerHandler(socketserver.StreamRequestHandler):
+	def handle(self):
+		for line in self.rfile:
+			try:
+				reply = self.server.broker.handleRequest(json.loads(line))
+			except Exception as ex:
+				reply = {'ok': False, 'error': str(ex)}
+			self.wfile.write((json.dumps(reply, default=str) + '\n').encode())
+
+# -------------------------------------------------------------------
+# Broker client: one socket connection, usable from several threads
+# -------------------------------------------------------------------
+class BrokerError(Exception):
+	pass
+
+def remote_error(reply):
+	error = remote_errors.get(reply.get('error_type'))
+	if error is not None:
+		return error(reply['what'], reply['seconds'])
+	return BrokerError(reply['error'])
+
+class BrokerClient():
+	def __init__(self, port=default_port, timeout=None):
+		self.socket = socket.create_connection(('127.0.0.1', port), timeout=timeout)
+		self.file = self.socket.makefile('rw')
+		self.lock = threading.Lock()
+
+	def request(self, request):
+		with self.lock:
+			self.file.write(json.dumps(request) + '\n')
+			self.file.flush()
+			reply = json.loads(self.file.readline())
+		if not reply['ok']:
+			raise remote_error(reply)
+		return reply['result']
+
+	def status(self):
+		return self.request({'command': 'status'})
+
+	def device(self, name):
+		return RemoteDevice(self, name)
+
+	def close(self):
+		self.file.close()
+		self.socket.close()
+
+# -------------------------------------------------------------------
+# Remote Device Class Definition
+#	Stands in for a HamiltonMVP/APump in another process: methods and
+#	attributes are forwarded to the broker
+# -------------------------------------------------------------------
+class RemoteDevice():
+	def __init__(self, client, name):
+		self._client = client
+		self._name = name
+
+	def __getattr__(self, name):
+		if name in device_attributes[self._name]:
+			return self._client.request({'command': 'get', 'device': self._name, 'name': name})
+		def method(*args, **kwargs):
+			return self._client.request({'command': 'call', 'device': self._name, 'method': name,
+										 'args': list(args), 'kwargs': kwargs})
+		return method
+
+	def closeSerialPort(self): # the port belongs to the broker
+		pass
+
+	def closeRemote(self): # remote control is released by the broker
+		pass
+
+# -------------------------------------------------------------------
+# Run the broker for the rig's valves and pump
+# -------------------------------------------------------------------
+if __name__ == '__main__':
+	from gilsonMP3 import APump
+	from hamilton import HamiltonMVP
+
+	valve_com_port = sys.argv[1] if len(sys.argv) > 1 else 'COM7'
+	pump_com_port = sys.argv[2] if len(sys.argv) > 2 else 'COM8'
+	port = int(sys.argv[3]) if len(sys.argv) > 3 else default_port
+
+	MVPchain = HamiltonMVP(com_port=valve_com_port, verbose=True)
+	pump = APump(com_port=pump_com_port, verbose=True)
+	broker = DeviceBroker({'valves': MVPchain, 'pump': pump}, port=port)
+	print('Device broker serving on 127.0.0.1:' + str(port))
+	try:
+		while True:
+			time.sleep(1)
+	except KeyboardInterrupt:
+		broker.close()
+		pump.closeRemote()
+		MVPchain.closeSerialPort()
+		pump.closeSerialPort()
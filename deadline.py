@@ -0,0 +1,150 @@
+# # !/usr/bin/env python3
+
+# -------------------------------------------------------------------
+# Deadlines and cancellation for blocking waits
+#	Every polling loop in the drivers runs against a Deadline with a
+#	budget (seconds) from `budgets`, and raises a typed DeviceTimeout
+#	subclass when it runs out instead of waiting forever. cancel()
+#	interrupts all waits at once (they raise Cancelled); waits run
+#	inside cancel_scope(event) are also interrupted by that event
+#	alone (e.g. one preflight check that missed its deadline).
+#
+#	Waits decorated with @recoverable call `recovery(error, attempt)`
+#	on a timeout; if it returns True the wait is retried with a fresh
+#	budget (e.g. after re-initializing the device), otherwise the
+#	error is raised (escalated) to the caller.
+# -------------------------------------------------------------------
+
+# -------------------------------------------------------------------
+# Import
+# -------------------------------------------------------------------
+import contextlib
+import functools
+import threading
+import time
+
+# Budgets (seconds) per kind of wait, change them here or per call
+budgets = {'valve_move': 60,	# valve done moving
+		   'valve_status': 60,	# valve not moving and not overloaded
+		   'pump_select': 30,	# pump answers its unit select
+		   'fusion_start': 120,	# protocol state becomes Running
+		   'fusion_idle': 6 * 3600}	# acquisition finished
+
+recovery = None # function(error, attempt) -> True to retry the wait
+cancel_event = threading.Event()
+scope = threading.local() # cancel event of the current thread's scope
+
+# -------------------------------------------------------------------
+# Errors
+# -------------------------------------------------------------------
+class DeviceTimeout(Exception):
+	def __init__(self, what, seconds):
+		super().__init__('%s did not finish within %g s' % (what, seconds))
+		self.what = what
+		self.seconds = seconds
+
+class Cancelled(Exception):
+	pass
+
+# -------------------------------------------------------------------
+# Cancel all waits (from any thread), reset() to allow waiting again
+# -------------------------------------------------------------------
+def cancel():
+	cancel_event.set()
+
+def reset():
+	cancel_event.clear()
+
+# -------------------------------------------------------------------
+# Cancel scope: waits in this thread also stop once `event` is set
+# -------------------------------------------------------------------
+@contextlib.contextmanager
+def cancel_scope(event):
+	outer = getattr(scope, 'event', None)
+	scope.event = event
+	try:
+		yield event
+	finally:
+		scope.event = outer
+
+def cancelled():
+	event = getattr(scope, 'event', None)
+	return cancel_event.is_set() or (event is not None and event.is_set())
+
+# -------------------------------------------------------------------
+# Sleep up to `seconds`, returns True as soon as cancelled
+# -------------------------------------------------------------------
+def wait_cancelled(seconds):
+	event = getattr(scope, 'event', None)
+	if event is None:
+		return cancel_event.wait(seconds)
+	end = time.monotonic() + seconds
+	while not cancelled():
+		remaining = end - time.monotonic()
+		if remaining <= 0:
+			return False
+		event.wait(min(remaining, 0.1))
+	return True
+
+# -------------------------------------------------------------------
+# Budget of a kind of wait, `seconds` overrides it if given
+# -------------------------------------------------------------------
+def budget(kind, seconds=None):
+	return budgets[kind] if seconds is None else seconds
+
+# -------------------------------------------------------------------
+# Deadline Class Definition
+#	error: DeviceTimeout subclass raised when the deadline has passed
+#	what: description of the wait, used in the error message
+# -------------------------------------------------------------------
+class Deadline():
+	def __init__(self, seconds, error=DeviceTimeout, what='wait'):
+		self.seconds = seconds
+		self.error = error
+		self.what = what
+		self.end = time.monotonic() + seconds
+
+	def remaining(self):
+		return max(0.0, self.end - time.monotonic())
+
+	def expired(self):
+		return time.monotonic() >= self.end
+
+	# ------------------------------------------------------------------
+	# Move the deadline `seconds` later (e.g. time the device was paused)
+	# ------------------------------------------------------------------
+	def extend(self, seconds):
+		self.end += seconds
+
+	# ------------------------------------------------------------------
+	# Raise if cancelled or past the deadline
+	# ------------------------------------------------------------------
+	def check(self):
+		if cancelled():
+			raise Cancelled(self.what + ' cancelled')
+		if self.expired():
+			raise self.error(self.what, self.seconds)
+
+	# ------------------------------------------------------------------
+	# Sleep between polls, never past the deadline; wakes up on cancel()
+	# ------------------------------------------------------------------
+	def sleep(self, seconds):
+		self.check()
+		wait_cancelled(min(seconds, self.remaining()))
+		self.check()
+
+# -------------------------------------------------------------------
+# Decorator: on a DeviceTimeout, ask `recovery` whether to retry
+# -------------------------------------------------------------------
+def recoverable(function):
+	@functools.wraps(function)
+	def wrapper(*args, **kwargs):
+		attempt = 0
+		while True:
+			try:
+				return function(*args, **kwargs)
+			except DeviceTimeout as error:
+				attempt += 1
+				if recovery is None or not recovery(error, attempt):
+					raise
+	return wrapper
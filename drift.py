@@ -0,0 +1,142 @@
+# # !/usr/bin/env python3
+
+# -------------------------------------------------------------------
+# Round-to-round drift estimation
+#	FFT phase correlation of a downsampled DAPI projection of every
+#	position against the same position in round 0. All positions of
+#	a round are registered in one batched FFT.
+# -------------------------------------------------------------------
+
+# -------------------------------------------------------------------
+# Import
+# -------------------------------------------------------------------
+import numpy as np
+
+import images
+
+# -------------------------------------------------------------------
+# Downsample a stack of images (n, y, x) by block averaging
+# -------------------------------------------------------------------
+def downsample(stack, factor):
+	if factor <= 1:
+		return stack
+	n, height, width = stack.shape
+	height, width = height // factor, width // factor
+	stack = stack[:, :height*factor, :width*factor]
+	return stack.reshape(n, height, factor, width, factor).mean(axis=(2, 4))
+
+# -------------------------------------------------------------------
+# Batched phase correlation
+#	reference_fft: rfft2 of the (windowed) reference stack
+#	stack: (n, y, x) images of the current round, same shape
+#	Returns (n, 2) shifts (dy, dx) of stack relative to the reference
+#		and (n,) correlation peak heights (1.0 = perfect match)
+# -------------------------------------------------------------------
+def phase_correlate(reference_fft, stack, window):
+	height, width = stack.shape[1:]
+	cross = np.fft.rfft2(stack * window) * np.conj(reference_fft)
+	cross /= np.abs(cross) + 1e-12
+	correlation = np.fft.irfft2(cross, s=(height, width))
+
+	n = correlation.shape[0]
+	peak_index = correlation.reshape(n, -1).argmax(axis=1)
+	peak_y, peak_x = np.divmod(peak_index, width)
+	rows = np.arange(n)
+	peak = correlation[rows, peak_y, peak_x]
+
+	# Sub-pixel refinement: parabola through the peak and its neighbours
+	def refine(before, after):
+		denominator = before - 2*peak + after
+		offset = np.zeros(n)
+		np.divide(before - after, 2*denominator, out=offset, where=np.abs(denominator) > 1e-12)
+		return np.clip(offset, -0.5, 0.5)
+
+	dy = peak_y + refine(correlation[rows, (peak_y - 1) % height, peak_x],
+						 correlation[rows, (peak_y + 1) % height, peak_x])
+	dx = peak_x + refine(correlation[rows, peak_y, (peak_x - 1) % width],
+						 correlation[rows, peak_y, (peak_x + 1) % width])
+
+	# Wrap to signed shifts
+	dy = np.where(dy > height / 2, dy - height, dy)
+	dx = np.where(dx > width / 2, dx - width, dx)
+	return np.stack([dy, dx], axis=1), peak
+
+# -------------------------------------------------------------------
+# Drift Monitor Class Definition
+#	tolerance is in full-resolution pixels
+# -------------------------------------------------------------------
+class DriftMonitor():
+	def __init__(self, image_pattern, channel=0, downsample=4, tolerance=10.0,
+				 resolution_level=0):
+		self.image_pattern = image_pattern
+		self.channel = channel
+		self.downsample = downsample
+		self.tolerance = tolerance
+		self.resolution_level = resolution_level
+
+		# Reference (round 0), filled by the first call to check()
+		self.positions = []
+		self.shape = None
+		self.window = None
+		self.reference_fft = None
+
+	# ------------------------------------------------------------------
+	# Stack projections of the given positions, cropped to a common shape
+	# ------------------------------------------------------------------
+	def _stack(self, projections, positions):
+		if self.shape is None:
+			self.shape = (min(projections[p].shape[0] for p in positions),
+						  min(projections[p].shape[1] for p in positions))
+		height, width = self.shape
+		stack = np.stack([projections[p][:height, :width] for p in positions])
+		stack = downsample(stack.astype(np.float32, copy=False), self.downsample)
+		# remove the mean so the window does not add a spurious peak at 0
+		return stack - stack.mean(axis=(1, 2), keepdims=True)
+
+	# ------------------------------------------------------------------
+	# Set round 0 projections as reference
+	# ------------------------------------------------------------------
+	def setReference(self, projections):
+		self.positions = sorted(projections)
+		self.shape = None
+		stack = self._stack(projections, self.positions)
+		height, width = stack.shape[1:]
+		self.window = np.outer(np.hanning(height), np.hanning(width)).astype(np.float32)
+		self.reference_fft = np.fft.rfft2(stack * self.window)
+
+	# ------------------------------------------------------------------
+	# Estimate drift of projections {position: 2D array} against round 0
+	#	Returns {position: (dy, dx, peak, flagged)} in full-res pixels
+	# ------------------------------------------------------------------
+	def estimate(self, projections):
+		positions = [p for p in self.positions if p in projections]
+		if not positions:
+			return {}
+		index = [self.positions.index(p) for p in positions]
+		stack = self._stack(projections, positions)
+		shifts, peaks = phase_correlate(self.reference_fft[index], stack, self.window)
+		shifts *= max(self.downsample, 1) * 2**self.resolution_level
+
+		results = {}
+		for i, position in enumerate(positions):
+			dy, dx = float(shifts[i, 0]), float(shifts[i, 1])
+			flagged = bool(np.hypot(dy, dx) > self.tolerance)
+			results[position] = (dy, dx, float(peaks[i]), flagged)
+		return results
+
+	# ------------------------------------------------------------------
+	# Load the images of one acquisition (written between since and
+	#	until) and compare them to round 0
+	#	The first acquisition checked becomes the reference
+	#	Returns {position: (dy, dx, peak, flagged)}
+	# ------------------------------------------------------------------
+	def check(self, since, until=None):
+		paths = images.find_images(self.image_pattern, since, until)
+		projections = {position: images.load_projection(path, self.channel, self.resolution_level)
+					   for position, path in paths.items()}
+		if not projections:
+			return {}
+		if self.reference_fft is None:
+			self.setReference(projections)
+			return {position: (0.0, 0.0, 1.0, False) for position in self.positions}
+		return self.estimate(projections)
@@ -0,0 +1,140 @@
+# # !/usr/bin/env python3
+
+# -------------------------------------------------------------------
+# Reagent routing through the daisy chained MVP valves
+#	Valve 0 feeds the sample; any port can be fed by the outlet of
+#	another valve (valve_links). A reagent's route is the list of
+#	(valve_id, port) moves from the sample back to the reagent's port,
+#	so valves that are not on the path are never moved. FluidicGraph
+#	adds tubing volumes, destinations and move planning on top.
+# -------------------------------------------------------------------
+
+# -------------------------------------------------------------------
+# Route of one reagent
+#	setup: [valve_0_port, valve_1_port, ...] as in fluidics_setup,
+#		ports of valves that are not on the path are ignored
+#	valve_links: {(valve_id, port): upstream valve_id}
+# -------------------------------------------------------------------
+def find_route(setup, valve_links, outlet_valve=0):
+	route = []
+	valve_id = outlet_valve
+	while True:
+		if valve_id >= len(setup):
+			raise ValueError('No port given for valve ' + str(valve_id))
+		if any(valve_id == visited for visited, port in route):
+			raise ValueError('Valve links form a loop at valve ' + str(valve_id))
+		port = setup[valve_id]
+		route.append((valve_id, port))
+		if (valve_id, port) not in valve_links:
+			return route
+		valve_id = valve_links[(valve_id, port)]
+
+# -------------------------------------------------------------------
+# Routing table: {reagent: [(valve_id, port), ...]}
+# -------------------------------------------------------------------
+def build_routing_table(fluidics_setup, valve_links, outlet_valve=0):
+	return {reagent: find_route(setup, valve_links, outlet_valve)
+			for reagent, setup in fluidics_setup.items()}
+
+# -------------------------------------------------------------------
+# Fluidic Graph Class Definition
+#	Valves, their ports, the tubing segments between them and the
+#	destinations (sample, and waste if a bypass valve is fitted).
+#	Tubing segments are keyed as
+#		('port', valve_id, port): dead volume of a valve port
+#		('link', valve_id, port): tubing from the upstream valve's
+#			outlet into that port
+#		('outlet',): tubing from the outlet valve to the sample/bypass
+#	default_volumes gives ul per kind ('port', 'link', 'outlet'),
+#	volumes overrides single segments.
+# -------------------------------------------------------------------
+class FluidicGraph():
+	def __init__(self, fluidics_setup, valve_links, outlet_valve=0, bypass_valve=None,
+				 default_volumes=None, volumes=None):
+		self.valve_links = valve_links
+		self.outlet_valve = outlet_valve
+		self.bypass_valve = bypass_valve # (valve_id, port_to_sample, port_to_waste)
+		self.default_volumes = default_volumes or {'port': 0, 'link': 0, 'outlet': 0}
+		self.volumes = volumes or {}
+		self.routes = build_routing_table(fluidics_setup, valve_links, outlet_valve)
+
+	# ------------------------------------------------------------------
+	# Valve positions needed to send a reagent to 'sample' or 'waste'
+	# ------------------------------------------------------------------
+	def route(self, reagent, destination='sample'):
+		route = list(self.routes[reagent])
+		if self.bypass_valve is not None:
+			valve_id, port_to_sample, port_to_waste = self.bypass_valve
+			route.append((valve_id, port_to_sample if destination == 'sample' else port_to_waste))
+		elif destination != 'sample':
+			raise ValueError('No bypass valve to route ' + reagent + ' to ' + destination)
+		return route
+
+	# ------------------------------------------------------------------
+	# Moves needed to go from the current valve ports to a route
+	#	current_port: [port of valve 0, port of valve 1, ...]
+	#		(None or missing entries = unknown, always moved)
+	# ------------------------------------------------------------------
+	def moves(self, current_port, route):
+		return [(valve_id, port) for valve_id, port in route
+				if valve_id >= len(current_port) or current_port[valve_id] != port]
+
+	# ------------------------------------------------------------------
+	# Moves toward the next route that can be made now without touching
+	#	the active path (valves not on the active route)
+	# ------------------------------------------------------------------
+	def prefetchMoves(self, current_port, active_route, next_route):
+		active_valves = set(valve_id for valve_id, port in active_route)
+		return [(valve_id, port) for valve_id, port in self.moves(current_port, next_route)
+				if valve_id not in active_valves]
+
+	# ------------------------------------------------------------------
+	# Tubing segments from a reagent's port to the outlet
+	# ------------------------------------------------------------------
+	def segments(self, reagent):
+		segments = [('outlet',)]
+		for valve_id, port in self.routes[reagent]:
+			segments.append(('port', valve_id, port))
+			if (valve_id, port) in self.valve_links:
+				segments.append(('link', valve_id, port))
+		return segments
+
+	# ------------------------------------------------------------------
+	# Dead volume (ul) between a reagent's port and the sample/bypass
+	# ------------------------------------------------------------------
+	def volume(self, reagent):
+		return sum(self.volumes.get(segment, self.default_volumes[segment[0]])
+				   for segment in self.segments(reagent))
+
+	# ------------------------------------------------------------------
+	# Valve travel (ports stepped over, the shorter way round) to go
+	#	from the current valve ports to a route
+	#	ports_per_valve: [number of ports of valve 0, ...]
+	# ------------------------------------------------------------------
+	def travel(self, current_port, route, ports_per_valve):
+		steps = 0
+		for valve_id, port in self.moves(current_port, route):
+			if valve_id >= len(current_port) or current_port[valve_id] is None:
+				steps += ports_per_valve[valve_id] // 2 # unknown position: assume half a turn
+				continue
+			distance = abs(current_port[valve_id] - port) % ports_per_valve[valve_id]
+			steps += min(distance, ports_per_valve[valve_id] - distance)
+		return steps
+
+	# ------------------------------------------------------------------
+	# Order reagents so the valves travel as little as possible
+	#	(nearest reagent next, starting from the current ports)
+	# ------------------------------------------------------------------
+	def orderByTravel(self, reagents, current_port, ports_per_valve, destination='sample'):
+		current_port = list(current_port)
+		remaining = list(reagents)
+		ordered = []
+		while remaining:
+			reagent = min(remaining, key=lambda reagent: (self.travel(current_port,
+				self.route(reagent, destination), ports_per_valve), remaining.index(reagent)))
+			remaining.remove(reagent)
+			ordered.append(reagent)
+			for valve_id, port in self.route(reagent, destination):
+				current_port += [None] * (valve_id + 1 - len(current_port))
+				current_port[valve_id] = port
+		return ordered
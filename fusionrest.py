@@ -1,7 +1,14 @@
 import requests
+import asyncio
 import json
+import queue
+import threading
 import time
 
+from deadline import Deadline, DeviceTimeout, budget
+from tracing import traced
+
+# Address of the Fusion instance used by the module-level functions
 host = "localhost"
 port = 15120
 
@@ -11,7 +18,7 @@ class ApiError(Exception):
 	"""
 	def __init__(self, endpoint, code, reason):
 		"""
-		Creates an new `ApiError` instance.
+		Creates a new `ApiError` instance.
 		"""
 		self._endpoint = endpoint
 		self._code = code
@@ -42,56 +49,379 @@ class ApiError(Exception):
 		"""
 		return self._reason
 
-def __make_address(endpoint):
-	return "http://{}:{}{}".format(host, port, endpoint)
+class ProtocolError(Exception):
+	"""
+	Indicates that a protocol could not be selected or is not ready to run.
+	"""
+	def __init__(self, name, reason):
+		"""
+		Creates a new `ProtocolError` instance.
+		"""
+		self._name = name
+		self._reason = reason
+
+	def __repr__(self):
+		return "<ProtocolError for {}: {}>".format(self._name, self._reason)
+
+	def __str__(self):
+		return self.__repr__()
+
+	def name(self):
+		"""
+		Gives the name of the protocol.
+		"""
+		return self._name
+
+	def reason(self):
+		"""
+		Gives the reason for the error. (a string)
+		"""
+		return self._reason
+
+class FusionTimeout(DeviceTimeout):
+	"""
+	Indicates that Fusion did not reach a protocol state within the time budget (see `deadline.budgets`).
+	"""
+	pass
+
+class FusionClient():
+	"""
+	Client for one Fusion instance (host and port).
+	Requests go through a pool of HTTP sessions, so one client can be used from several threads at once.
+	Every request has a (connect, read) timeout in seconds, and per-endpoint call counts, errors and latencies are kept in `metrics()`.
+	Blocking calls have asyncio counterparts, see `call_async()` and `wait_until_state_async()`.
+	"""
+	def __init__(self, host="localhost", port=15120, timeout=(2, 10), pool_size=4):
+		"""
+		Creates a new `FusionClient` instance.
+		"""
+		self.host = host
+		self.port = port
+		self.timeout = timeout
+		self.armed_protocols = [] # protocols selected ahead of time by `arm()`
+		self.last_state = None # (state, time.time()) of the last state query
+		self.last_progress = None # (percentage, time.time()) of the last progress query
+		self.progress_interval = None # seconds between progress queries while waiting, None for none
+
+		self._sessions = queue.LifoQueue()
+		for i in range(pool_size):
+			self._sessions.put(requests.Session())
+		self._metrics_lock = threading.Lock()
+		self._metrics = {}
+		self._arm_lock = threading.RLock()
+
+	def __repr__(self):
+		return "<FusionClient {}:{}>".format(self.host, self.port)
+
+	def _make_address(self, endpoint):
+		return "http://{}:{}{}".format(self.host, self.port, endpoint)
+
+	@traced('rest')
+	def _request(self, method, endpoint, data=None):
+		session = self._sessions.get() # blocks while all sessions are in use
+		started = time.monotonic()
+		failed = True
+		try:
+			response = session.request(method, self._make_address(endpoint), data=data, timeout=self.timeout)
+			if (response.status_code < 200) or (response.status_code > 299):
+				raise ApiError(endpoint, response.status_code, response.reason)
+			failed = False
+			return response
+		finally:
+			self._sessions.put(session)
+			self._record(method + " " + endpoint, time.monotonic() - started, failed)
+
+	def _record(self, key, seconds, failed):
+		with self._metrics_lock:
+			entry = self._metrics.setdefault(key, {'calls': 0, 'errors': 0, 'seconds': 0.0, 'max_seconds': 0.0})
+			entry['calls'] += 1
+			entry['errors'] += failed
+			entry['seconds'] += seconds
+			entry['max_seconds'] = max(entry['max_seconds'], seconds)
+
+	def metrics(self):
+		"""
+		Returns a copy of the request metrics: {"GET /v1/...": {'calls', 'errors', 'seconds', 'max_seconds'}}.
+		"""
+		with self._metrics_lock:
+			return {key: dict(entry) for key, entry in self._metrics.items()}
+
+	def close(self):
+		"""
+		Closes all pooled HTTP sessions.
+		"""
+		while not self._sessions.empty():
+			self._sessions.get().close()
+
+	def _get(self, endpoint):
+		return self._request('GET', endpoint).json()
+
+	def _get_plain(self, endpoint):
+		return self._request('GET', endpoint).text
+
+	def _get_value(self, endpoint, key):
+		struct = self._get(endpoint)
+		return struct[key]
+
+	def _put(self, endpoint, obj):
+		body = json.dumps(obj)
+		self._put_plain(endpoint, body)
+
+	def _put_plain(self, endpoint, body):
+		self._request('PUT', endpoint, data=body)
+
+	def _put_value(self, endpoint, key, value):
+		struct = {key: value}
+		self._put(endpoint, struct)
+
+	# low-level API
+
+	def _get_state(self):
+		state = self._get_value("/v1/protocol/state", 'State')
+		self.last_state = (state, time.time())
+		return state
+
+	def _set_state(self, value):
+		return self._put_value("/v1/protocol/state", 'State', value)
+
+	def _get_selected_protocol(self):
+		return self._get_value("/v1/protocol/current", 'Name')
+
+	def _set_selected_protocol(self, value):
+		return self._put_value("/v1/protocol/current", 'Name', value)
+
+	def _get_protocol_progress(self):
+		return self._get("/v1/protocol/progress")
+
+	# high-level API
+
+	def change_protocol(self, name):
+		"""
+		Changes to the protocol named.
+		"""
+		self._set_selected_protocol(name)
+
+	def arm(self, names):
+		"""
+		Selects one protocol, or a queue of protocols, ahead of time so that a later `run_protocol_completely()` only has to start it.
+		Every protocol in the queue is selected once and read back, so a misspelled name fails here; the first one is left selected.
+		After an armed protocol has run, the next one in the queue is selected.
+		Raises `ProtocolError` if Fusion is busy or a protocol cannot be selected.
+		"""
+		if isinstance(names, str):
+			names = [names]
+		with self._arm_lock:
+			self.armed_protocols = []
+			state = self._get_state()
+			if state != 'Idle':
+				raise ProtocolError(names[0], 'Fusion is not idle ({})'.format(state))
+			for name in reversed(names): # the first protocol is selected last
+				self._set_selected_protocol(name)
+				selected = self._get_selected_protocol()
+				if selected != name:
+					raise ProtocolError(name, 'selected protocol reads back as {}'.format(selected))
+			self.armed_protocols = list(names)
+
+	def is_armed(self, name):
+		"""
+		Returns True if the named protocol is armed, still selected and Fusion is idle, i.e. it can be started right away.
+		"""
+		if not self.armed_protocols or self.armed_protocols[0] != name:
+			return False
+		return self._get_selected_protocol() == name and self._get_state() == 'Idle'
 
-def __raise_on_error(endpoint, response):
-	if (response.status_code < 200) or (response.status_code > 299):
-		raise ApiError(endpoint, response.status_code, response.reason)
+	def run(self, name):
+		"""
+		Changes to the named protocol and starts to run it.
+		If no name is given, runs the currently-selected protocol.
+		
+		NB: this function does not block until the state changes; use `get_state()` to be sure the protocol has actually started.
+		"""
+		if name is not None:
+			self._set_selected_protocol(name)
+		self._set_state('Running')
 
-def __get(endpoint):
-	response = requests.get(__make_address(endpoint))
-	__raise_on_error(endpoint, response)
-	# print("debug: received text [[%s]]" % response.text)
-	return response.json()
+	def pause(self):
+		"""
+		Pauses a protocol that is currently running.
+		The protocol can be resumed with a `resume()` call.
+		It is an error to call this if no protocol is running.
+		
+		NB: this function does not block until the state changes; use `get_state()` to be sure the protocol has actually paused.
+		"""
+		self._set_state('Paused')
 
-def __get_plain(endpoint):
-	response = requests.get(__make_address(endpoint))
-	__raise_on_error(endpoint, response)
-	return response.text
+	def resume(self):
+		"""
+		Resumes a previously-paused protocol.
+		It is an error to call this if no protocol is running or paused.
+		
+		NB: this function does not block until the state changes; use `get_state()` to be sure the protocol has actually resumed.
+		"""
+		self._set_state('Running')
 
-def __get_value(endpoint, key):
-	struct = __get(endpoint)
-	return struct[key]
+	def stop(self):
+		"""
+		Stops a protocol that is currently running.
+		It is an error to call this if no protocol is running or paused.
+		
+		NB: this function does not block until the state changes; use `get_state()` to be sure the protocol has actually stopped.
+		"""
+		self._set_state('Aborted')
+
+	def get_state(self):
+		"""
+		Returns the current run state of the protocol.
+		Always returns one of the following strings:
+		* Idle:     The protocol is not running.
+		* Waiting:  User requested protocol run (transitional state).
+		* Running:  Protocol is running.
+		* Paused:   Protocol was running and is now paused.
+		* Aborting: User has requested protocol stop (transitional state).
+		* Aborted:  The protocol has stopped (transitional state, will become Idle).
+		"""
+		return self._get_state()
 
-def __put(endpoint, obj):
-	body = json.dumps(obj)
-	__put_plain(endpoint, body)
+	def wait_until_state(self, target_state, check_interval_secs, timeout=None):
+		"""
+		Waits until the protocol is in the given `target_state`.
+		Repeatedly queries the API every `check_interval_secs`.
+		If `progress_interval` is set, the completion percentage is also queried that often (see `last_progress`).
+		This call will block until the target state is reached, for at most `timeout` seconds (default: the 'fusion_idle' budget);
+		time the protocol spends paused does not count.
+		Raises `FusionTimeout` when the time is up, and `deadline.Cancelled` after `deadline.cancel()`.
+		The wait is not retried through `deadline.recovery`: a timeout means the whole budget ran out, and waiting as long again would only hide a stalled acquisition.
+		"""
+		wait = Deadline(budget('fusion_idle', timeout), FusionTimeout, "Fusion state " + target_state)
+		progress_checked = time.monotonic()
+		checked = time.monotonic()
+		while True:
+			state = self._get_state()
+			if state == target_state:
+				break
+			if state == 'Paused': # paused since the last check
+				wait.extend(time.monotonic() - checked)
+			checked = time.monotonic()
+			if self.progress_interval is not None and time.monotonic() - progress_checked >= self.progress_interval:
+				progress_checked = time.monotonic()
+				self.completion_percentage()
+			wait.sleep(check_interval_secs)
+
+	def wait_until_idle(self, timeout=None):
+		"""
+		Waits until the protocol has completed, checking every 1 second.
+		This call will block until the target state is reached (at most the 'fusion_idle' budget by default).
+		"""
+		self.wait_until_state('Idle', 1, timeout=budget('fusion_idle', timeout))
 
-def __put_plain(endpoint, body):
-	response = requests.put(__make_address(endpoint), data=body)
-	__raise_on_error(endpoint, response)
+	@traced('acquisition_start')
+	def wait_until_running(self, timeout=None):
+		"""
+		Waits until the protocol has started up, checking every 100 milliseconds.
+		This call will block until the target state is reached (at most the 'fusion_start' budget by default).
+		"""
+		self.wait_until_state('Running', 0.1, timeout=budget('fusion_start', timeout))
 
-def __put_value(endpoint, key, value):
-	struct = {key: value}
-	__put(endpoint, struct)
+	def completion_percentage(self):
+		"""
+		Returns the current protocol completion percentage, as a number ranging from 0 to 100.
+		If called after the protocol has stopped, this function will return whatever the final completion percentage was.
+		This may be less than 100 if the protocol was manually stopped early.
+		"""
+		info = self._get_protocol_progress()
+		self.last_progress = (100 * info['Progress'], time.time())
+		return self.last_progress[0]
+
+	@traced('acquisition')
+	def run_protocol_completely(self, protocol_name):
+		"""
+		Tells Fusion to run the named protocol, and waits for it to complete.
+		If the protocol was armed with `arm()`, it is only started; the next armed protocol is selected afterwards.
+		This call will block until the protocol has finished.
+		"""
+		with self._arm_lock:
+			if self.is_armed(protocol_name):
+				self.armed_protocols = self.armed_protocols[1:]
+				self.run(None)
+			else:
+				self.armed_protocols = []
+				self.run(protocol_name)
+		self.wait_until_running()
+		self.wait_until_idle()
+		with self._arm_lock:
+			if self.armed_protocols:
+				self._set_selected_protocol(self.armed_protocols[0])
+
+	# asyncio API
+
+	async def call_async(self, method_name, *args, **kwargs):
+		"""
+		Runs any blocking method of this client (e.g. "run_protocol_completely") in the default executor and awaits it.
+		"""
+		loop = asyncio.get_running_loop()
+		method = getattr(self, method_name)
+		return await loop.run_in_executor(None, lambda: method(*args, **kwargs))
+
+	async def get_state_async(self):
+		"""
+		Asyncio version of `get_state()`.
+		"""
+		return await self.call_async('get_state')
+
+	async def wait_until_state_async(self, target_state, check_interval_secs, timeout=None):
+		"""
+		Asyncio version of `wait_until_state()`; other tasks keep running between the checks.
+		"""
+		wait = Deadline(budget('fusion_idle', timeout), FusionTimeout, "Fusion state " + target_state)
+		checked = time.monotonic()
+		while True:
+			state = await self.get_state_async()
+			if state == target_state:
+				break
+			if state == 'Paused': # paused since the last check
+				wait.extend(time.monotonic() - checked)
+			checked = time.monotonic()
+			wait.check()
+			await asyncio.sleep(min(check_interval_secs, wait.remaining()))
+			wait.check()
+
+	async def run_protocol_completely_async(self, protocol_name):
+		"""
+		Asyncio version of `run_protocol_completely()`.
+		"""
+		await self.call_async('run_protocol_completely', protocol_name)
+
+# module-level API, using one client for `host` and `port`
+
+_default_client = None
+_default_client_lock = threading.Lock()
+
+def default_client():
+	"""
+	Returns the client used by the module-level functions (re-created if `host` or `port` changed).
+	"""
+	global _default_client
+	with _default_client_lock:
+		if _default_client is None or (_default_client.host, _default_client.port) != (host, port):
+			_default_client = FusionClient(host, port)
+		return _default_client
 
 # low-level API
 
 def _get_state():
-	return __get_value("/v1/protocol/state", 'State')
+	return default_client()._get_state()
 
 def _set_state(value):
-	return __put_value("/v1/protocol/state", 'State', value)
+	return default_client()._set_state(value)
 
 def _get_selected_protocol():
-	return __get_value("/v1/protocol/current", 'Name')
+	return default_client()._get_selected_protocol()
 
 def _set_selected_protocol(value):
-	return __put_value("/v1/protocol/current", 'Name', value)
+	return default_client()._set_selected_protocol(value)
 
 def _get_protocol_progress():
-	return __get("/v1/protocol/progress")
+	return default_client()._get_protocol_progress()
 
 # high-level API
 
@@ -99,7 +429,20 @@ def change_protocol(name):
 	"""
 	Changes to the protocol named.
 	"""
-	_set_selected_protocol(name)
+	default_client().change_protocol(name)
+
+def arm(names):
+	"""
+	Selects one protocol, or a queue of protocols, ahead of time so that a later `run_protocol_completely()` only has to start it.
+	Raises `ProtocolError` if Fusion is busy or a protocol cannot be selected.
+	"""
+	default_client().arm(names)
+
+def is_armed(name):
+	"""
+	Returns True if the named protocol is armed and can be started right away.
+	"""
+	return default_client().is_armed(name)
 
 def run(name):
 	"""
@@ -108,9 +451,7 @@ def run(name):
 	
 	NB: this function does not block until the state changes; use `get_state()` to be sure the protocol has actually started.
 	"""
-	if name is not None:
-		_set_selected_protocol(name)
-	_set_state('Running')
+	default_client().run(name)
 
 def pause():
 	"""
@@ -120,7 +461,7 @@ def pause():
 	
 	NB: this function does not block until the state changes; use `get_state()` to be sure the protocol has actually paused.
 	"""
-	_set_state('Paused')
+	default_client().pause()
 
 def resume():
 	"""
@@ -129,7 +470,7 @@ def resume():
 	
 	NB: this function does not block until the state changes; use `get_state()` to be sure the protocol has actually resumed.
 	"""
-	_set_state('Running')
+	default_client().resume()
 
 def stop():
 	"""
@@ -138,7 +479,7 @@ def stop():
 	
 	NB: this function does not block until the state changes; use `get_state()` to be sure the protocol has actually stopped.
 	"""
-	_set_state('Aborted')
+	default_client().stop()
 
 def get_state():
 	"""
@@ -151,30 +492,30 @@ def get_state():
 	* Aborting: User has requested protocol stop (transitional state).
 	* Aborted:  The protocol has stopped (transitional state, will become Idle).
 	"""
-	return _get_state()
+	return default_client().get_state()
 
-def wait_until_state(target_state, check_interval_secs):
+def wait_until_state(target_state, check_interval_secs, timeout=None):
 	"""
 	Waits until the protocol is in the given `target_state`.
 	Repeatedly queries the API every `check_interval_secs`.
-	This call will block until the target state is reached.
+	This call will block until the target state is reached, for at most `timeout` seconds (default: the 'fusion_idle' budget);
+	time the protocol spends paused does not count.
 	"""
-	while _get_state() != target_state:
-		time.sleep(check_interval_secs)
+	default_client().wait_until_state(target_state, check_interval_secs, timeout=timeout)
 
-def wait_until_idle():
+def wait_until_idle(timeout=None):
 	"""
 	Waits until the protocol has completed, checking every 1 second.
-	This call will block until the target state is reached.
+	This call will block until the target state is reached (at most the 'fusion_idle' budget by default).
 	"""
-	wait_until_state('Idle', 1)
+	default_client().wait_until_idle(timeout=timeout)
 
-def wait_until_running():
+def wait_until_running(timeout=None):
 	"""
 	Waits until the protocol has started up, checking every 100 milliseconds.
-	This call will block until the target state is reached.
+	This call will block until the target state is reached (at most the 'fusion_start' budget by default).
 	"""
-	wait_until_state('Running', 0.1)
+	default_client().wait_until_running(timeout=timeout)
 
 def completion_percentage():
 	"""
@@ -182,14 +523,11 @@ def completion_percentage():
 	If called after the protocol has stopped, this function will return whatever the final completion percentage was.
 	This may be less than 100 if the protocol was manually stopped early.
 	"""
-	info = _get_protocol_progress()
-	return 100 * info['Progress']
+	return default_client().completion_percentage()
 
 def run_protocol_completely(protocol_name):
 	"""
 	Tells Fusion to run the named protocol, and waits for it to complete.
 	This call will block until the protocol has finished.
 	"""
-	run(protocol_name)
-	wait_until_running()
-	wait_until_idle()
+	default_client().run_protocol_completely(protocol_name)
@@ -10,9 +10,14 @@
 # ----------------------------------------------------------------------
 # Import
 # ----------------------------------------------------------------------
-import serial
+import contextlib
+import threading
 import time
 
+from deadline import Deadline, DeviceTimeout, budget, recoverable
+from tracing import traced
+from transport import Reconnected, ReconnectingTransport
+
 # ----------------------------------------------------------------------
 # Define important serial characters
 # ----------------------------------------------------------------------
@@ -22,11 +27,54 @@ stop = '\x0d'
 R = '\xd2' # ASCII R (82 = 0x52) + 128 = 210 = 0xd2 (remote response)
 K = '\xcb' # ASCII K (75 = 0x4b) + 128 = 203 = 0xcb (keypad response)
 
+# ----------------------------------------------------------------------
+# Pump did not answer within its budget (see deadline.py)
+# ----------------------------------------------------------------------
+class PumpTimeout(DeviceTimeout):
+	pass
+
+# ----------------------------------------------------------------------
+# Command Lock: a reentrant lock that counts the threads waiting for it,
+#	so a background reader holding it can see a command is pending
+#	and give the line back (see APump.sampleDisplay)
+# ----------------------------------------------------------------------
+class CommandLock():
+	def __init__(self):
+		self.lock = threading.RLock()
+		self.count_lock = threading.Lock()
+		self.waiting = 0
+	
+	def acquire(self, blocking = True):
+		if not blocking:
+			return self.lock.acquire(blocking = False)
+		with self.count_lock:
+			self.waiting += 1
+		try:
+			return self.lock.acquire()
+		finally:
+			with self.count_lock:
+				self.waiting -= 1
+	
+	def release(self):
+		self.lock.release()
+	
+	def __enter__(self):
+		return self.acquire()
+	
+	def __exit__(self, *exc_info):
+		self.release()
+
 # ----------------------------------------------------------------------
 # Gilson Minipuls3 Class Definition
+#	bus: GilsonBus shared with other units on the same serial line
+#		(com_port, transport and trace_path are then ignored)
+#	verify_interval: s between checks of the state mirror against the
+#		display (before a start), None to never check
 # ----------------------------------------------------------------------
 class APump():
-	def __init__(self, com_port = 'COM8', verbose = True, parameters = False):
+	def __init__(self, com_port = 'COM8', verbose = True, parameters = False,
+				 transport = None, trace_path = None, bus = None, pump_ID = 30,
+				 verify_interval = 60):
 		
 		# # Define attributes -- implement this in future versions
 		# self.com_port = parameters.get('pump_com_port', 'COM5')
@@ -39,27 +87,52 @@ class APump():
 		# Define attributes - for now just hard-code them instead of
 		#	parsing XML file
 		self.com_port = com_port
-		self.pump_ID = 30
+		self.pump_ID = pump_ID
+		self.bus = bus
 		self.verbose = verbose
 		# self.flip_flow_direction = False
 		self.flip_flow_direction = True		#since useqFISH uses the pump in reverse direction
 		self.read_length = 40
 		
-		# Create serial port
-		self.serial = serial.Serial(port = self.com_port,
-									baudrate = 19200,
-									parity = serial.PARITY_EVEN,
-									bytesize = serial.EIGHTBITS,
-									stopbits = serial.STOPBITS_TWO,
-									timeout = 1) # changed timeout from 0.1
+		# Create serial port (unless a transport, e.g. a trace replay, is given),
+		#	reopened automatically if it fails (see transact)
+		if bus is not None:
+			transport = bus.serial
+		elif transport is None:
+			import serial # only needed to open a port (not for traces or a bus)
+			transport = ReconnectingTransport(lambda: serial.Serial(port = self.com_port,
+									  baudrate = 19200,
+									  parity = serial.PARITY_EVEN,
+									  bytesize = serial.EIGHTBITS,
+									  stopbits = serial.STOPBITS_TWO,
+									  timeout = 1), what = 'Gilson pump port ' + str(com_port)) # changed timeout from 0.1
+		if trace_path is not None and bus is None: # record all serial traffic
+			from transport import RecordingTransport
+			transport = RecordingTransport(transport, trace_path)
+		self.serial = transport
 		
-		# Define initial pump status
+		# Define initial pump status (as commanded, see startFlow/stopFlow)
 		self.flow_status = 'Stopped'
 		self.speed = 0.0
 		self.direction = 'Forward'
 		
+		# One serial transaction at a time (background samplers share the
+		#	port, and yield it to commands waiting for the lock)
+		self.lock = CommandLock()
+		self.last_command_time = time.monotonic()
+		
+		# Mirror of the pump's state as last set by a command (None =
+		#	unknown), so commands that would not change anything are
+		#	skipped; checked against the display every verify_interval s
+		self.mirror = {'speed': None, 'direction': None, 'running': None}
+		self.verify_interval = verify_interval
+		self.last_verified = None
+		self.skipped_commands = 0
+		self.mirror_mismatches = 0
+		
 		# self.masterReset()
-		self.disconnect()
+		with self.lock, self.busTurn():
+			self.disconnect()
 		self.enableRemoteControl(1)
 		self.startFlow(self.speed, self.direction)
 		self.confirmRemoteControl()
@@ -77,6 +150,7 @@ class APump():
 			return True
 		elif response == 'K':
 			print('Keypad control enabled')
+			self.invalidateMirror() # keys may have been pressed
 			return False
 		else:
 			return False
@@ -91,7 +165,8 @@ class APump():
 	# Disconnect from Serial Connection
 	# ------------------------------------------------------------------
 	def closeSerialPort(self):
-		self.serial.close()
+		if self.bus is None: # a shared port is closed by the bus
+			self.serial.close()
 	
 	# ------------------------------------------------------------------
 	# Disconnect
@@ -107,6 +182,7 @@ class APump():
 			self.sendBuffered(self.pump_ID, 'SR')
 		else:
 			self.sendBuffered(self.pump_ID, 'SK')
+		self.invalidateMirror() # unknown while the keypad is enabled
 	
 	# ------------------------------------------------------------------
 	# Get Entire Response - Read all bits in buffer, clear buffer, etc.
@@ -133,7 +209,12 @@ class APump():
 	def getStatus(self):
 		message = self.readDisplay()
 		print(message)
+		return self.parseStatus(message)
 		
+	# ------------------------------------------------------------------
+	# Parse Pump Display Message into Operation Status
+	# ------------------------------------------------------------------
+	def parseStatus(self, message):
 		if self.flip_flow_direction:
 			direction = {' ' : 'Not Running',
 						 '-' : 'Forward',
@@ -155,6 +236,51 @@ class APump():
 		
 		return (status, speed, direction, control, auto_start, 'No Error')
 		
+	# ------------------------------------------------------------------
+	# Forget the mirrored state: the next start resends everything
+	# ------------------------------------------------------------------
+	def invalidateMirror(self):
+		with self.lock:
+			self.mirror = {'speed': None, 'direction': None, 'running': None}
+	
+	# ------------------------------------------------------------------
+	# Compare a parsed status (see parseStatus) with the mirror
+	#	read_time: time.monotonic() of the display read; the check is
+	#		skipped if a command was sent since
+	#	The mirror is invalidated on a mismatch. Returns True if it matched
+	# ------------------------------------------------------------------
+	def checkMirror(self, status, read_time = None):
+		with self.lock:
+			if read_time is not None and self.last_command_time > read_time:
+				return True
+			flow_status, speed, direction, control = status[:4]
+			running = flow_status == 'Flowing' and speed > 0
+			mirror = self.mirror
+			matched = (control == 'Remote'
+					   and mirror['running'] in (None, running)
+					   and (not running or mirror['direction'] in (None, direction))
+					   and (not running or mirror['speed'] is None or abs(mirror['speed'] - speed) < 0.01))
+			self.last_verified = time.monotonic()
+			if not matched:
+				self.mirror_mismatches += 1
+				if self.verbose:
+					print('Pump state ' + str(status[:4]) + ' does not match ' + str(mirror))
+				self.invalidateMirror()
+			return matched
+	
+	# ------------------------------------------------------------------
+	# Read the display and check the mirror against it
+	# ------------------------------------------------------------------
+	def verifyMirror(self):
+		with self.lock:
+			message = self.readDisplay()
+			try:
+				status = self.parseStatus(message)
+			except (ValueError, IndexError):
+				self.invalidateMirror()
+				return False
+			return self.checkMirror(status)
+	
 	# ------------------------------------------------------------------
 	# Master Reset
 	# ------------------------------------------------------------------
@@ -181,6 +307,32 @@ class APump():
 		#		" " a space means that no key was pressed
 		# Default response: "$"
 	
+	# ------------------------------------------------------------------
+	# Read the Display for a Background Sampler
+	#	Gives way to commands: returns None (nothing read) if the pump
+	#	is busy or a command is waiting for it, before and after the
+	#	unit select. The select only waits for the unit's echo instead
+	#	of a full read timeout, so the line is held for a few
+	#	characters. Returns (message, time.monotonic() of the read)
+	# ------------------------------------------------------------------
+	def sampleDisplay(self):
+		if self.lock.waiting or not self.lock.acquire(blocking = False):
+			return None
+		try:
+			with self.busTurn():
+				if not self.quickSelectUnit(self.pump_ID) or self.lock.waiting:
+					self.disconnect()
+					return None
+				read_time = time.monotonic()
+				message = self.readImmediate('R')
+				self.disconnect()
+				return message, read_time
+		except Reconnected:
+			self.recoverConnection()
+			return None
+		finally:
+			self.lock.release()
+	
 	# ------------------------------------------------------------------
 	# Select Unit
 	#
@@ -210,6 +362,15 @@ class APump():
 		#print('Unit selection failed')
 			return False
 	
+	# ------------------------------------------------------------------
+	# Select Unit, reading back only its echo (no full read timeout);
+	#	anything else on the line counts as a failed select
+	# ------------------------------------------------------------------
+	def quickSelectUnit(self, unitNumber):
+		devSelect = chr(0x80 | unitNumber)
+		self.sendString(devSelect)
+		return self.getResponse().decode('ISO-8859-1') == devSelect
+	
 	# ------------------------------------------------------------------
 	# Send and Acknowledge
 	# ------------------------------------------------------------------
@@ -225,12 +386,14 @@ class APump():
 	#		executed one at a time.
 	#	Note: Response to buffered command is a period (.)
 	# ------------------------------------------------------------------
+	@traced('serial')
 	def sendBuffered(self, unitNumber, command):
-		while not self.selectUnit(unitNumber):
-			time.sleep(1)
-			self.selectUnit(unitNumber)		
-		self.sendAndAcknowledge(start + command + stop)
-		self.disconnect()
+		def transaction():
+			self.waitForUnit(unitNumber)
+			self.sendAndAcknowledge(start + command + stop)
+			self.disconnect()
+			self.last_command_time = time.monotonic()
+		self.transact(transaction, command)
 		
 	# ------------------------------------------------------------------
 	# Send Immediate Command
@@ -239,10 +402,22 @@ class APump():
 	#		instrument and are executed immediately, temporarily
 	#		interrupting other commands in progress.
 	# ------------------------------------------------------------------
+	@traced('serial')
 	def sendImmediate(self, unitNumber, command):
-		while not self.selectUnit(unitNumber):
-			time.sleep(1)
-			self.selectUnit(unitNumber)
+		def transaction():
+			self.waitForUnit(unitNumber)
+			response = self.readImmediate(command)
+			self.disconnect()
+			return response
+		
+		return self.transact(transaction) # status requests are always resent
+	
+	# ------------------------------------------------------------------
+	# Read the Response to an Immediate Command (unit already selected)
+	#	One character at a time, acknowledging each; the last one has
+	#	its high bit set
+	# ------------------------------------------------------------------
+	def readImmediate(self, command):
 		self.sendString(command[0])
 		newCharacter = self.getResponse() # read one bit
 		response = ''
@@ -253,11 +428,82 @@ class APump():
 				self.sendString(acknowledge)
 				newCharacter = self.getResponse()
 			response += chr(ord(newCharacter.decode('ISO-8859-1')) & ~0x80)
-		
-		self.disconnect()
-		
 		return response
 	
+	# ------------------------------------------------------------------
+	# Run One Serial Transaction, Surviving a Reopened Port
+	#	If the port had to be reopened, the pump is checked (see
+	#	recoverConnection) and the transaction is run again, unless
+	#	the pump shows that buffered `command` already took effect
+	# ------------------------------------------------------------------
+	def transact(self, transaction, command = None):
+		with self.lock:
+			try:
+				with self.busTurn():
+					return transaction()
+			except Reconnected:
+				status = self.recoverConnection()
+				if command is not None and self.commandConfirmed(command, status):
+					return None
+				with self.busTurn():
+					return transaction()
+	
+	# ------------------------------------------------------------------
+	# Recover After the Serial Port Was Reopened
+	#	Remote control is restored if the pump fell back to keypad
+	#	control; returns the parsed status (None if unreadable)
+	# ------------------------------------------------------------------
+	def recoverConnection(self):
+		print('Pump port reopened, checking pump state')
+		with self.busTurn():
+			self.disconnect()
+		if not self.confirmRemoteControl():
+			self.enableRemoteControl(1)
+		self.invalidateMirror()
+		try:
+			return self.parseStatus(self.readDisplay())
+		except (ValueError, IndexError):
+			return None
+	
+	# ------------------------------------------------------------------
+	# Check Whether a Buffered Command Already Took Effect
+	#	status: parsed status (see parseStatus); a speed can only be
+	#	confirmed while the pump runs
+	# ------------------------------------------------------------------
+	def commandConfirmed(self, command, status):
+		if status is None:
+			return False
+		flow_status, speed, direction, control = status[:4]
+		if command == 'KH':
+			return flow_status == 'Stopped'
+		if command in ('K<', 'K>'):
+			forward = (command == 'K<') == self.flip_flow_direction
+			return flow_status == 'Flowing' and direction == ('Forward' if forward else 'Reverse')
+		if command[0] == 'R':
+			return flow_status == 'Flowing' and abs(speed - int(command[1:]) / 100) < 0.01
+		if command in ('SR', 'SK'):
+			return control == ('Remote' if command == 'SR' else 'Keypad')
+		return False
+	
+	# ------------------------------------------------------------------
+	# Select Unit, retrying until it answers
+	#	Raises PumpTimeout after `timeout` s (default budget 'pump_select')
+	# ------------------------------------------------------------------
+	@recoverable
+	def waitForUnit(self, unitNumber, timeout = None):
+		deadline = Deadline(budget('pump_select', timeout), PumpTimeout,
+							'Pump unit ' + str(unitNumber) + ' select')
+		while not self.selectUnit(unitNumber):
+			deadline.sleep(1)
+	
+	# ------------------------------------------------------------------
+	# Exclusive use of a shared serial line for one transaction
+	# ------------------------------------------------------------------
+	def busTurn(self):
+		if self.bus is None:
+			return contextlib.nullcontext()
+		return self.bus.turn(self.pump_ID)
+	
 	# ------------------------------------------------------------------
 	# Send String
 	# ------------------------------------------------------------------
@@ -269,15 +515,15 @@ class APump():
 	# ------------------------------------------------------------------
 	def setFlowDirection(self, forward):
 		if self.flip_flow_direction:
-			if forward:
-				self.sendBuffered(self.pump_ID, 'K<')
-			else:
-				self.sendBuffered(self.pump_ID, 'K>')
+			command = 'K<' if forward else 'K>'
 		else:
-			if forward:
-				self.sendBuffered(self.pump_ID, 'K>')
-			else:
-				self.sendBuffered(self.pump_ID, 'K<')
+			command = 'K>' if forward else 'K<'
+		with self.lock:
+			self.mirror['running'] = None # unknown if the command fails
+			self.sendBuffered(self.pump_ID, command)
+			speed = self.mirror['speed'] # at speed 0 the pump turns on but does not pump
+			self.mirror['running'] = None if speed is None else speed > 0
+			self.mirror['direction'] = 'Forward' if forward else 'Reverse'
 	
 	# ------------------------------------------------------------------
 	# Set Pump Speed
@@ -285,7 +531,10 @@ class APump():
 	def setSpeed(self, rotation_speed):
 		if rotation_speed >= 0 and rotation_speed <= 48:
 			rotation_int = int(rotation_speed * 100)
-			self.sendBuffered(self.pump_ID, 'R' + ('%04d' % rotation_int))
+			with self.lock:
+				self.mirror['speed'] = None # unknown if the command fails
+				self.sendBuffered(self.pump_ID, 'R' + ('%04d' % rotation_int))
+				self.mirror['speed'] = rotation_int / 100
 			
 			# NOTE:
 			# '%04d' % rotation_int --> ensures input to Minipuls3
@@ -299,21 +548,158 @@ class APump():
 	
 	# ------------------------------------------------------------------
 	# Start Pump Flow
+	#	Only commands that change the mirrored state are sent: a restart
+	#	at the same speed is a single direction (run) command, and
+	#	nothing is sent if the pump already runs as requested
 	# ------------------------------------------------------------------
+	@traced('pump')
 	def startFlow(self, speed, direction = 'Forward'):
-		self.setSpeed(speed)
-		# self.speed = speed
+		with self.lock:
+			if (self.verify_interval is not None and (self.last_verified is None
+					or time.monotonic() - self.last_verified > self.verify_interval)):
+				self.verifyMirror()
+			if self.mirror['speed'] is None or abs(self.mirror['speed'] - int(speed * 100) / 100) >= 0.01:
+				self.setSpeed(speed)
+			else:
+				self.skipped_commands += 1
+			if self.mirror['running'] and self.mirror['direction'] == direction:
+				self.skipped_commands += 1
+			else:
+				self.resumeFlow(direction)
+			self.flow_status = 'Flowing' if speed > 0 else 'Stopped'
+			self.speed = speed
+			self.direction = direction
+	
+	# ------------------------------------------------------------------
+	# Start Pump Flow at the Speed Already Set (one command)
+	# ------------------------------------------------------------------
+	def resumeFlow(self, direction = 'Forward'):
 		self.setFlowDirection(direction == 'Forward')
 	
 	# ------------------------------------------------------------------
 	# Stop Pump Flow
+	#	Always sent, whatever the mirror says
 	# ------------------------------------------------------------------
+	@traced('pump')
 	def stopFlow(self):
-		self.sendBuffered(self.pump_ID, 'KH')
+		with self.lock:
+			self.mirror['running'] = None
+			self.sendBuffered(self.pump_ID, 'KH')
+			self.mirror['running'] = False
+			self.flow_status = 'Stopped'
 		return True
 	
 		# Changed from original, which just set speed to 0
-						
+
+# ----------------------------------------------------------------------
+# Gilson Bus Class Definition
+#	Several Minipuls3 units (unit numbers set on each pump) on one
+#	serial line. Every GSIOC transaction (select unit, command,
+#	disconnect) holds the line exclusively; units waiting for the line
+#	are served round-robin by unit number, so a unit that sends many
+#	commands (or is polled by telemetry) cannot starve the others.
+# ----------------------------------------------------------------------
+class GilsonBus():
+	def __init__(self, com_port = 'COM8', verbose = True, transport = None, trace_path = None):
+		self.com_port = com_port
+		self.verbose = verbose
+		
+		if transport is None: # reopened automatically if it fails
+			import serial # only needed to open a port
+			transport = ReconnectingTransport(lambda: serial.Serial(port = self.com_port,
+									  baudrate = 19200,
+									  parity = serial.PARITY_EVEN,
+									  bytesize = serial.EIGHTBITS,
+									  stopbits = serial.STOPBITS_TWO,
+									  timeout = 1), what = 'Gilson bus port ' + str(com_port))
+		if trace_path is not None: # record all serial traffic
+			from transport import RecordingTransport
+			transport = RecordingTransport(transport, trace_path)
+		self.serial = transport
+		
+		self.pumps = {} # unit number -> APump
+		self.condition = threading.Condition()
+		self.owner = None # unit holding the line
+		self.waiting = {} # unit number -> transactions waiting
+		self.last_unit = None # unit served last
+		self.transactions = {} # unit number -> transactions done
+	
+	# ------------------------------------------------------------------
+	# Add (and initialize) the pump with unit number `unit`
+	# ------------------------------------------------------------------
+	def addPump(self, unit):
+		pump = APump(com_port = self.com_port, verbose = self.verbose, bus = self, pump_ID = unit)
+		self.pumps[unit] = pump
+		return pump
+	
+	# ------------------------------------------------------------------
+	# Hold the line for one transaction of `unit` (context manager)
+	# ------------------------------------------------------------------
+	@contextlib.contextmanager
+	def turn(self, unit):
+		with self.condition:
+			self.waiting[unit] = self.waiting.get(unit, 0) + 1
+			while self.owner is not None or self.nextUnit() != unit:
+				self.condition.wait()
+			self.waiting[unit] -= 1
+			self.owner = unit
+		try:
+			yield
+		finally:
+			with self.condition:
+				self.owner = None
+				self.last_unit = unit
+				self.transactions[unit] = self.transactions.get(unit, 0) + 1
+				self.condition.notify_all()
+	
+	# ------------------------------------------------------------------
+	# Next unit to serve: first waiting unit after the last one served
+	# ------------------------------------------------------------------
+	def nextUnit(self):
+		units = sorted(unit for unit, count in self.waiting.items() if count > 0)
+		if not units:
+			return None
+		if self.last_unit is not None:
+			for unit in units:
+				if unit > self.last_unit:
+					return unit
+		return units[0]
+	
+	# ------------------------------------------------------------------
+	# Commanded state of every unit: {unit: (flow_status, speed, direction)}
+	# ------------------------------------------------------------------
+	def getStates(self):
+		return {unit: (pump.flow_status, pump.speed, pump.direction)
+				for unit, pump in self.pumps.items()}
+	
+	# ------------------------------------------------------------------
+	# Start several units: {unit: (speed, direction)}
+	#	The commands are interleaved with the other units' traffic, so
+	#	the pumps start within a few transactions of each other
+	# ------------------------------------------------------------------
+	def startFlows(self, flows):
+		threads = [threading.Thread(target=self.pumps[unit].startFlow, args=(speed, direction))
+				   for unit, (speed, direction) in flows.items()]
+		for thread in threads:
+			thread.start()
+		for thread in threads:
+			thread.join()
+	
+	# ------------------------------------------------------------------
+	# Stop all units
+	# ------------------------------------------------------------------
+	def stopAll(self):
+		for pump in self.pumps.values():
+			pump.stopFlow()
+	
+	# ------------------------------------------------------------------
+	# Return all units to keypad control and close the serial line
+	# ------------------------------------------------------------------
+	def close(self):
+		for pump in self.pumps.values():
+			pump.closeRemote()
+		self.serial.close()
+
 # -----------------------------------------------------------------------
 # Test/Demo of Class
 # -----------------------------------------------------------------------
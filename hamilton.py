@@ -11,29 +11,137 @@
 # -------------------------------------------------------------------
 # Import
 # -------------------------------------------------------------------
+import collections
 import sys
 import time
 
+from deadline import Deadline, DeviceTimeout, budget, recoverable
+from tracing import traced
+from transport import Reconnected, ReconnectingTransport
+
+# -------------------------------------------------------------------
+# Valve did not finish a wait within its budget (see deadline.py)
+# -------------------------------------------------------------------
+class ValveTimeout(DeviceTimeout):
+	pass
+
+# -------------------------------------------------------------------
+# Codec: command frames and response tables
+#	Replies are (value, ok, raw response); a whole-chain status is one
+#	ValveStatus (port 0-7, done moving, overloaded) per valve
+# -------------------------------------------------------------------
+acknowledge = '\x06'
+negative_acknowledge = '\x21'
+carriage_return = '\r'
+
+port_replies = {str(port): port - 1 for port in range(1, 9)} # '1' -> 0 (was 'Port 1', etc.)
+yes_no_replies = {'*' : False,
+				  'N' : False,
+				  'Y' : True}
+configuration_replies = {'2' : '8 ports',
+						 '3' : '6 ports',
+						 '4' : '3 ports',
+						 '5' : '2 ports @180',
+						 '6' : '2 ports @90',
+						 '7' : '4 ports'}
+ports_per_configuration = {'8 ports' : 8,
+						   '6 ports' : 6,
+						   '3 ports' : 3,
+						   '2 ports @180' : 2,
+						   '2 ports @90' : 2,
+						   '4 ports' : 4}
+
+# Queries: kind -> (message, response table, default = not understood)
+queries = {'position': ('LQP\r', port_replies, 'Unknown Port'),
+		   'moving': ('F\r', yes_no_replies, 'Unknown response'),
+		   'overload': ('G\r', yes_no_replies, 'Unknown response'),
+		   'configuration': ('LQT\r', configuration_replies, 'Unknown response'),
+		   'initialize': ('LXR\r', {}, '')}
+
+Reply = collections.namedtuple('Reply', ['value', 'ok', 'raw'])
+ValveStatus = collections.namedtuple('ValveStatus', ['port', 'done_moving', 'overloaded'])
+
+class MVPCodec():
+	def __init__(self, valve_names, max_ports = 8):
+		# Every query and move frame of every valve, encoded once
+		self.frames = {}
+		for valve_ID, valve_name in enumerate(valve_names):
+			for message, table, default in queries.values():
+				self.frames[(valve_ID, message)] = (valve_name + message).encode()
+			for direction in (0, 1):
+				for port_ID in range(1, max_ports + 1):
+					message = 'LP' + str(direction) + str(port_ID) + 'R\r'
+					self.frames[(valve_ID, message)] = (valve_name + message).encode()
+		self.valve_names = valve_names
+	
+	# ------------------------------------------------------------------
+	# Frame of `message` for a valve
+	# ------------------------------------------------------------------
+	def encode(self, valve_ID, message):
+		frame = self.frames.get((valve_ID, message))
+		if frame is None:
+			frame = (self.valve_names[valve_ID] + message).encode()
+		return frame
+	
+	# ------------------------------------------------------------------
+	# Decode one reply (see HamiltonMVP.inquireAndRespond)
+	#	default: value of a reply not in `dictionary`; if empty, a
+	#		plain acknowledge is success
+	# ------------------------------------------------------------------
+	def decode(self, response, dictionary, default):
+		if not response:
+			return Reply('No response', False, response)
+		if response[0] == negative_acknowledge:
+			return Reply('Negative Acknowledge', False, response)
+		if response[0] == acknowledge and default:
+			value = dictionary.get(response[1:-1], default)
+			return Reply(value, value != default, response)
+		return Reply('Acknowledge', True, response)
+	
+	def decodeQuery(self, kind, response):
+		message, dictionary, default = queries[kind]
+		return self.decode(response, dictionary, default)
+	
+	# ------------------------------------------------------------------
+	# Split a burst of replies (each ends with a carriage return; a
+	#	negative acknowledge may come without one)
+	# ------------------------------------------------------------------
+	def split(self, response):
+		replies = []
+		for part in response.split(carriage_return)[:-1]:
+			while part[:1] == negative_acknowledge and len(part) > 1:
+				replies.append(negative_acknowledge)
+				part = part[1:]
+			replies.append(part + carriage_return)
+		return replies
+
 # -------------------------------------------------------------------
 # Hamilton MVP Class Definition
 # -------------------------------------------------------------------
 
 class HamiltonMVP():
 	
-	def __init__(self, com_port = 'COM11', verbose = False):
+	def __init__(self, com_port = 'COM11', verbose = False, max_valves = 16,
+				 transport = None, trace_path = None):
 		
 		# Define attributes
 		self.com_port = com_port
 		self.verbose = verbose
 		
-		# Create serial port
-		import serial # why is this imported here?
-		self.serial = serial.Serial(port = self.com_port,
-									baudrate = 9600,
-									parity = serial.PARITY_ODD,
-									bytesize = serial.SEVENBITS,
-									stopbits = serial.STOPBITS_ONE,
-									timeout = 1)
+		# Create serial port (unless a transport, e.g. a trace replay, is given),
+		#	reopened automatically if it fails (see recoverConnection)
+		if transport is None:
+			import serial # why is this imported here?
+			transport = ReconnectingTransport(lambda: serial.Serial(port = self.com_port,
+									  baudrate = 9600,
+									  parity = serial.PARITY_ODD,
+									  bytesize = serial.SEVENBITS,
+									  stopbits = serial.STOPBITS_ONE,
+									  timeout = 1), what = 'Hamilton MVP port ' + str(com_port))
+		if trace_path is not None: # record all serial traffic
+			from transport import RecordingTransport
+			transport = RecordingTransport(transport, trace_path)
+		self.serial = transport
 		
 		# Define important serial characters:
 		self.acknowledge = '\x06'
@@ -46,23 +154,25 @@ class HamiltonMVP():
 			# to ascii addresses )(0 = a, 1 = b, etc.)
 		
 		# Define/initialize valve and port properties
-		# self.max_valves = 16
-		self.max_valves = 2 # we only will have 3 valves, so try to
-			# eliminate confusion (and save time initializing) by
-			# setting max valves to 3 instead of entire capacity of 16
+		# Up to 16 valves (addresses a-p) on one daisy chain; discovery
+		#	probes all addresses in one burst, so a smaller max_valves
+		#	no longer saves time initializing
+		self.max_valves = max_valves
 		self.valve_names = []
+		self.codec = MVPCodec([])
 		self.num_valves = 0
 		self.valve_configs = []
-		self.max_ports_per_valve = [8, 8]
+		self.max_ports_per_valve = []
 		self.current_port = []
 		
 		# Configure device
-		self.autoAddress()
+		self.repeatAfterReconnect(self.autoAddress)
 		self.autoDetectValves()
 		
 	# -------------------------------------------------------------------
 	# Define Device Addresses (Auto-Address):
 	#	Must be first command issued
+	#	(see repeatAfterReconnect if the port may be reopened)
 	# -------------------------------------------------------------------
 	def autoAddress(self):
 		auto_address_cmd = '1a\r'
@@ -75,6 +185,9 @@ class HamiltonMVP():
 	
 	# -------------------------------------------------------------------
 	# Auto Detect and Configure Valves:
+	#	Auto-addressing numbers the chain without gaps, so all addresses
+	#	are initialized in one burst and the valves found are the
+	#	replies before the first missing one (see probeValveConfigurations)
 	# -------------------------------------------------------------------
 	def autoDetectValves(self):
 		
@@ -82,35 +195,19 @@ class HamiltonMVP():
 			print('Opening the Hamilton MVP Valve Daisy Chain')
 			print('   ' + 'Com Port: ' + str(self.com_port))
 		
-		for valve_ID in range(self.max_valves): # loop over all possible valves
-			
-			# Generate address character (0 = a, 1 = b, etc.)
-			device_address_character = chr(valve_ID + self.char_offset)
-			
-			# Populate "valve_names" with potential valve names (ascii)
-			self.valve_names.append(device_address_character)
-			
-			# Attempt to initialize valve:
-			found_valve = self.initializeValve(valve_ID)
-			# found_valve = ('Acknoledge', True, '\x06\r')
-			
-			if found_valve[1]: # if initialization completed successfully
-				valve_config = self.howIsValveConfigured(valve_ID)
-				print(f"valve_config: {valve_config}")
-				if valve_config[1]: # successful response
-					self.valve_configs.append(valve_config[0]) # CHECK
-					self.max_ports_per_valve.append(self.numPortsPerConfiguration(valve_config[0])) # CHECK
-					self.current_port.append(valve_config[0]) # CHECK
-					
-					if self.verbose:
-						print('Found ' + valve_config[0] + ' device at valve_id ' +
-							str(valve_ID))
-				
-			else:
-				if self.verbose:
-					print('not found_valve[1] -- not successful initizliation')
-					print('found_valve output: ' + str(found_valve))
-				break
+		# Generate address characters (0 = a, 1 = b, etc.)
+		self.valve_names = [chr(valve_ID + self.char_offset) for valve_ID in range(self.max_valves)]
+		self.codec = MVPCodec(self.valve_names)
+		
+		found_configs = self.repeatAfterReconnect(self.probeValveConfigurations,
+			before_repeat = self.autoAddress) # chain may have been power cycled
+		for valve_ID, valve_config in enumerate(found_configs):
+			print(f"valve_config: {valve_config}")
+			self.valve_configs.append(valve_config)
+			self.max_ports_per_valve.append(self.numPortsPerConfiguration(valve_config))
+			self.current_port.append(None) # unknown until initialized
+			if self.verbose:
+				print('Found ' + valve_config + ' device at valve_id ' + str(valve_ID))
 
 		# Set number of valves of current configuration
 		self.num_valves = len(self.valve_configs)
@@ -123,21 +220,46 @@ class HamiltonMVP():
 			print('Error: no valves discovered')
 			return False # return failure
 		
+		# Valves were initialized by the probe, wait for all of them
+		for valve_ID in range(self.num_valves):
+			self.waitUntilNotMoving(valve_ID)
+			location = self.whereIsValve(valve_ID)
+			if location[1]:
+				self.current_port[valve_ID] = location[0] + 1 # whereIsValve counts from 0
+		
 		# Display found values
 		print('Found ' + str(self.num_valves) + ' Hamilton MVP Valves')
 		for valve_ID in range(self.num_valves):
 			print('   ' + 'Device ' + self.valve_names[valve_ID] + 
 				' is configured with ' + self.valve_configs[valve_ID])
 		
-		self.waitUntilNotMoving(self.num_valves-1)
-		
 		print('Initialized Valves')
 		
 		return True	
 	
+	# -------------------------------------------------------------------
+	# Change Ports of Several Valves
+	#	route: [(valve_ID, port_ID), ...], e.g. from a routing table
+	#	Valves already at their port are not moved; the others are moved
+	#	together and then waited for
+	# -------------------------------------------------------------------
+	def changePorts(self, route, wait_until_done = True):
+		moved = []
+		for valve_ID, port_ID in route:
+			if self.isValidValve(valve_ID) and self.current_port[valve_ID] == port_ID:
+				continue
+			if not self.changePort(valve_ID, port_ID, wait_until_done = False):
+				return False
+			moved.append(valve_ID)
+		if wait_until_done:
+			for valve_ID in moved:
+				self.waitUntilNotMoving(valve_ID, pause_time = 1)
+		return True
+	
 	# -------------------------------------------------------------------
 	# Change Port Position
 	# -------------------------------------------------------------------
+	@traced('valve')
 	def changePort(self, valve_ID, port_ID, direction = 0, wait_until_done = True):
 
 		print(f">>> changing {valve_ID} valve's port to {port_ID}")
@@ -156,7 +278,8 @@ class HamiltonMVP():
 		message = 'LP' + str(direction) + str(port_ID) + 'R\r'
 		
 		# Get response - acknowledge/negative acknowledge
-		response = self.inquireAndRespond(valve_ID, message)
+		#	(empty default: a plain acknowledge counts as success)
+		response = self.inquireAndRespond(valve_ID, message, dictionary = {}, default = '')
 		
 		if response[0] == 'Negative Acknowledge':
 			print('Move failed: ' + str(response))
@@ -246,19 +369,53 @@ class HamiltonMVP():
 		# Generate labels: 0 = clockwise, 1 = counter-clockwise
 		return ('Clockwise', 'Counter Clockwise')
 	
+	# -------------------------------------------------------------------
+	# Get Status of Several Valves in One Burst
+	#	Position, movement and overload queries of all valves are
+	#	written at once and the replies read back together
+	#	Returns [ValveStatus(port, done_moving, overloaded), ...] in the
+	#	order of valve_IDs (default: all valves); a value that did not
+	#	decode is the table default (e.g. 'Unknown Port')
+	# -------------------------------------------------------------------
+	@traced('serial')
+	def getChainStatus(self, valve_IDs = None):
+		if valve_IDs is None:
+			valve_IDs = range(self.num_valves)
+		valve_IDs = [valve_ID for valve_ID in valve_IDs if self.isValidValve(valve_ID)]
+		kinds = ('position', 'moving', 'overload')
+		requests = [(valve_ID, kind) for valve_ID in valve_IDs for kind in kinds]
+		if not requests:
+			return []
+		frame = b''.join(self.codec.encode(valve_ID, queries[kind][0]) for valve_ID, kind in requests)
+		try:
+			self.writeFrame(frame)
+			replies = self.readReplies(len(requests))
+		except Reconnected: # queries only, safe to send again
+			self.recoverConnection()
+			self.writeFrame(frame)
+			replies = self.readReplies(len(requests))
+		replies += [''] * (len(requests) - len(replies)) # missing replies
+		
+		chain_status = []
+		for i in range(len(valve_IDs)):
+			chain_status.append(ValveStatus(*(self.codec.decodeQuery(kind, replies[3*i + j]).value
+				for j, kind in enumerate(kinds))))
+		return chain_status
+	
 	# -------------------------------------------------------------------
 	# Get Valve Staus
 	#	NOTE: Modified from original
+	#	(one burst, see getChainStatus)
 	# -------------------------------------------------------------------
 	def getStatus(self, valve_ID):
-		valveLocation = self.whereIsValve(valve_ID)
-		doneMoving = self.isMovementFinished(valve_ID)
-		overloadStatus = self.isValveOverloaded(valve_ID)
+		if not self.isValidValve(valve_ID):
+			return ValveStatus('Unknown Port', 'Unknown response', 'Unknown response')
+		valve_status = self.getChainStatus([valve_ID])[0]
 		if self.verbose:
-			print('Valve location: ' + str(valveLocation))
-			print('Done moving? ' + str(doneMoving))
-			print('Is valve overloaded? ' + str(overloadStatus))
-		return (valveLocation[0], doneMoving[0], overloadStatus[0])
+			print('Valve location: ' + str(valve_status.port))
+			print('Done moving? ' + str(valve_status.done_moving))
+			print('Is valve overloaded? ' + str(valve_status.overloaded))
+		return valve_status
 		# original code:
 		# return (self.whereIsValve(valve_ID), not self.isMovementFinished(valve_(D))
 		
@@ -269,16 +426,7 @@ class HamiltonMVP():
 	# Check Valve Configuration
 	# -------------------------------------------------------------------
 	def howIsValveConfigured(self, valve_ID):
-		response = self.inquireAndRespond(valve_ID,
-								message = 'LQT\r',
-								dictionary = {'2' : '8 ports',
-											  '3' : '6 ports',
-											  '4' : '3 ports',
-											  '5' : '2 ports @180',
-											  '6' : '2 ports @90',
-											  '7' : '4 ports'},
-								default = 'Unknown response')
-		return response
+		return self.query(valve_ID, 'configuration')
 		# response format: ('8 ports', True, messageTo_inquireAndRespond)
 			# original code returned response[0] but that makes no sense
 		
@@ -293,59 +441,33 @@ class HamiltonMVP():
 	# Initialize Port Position of Given Valve
 	# -------------------------------------------------------------------
 	def initializeValve(self, valve_ID):
-		response = self.inquireAndRespond(valve_ID,
-								message = 'LXR\r',
-								dictionary = {},
-								default = '')
+		return self.query(valve_ID, 'initialize')
 			# response format: ('Acknowledge', True, messageTo_inquireAndRespond)
-		return response
 
 	# -------------------------------------------------------------------
 	# Basic I/O with Serial Port
 	#	This function returns a response tuple used by this class
 	#	(dictionary entry, affirmative response?, raw response string)
 	# -------------------------------------------------------------------
+	@traced('serial')
 	def inquireAndRespond(self, valve_ID, message, dictionary={}, default="unknown"):
 		
 		# Check if the valve_ID valve is initialized:
 		if not self.isValidValve(valve_ID):
 			print ('isValidValve check failed on valve ' + str(valve_ID))
-			return ('', False, '')
-		
-		# Prepend address of provided valve (0 = a, 1 = b, etc.)
-		message = self.valve_names[valve_ID] + message
-		
-		# Write message and read response
-		self.writeToSerialPort(message)
-		response = self.readSerialPort()
-						
-		# Parse response into sent message and response
-		# messageStart = response.find(message)
-		# messageStop = messageStart + len(message)
-		# messageRepeat = response[messageStart:messageStop]
-		
-		# Parse out actual response from valve, without final carriage return
-		responseStart = response[0]
-		actualResponse = response[1:-1]
-		# print(ascii(actualResponse))
-
-		return_tuple = ["Acknowledge", True]
-
-		if responseStart == self.acknowledge:
-			return_value = dictionary.get(actualResponse, default)
-			if default:
-				if return_value == default:
-					return_tuple[0] = default
-					return_tuple[1] = False
-				# elif return_value:
-				else:
-					return_tuple[0] = return_value
-
-		if responseStart == self.negative_acknowledge:
-			return_tuple[0] = "Negative Acknowledge"
-			return_tuple[1] = False
-
-		return (return_tuple[0], return_tuple[1], response)
+			return Reply('', False, '')
+		
+		# Write the (pre-encoded) frame and decode the response
+		frame = self.codec.encode(valve_ID, message)
+		try:
+			self.writeFrame(frame)
+			return self.codec.decode(self.readSerialPort(), dictionary, default)
+		except Reconnected:
+			self.recoverConnection()
+			if message.startswith('LP') and self.current_port[valve_ID] == int(message[3:-2]):
+				return Reply('Acknowledge', True, '') # moved before the port failed
+			self.writeFrame(frame) # replay
+			return self.codec.decode(self.readSerialPort(), dictionary, default)
 
 		# # Check for Negative Acknowledge:
 		# if responseStart == self.negative_acknowledge:
@@ -368,13 +490,7 @@ class HamiltonMVP():
 	# Poll Movement of Valve
 	# -------------------------------------------------------------------
 	def isMovementFinished(self, valve_ID):
-		response = self.inquireAndRespond(valve_ID,
-								message = 'F\r',
-								dictionary = {'*' : False,
-											  'N' : False,
-											  'Y' : True},
-								default = 'Unknown response')
-		return response
+		return self.query(valve_ID, 'moving')
 		
 	# -------------------------------------------------------------------
 	# Check if Port is Valid
@@ -398,9 +514,11 @@ class HamiltonMVP():
 		
 	# -------------------------------------------------------------------
 	# Check if Valve is Valid
+	#	Only valves found on the chain (not max_valves, the addresses
+	#	that are probed)
 	# -------------------------------------------------------------------
 	def isValidValve(self, valve_ID):
-		if not (valve_ID < self.max_valves):
+		if not (0 <= valve_ID < self.num_valves):
 			if self.verbose:
 				print(str(valve_ID) + ' is not a valid valve')
 			return False
@@ -414,12 +532,7 @@ class HamiltonMVP():
 	#	NOTE: Not called in any other HamiltonMVP class functions
 	# -------------------------------------------------------------------
 	def isValveOverloaded(self, valve_ID):
-		return self.inquireAndRespond(valve_ID,
-							message = 'G\r',
-							dictionary = {'*' : False,
-										  'N' : False,
-										  'Y' : True},
-							default = 'Unknown response')
+		return self.query(valve_ID, 'overload')
 		# if overloaded: (True, True, messageTo_inquireAndRespond)
 	
 	# -------------------------------------------------------------------
@@ -427,13 +540,66 @@ class HamiltonMVP():
 	#	e.g. '8 ports' --> 8 (output from howIsValveConfigured)
 	# -------------------------------------------------------------------
 	def numPortsPerConfiguration(self, configuration_string):
-		return {'8 ports' : 8,
-				'6 ports' : 6,
-				'3 ports' : 3,
-				'2 ports @180' : 2,
-				'2 ports @90' : 2,
-				'4 ports' : 4}.get(configuration_string)
-		
+		return ports_per_configuration.get(configuration_string)
+		
+	# -------------------------------------------------------------------
+	# Initialize All Possible Valves, then Query the Found Ones
+	#	A valve must be initialized (LXR) before it is queried, so all
+	#	addresses get LXR in one burst; the valves found are the leading
+	#	acknowledges. Their configurations (LQT) are read in a second burst
+	#	Returns the configurations ('8 ports', ...) of the valves found,
+	#	in address order
+	# -------------------------------------------------------------------
+	def probeValveConfigurations(self):
+		self.writeFrame(b''.join(self.codec.encode(valve_ID, queries['initialize'][0])
+			for valve_ID in range(len(self.valve_names))))
+		response = ''
+		while True: # read until the replies stop
+			chunk = self.readSerialPort()
+			if not chunk:
+				break
+			response += chunk
+		acknowledges = response[:len(response) - len(response.lstrip(self.acknowledge + self.carriage_return))]
+		num_found = acknowledges.count(self.acknowledge)
+		if num_found == 0:
+			return []
+		
+		self.writeFrame(b''.join(self.codec.encode(valve_ID, queries['configuration'][0])
+			for valve_ID in range(num_found)))
+		found_configs = []
+		for reply in self.readReplies(num_found):
+			configuration = self.codec.decodeQuery('configuration', reply)
+			if not configuration.ok:
+				break
+			found_configs.append(configuration.value)
+		return found_configs
+	
+	# -------------------------------------------------------------------
+	# Read the Positions of All Valves in One Burst
+	#	Returns [Reply, ...] (value: port 0-7), no recovery if the port
+	#	is reopened (see recoverConnection)
+	# -------------------------------------------------------------------
+	def readPositions(self):
+		self.writeFrame(b''.join(self.codec.encode(valve_ID, queries['position'][0])
+			for valve_ID in range(self.num_valves)))
+		replies = self.readReplies(self.num_valves)
+		replies += [''] * (self.num_valves - len(replies)) # missing replies
+		return [self.codec.decodeQuery('position', reply) for reply in replies]
+	
+	# -------------------------------------------------------------------
+	# Read `count` Replies of a Burst (fewer if the port goes quiet)
+	# -------------------------------------------------------------------
+	def readReplies(self, count):
+		response = ''
+		replies = []
+		while len(replies) < count:
+			chunk = self.readSerialPort()
+			if not chunk:
+				break
+			response += chunk
+			replies = self.codec.split(response)
+		return replies
+	
 	# -------------------------------------------------------------------
 	# Read from Serial Port
 	# -------------------------------------------------------------------
@@ -445,6 +611,41 @@ class HamiltonMVP():
 			print(f'Received response: {ascii(response)}')
 		return response
 	
+	# -------------------------------------------------------------------
+	# Recover After the Serial Port Was Reopened
+	#	Valve positions are read back (LQP), readdressing the chain
+	#	first if the valves stopped answering
+	# -------------------------------------------------------------------
+	def recoverConnection(self):
+		print('Hamilton MVP port reopened, checking valve positions')
+		def checkPositions():
+			locations = self.readPositions()
+			if not all(location.ok for location in locations):
+				self.autoAddress() # chain may have been power cycled
+				locations = self.readPositions()
+			return locations
+		locations = self.repeatAfterReconnect(checkPositions)
+		for valve_ID, location in enumerate(locations):
+			self.current_port[valve_ID] = location[0] + 1 if location[1] else None
+		return self.current_port
+	
+	# -------------------------------------------------------------------
+	# Run a Step of the Chain Setup, Again if the Port Was Reopened
+	#	The port is reopened by ReconnectingTransport, which raises
+	#	Reconnected; the step is repeated (after before_repeat(), e.g.
+	#	readdressing the chain) up to `attempts` times in all
+	# -------------------------------------------------------------------
+	def repeatAfterReconnect(self, step, before_repeat = None, attempts = 3):
+		for attempt in range(attempts):
+			try:
+				if attempt > 0 and before_repeat is not None:
+					before_repeat()
+				return step()
+			except Reconnected:
+				if attempt == attempts - 1:
+					raise
+				print('Hamilton MVP port reopened, repeating ' + step.__name__)
+	
 	# -------------------------------------------------------------------
 	# Reset Chain: Readdress and redetect valves
 	#	NOTE: Not called in any other HamiltonMVP class functions
@@ -453,23 +654,31 @@ class HamiltonMVP():
 		
 		# Reset device configuration:
 		self.valve_names = []
+		self.codec = MVPCodec([])
 		self.num_valves = 0
 		self.valve_configs = []
 		self.max_ports_per_valve = []
+		self.current_port = []
 		
 		# Configure device
-		self.autoAddress()
+		self.repeatAfterReconnect(self.autoAddress)
 		self.autoDetectValves()
 	
 	# -------------------------------------------------------------------
 	# Halt Hamilton Class Until Movement is Finished
-	# -------------------------------------------------------------------
-	def waitUntilNotMoving(self, valve_ID, pause_time = 1):
+	#	Raises ValveTimeout after `timeout` s (default budget
+	#	'valve_move'); unknown responses count as still moving
+	# -------------------------------------------------------------------
+	@traced('valve_wait')
+	@recoverable
+	def waitUntilNotMoving(self, valve_ID, pause_time = 1, timeout = None):
+		deadline = Deadline(budget('valve_move', timeout), ValveTimeout,
+							'Valve ' + str(valve_ID) + ' movement')
 		doneMoving = False
 		while not doneMoving:
 			moveStatus = self.isMovementFinished(valve_ID)
-			doneMoving = moveStatus[0] # will be "True" if stopped
-			time.sleep(pause_time)
+			doneMoving = moveStatus[0] is True # "True" only if stopped
+			deadline.sleep(pause_time)
 												
 	# -------------------------------------------------------------------
 	# Poll Valve Configuration
@@ -486,28 +695,26 @@ class HamiltonMVP():
 	#	(Modified from original)
 	# -------------------------------------------------------------------
 	def whereIsValve(self, valve_ID):
-		response = self.inquireAndRespond(valve_ID,
-								message = 'LQP\r',
-								dictionary = {'1' : 0, # was : 'Port 1' (etc.)
-											  '2' : 1, 
-											  '3' : 2, 
-											  '4' : 3, 
-											  '5' : 4, 
-											  '6' : 5,
-											  '7' : 6, 
-											  '8' : 7},
-								default = 'Unknown Port')
-		return response
+		return self.query(valve_ID, 'position')
 			# returns, e.g. (0, True, messageTo_inquireAndRespond)
+	
+	# -------------------------------------------------------------------
+	# Send One Query (kind from `queries`, e.g. 'position')
+	# -------------------------------------------------------------------
+	def query(self, valve_ID, kind):
+		message, dictionary, default = queries[kind]
+		return self.inquireAndRespond(valve_ID, message, dictionary, default)
 							
 	# -------------------------------------------------------------------
 	# Write to Serial Port
 	# -------------------------------------------------------------------
 	def writeToSerialPort(self, message):
-		self.serial.write(message.encode())
-		# print(message.encode())
+		self.writeFrame(message.encode())
+	
+	def writeFrame(self, frame):
+		self.serial.write(frame)
 		if self.verbose:
-			print('Wrote: ' + message) # display all but final CR
+			print('Wrote: ' + frame.decode()) # display all but final CR
 	
 # -----------------------------------------------------------------------
 # Test/Demo of Class
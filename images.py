@@ -0,0 +1,100 @@
+# # !/usr/bin/env python3
+
+# -------------------------------------------------------------------
+# Helpers for reading the images Fusion writes during a run
+#	Only the parts needed by the online QC stages (drift, ...) are
+#	read, so a round can be checked while the fluidics keep going
+# -------------------------------------------------------------------
+
+# -------------------------------------------------------------------
+# Import
+# -------------------------------------------------------------------
+import contextlib
+import glob
+import os
+import re
+
+import numpy as np
+
+# Fusion appends the field (position) index as _F<n> to multi-position files
+position_pattern = re.compile(r'_F(\d+)')
+
+# -------------------------------------------------------------------
+# Find images of one acquisition
+#	Returns {position: path} for files matching `pattern` that were
+#	written after `since` (time.time() when imaging started) and, if
+#	given, not after `until` (when it finished), so a late check does
+#	not pick up files of the next acquisition
+# -------------------------------------------------------------------
+def find_images(pattern, since=0, until=None):
+	images = {}
+	for path in glob.glob(pattern):
+		modified = os.path.getmtime(path)
+		if modified < since or (until is not None and modified > until):
+			continue
+		match = position_pattern.search(os.path.basename(path))
+		position = int(match.group(1)) if match else 0
+		# keep the newest file if a position was written more than once
+		if position not in images or modified > os.path.getmtime(images[position]):
+			images[position] = path
+	return images
+
+# -------------------------------------------------------------------
+# Open one channel of an image as a (z, y, x) array without reading it
+#	(context manager, the file is closed on exit, so only use the
+#	stack inside the with block)
+#	.ims: HDF5 dataset (read lazily by h5py), resolution_level > 0
+#		uses the pyramid Imaris already stores (cheap downsampling)
+#	.tif: memory-mapped through tifffile (uncompressed files only)
+#	.npy: memory-mapped by numpy
+# -------------------------------------------------------------------
+@contextlib.contextmanager
+def open_stack(path, channel=0, resolution_level=0):
+	extension = os.path.splitext(path)[1].lower()
+	if extension == '.ims':
+		import h5py # only needed for Imaris files
+		with h5py.File(path, 'r') as ims:
+			yield ims['DataSet/ResolutionLevel %d/TimePoint 0/Channel %d/Data' % (resolution_level, channel)]
+		return
+	if extension in ('.tif', '.tiff'):
+		import tifffile # only needed for tiff files
+		mapped = tifffile.memmap(path, mode='r')
+	elif extension == '.npy':
+		mapped = np.load(path, mmap_mode='r')
+	else:
+		raise ValueError('Unsupported image file: ' + path)
+	try:
+		# (c, z, y, x) or (z, y, x)
+		stack = mapped
+		if stack.ndim == 4:
+			stack = stack[channel]
+		elif stack.ndim == 2:
+			stack = stack[np.newaxis]
+		yield stack
+	finally:
+		if getattr(mapped, '_mmap', None) is not None: # do not wait for garbage collection to release the file
+			mapped._mmap.close()
+
+# -------------------------------------------------------------------
+# Maximum projection of one channel along z, as float32 (in memory,
+#	the file is closed again)
+# -------------------------------------------------------------------
+def load_projection(path, channel=0, resolution_level=0):
+	with open_stack(path, channel, resolution_level) as stack:
+		projection = np.array(stack[0], dtype=np.float32) # copy, never a view of the file
+		for z in range(1, stack.shape[0]): # plane by plane to keep memory low
+			np.maximum(projection, stack[z], out=projection)
+	return projection
+
+# -------------------------------------------------------------------
+# Signal over background of an image: ratio of the given intensity
+#	percentile to the median, highest over the given channels
+#	(~1 for an empty field, large when spots are left)
+# -------------------------------------------------------------------
+def signal_ratio(path, channels, percentile=99.9, resolution_level=0):
+	ratios = []
+	for channel in channels:
+		projection = load_projection(path, channel, resolution_level)
+		background = float(np.median(projection)) + 1e-6
+		ratios.append(float(np.percentile(projection, percentile)) / background)
+	return max(ratios)
@@ -0,0 +1,172 @@
+# # !/usr/bin/env python3
+
+# -------------------------------------------------------------------
+# Persistent job queue
+#	Experiments and maintenance programs (sequencing, cleaning, line
+#	priming, ...) queued to run back to back without anyone at the
+#	rig. Each job is one JSON file in the queue directory, named by
+#	its position, so jobs can be added (by hand or with
+#	`python jobs.py add`) while the queue runs; the runner only
+#	rewrites the file of the job it is running. A job's state moves
+#	queued -> running -> done | failed, and every transition is
+#	written to the queue journal.
+#
+#	A job found 'running' when the queue starts was interrupted and is
+#	run again first (sequencing resumes from its plan checkpoint,
+#	cleaning from its state file). By default a failed job stops the
+#	queue, since the jobs after it expect the rig in a known state.
+#
+#	python jobs.py add <queue_dir> <kind> [name=value ...]
+#	python jobs.py list <queue_dir>
+#	python jobs.py retry <queue_dir> <job_id>
+# -------------------------------------------------------------------
+
+# -------------------------------------------------------------------
+# Import
+# -------------------------------------------------------------------
+import glob
+import json
+import os
+import sys
+import time
+
+from journal import RunJournal
+from jsonfile import save_json
+
+# -------------------------------------------------------------------
+# Job Queue Class Definition
+# -------------------------------------------------------------------
+class JobQueue():
+	def __init__(self, path):
+		self.path = path
+		os.makedirs(path, exist_ok=True)
+		self.journal = None
+
+	def jobPath(self, job_id):
+		return os.path.join(self.path, job_id + '.json')
+
+	# ------------------------------------------------------------------
+	# All jobs in queue order
+	# ------------------------------------------------------------------
+	def jobs(self):
+		jobs = []
+		for path in sorted(glob.glob(os.path.join(self.path, '*.json'))):
+			try:
+				with open(path) as job_file:
+					jobs.append(json.load(job_file))
+			except ValueError: # being written by another process
+				continue
+		return jobs
+
+	# ------------------------------------------------------------------
+	# Add a job at the end of the queue, returns it
+	# ------------------------------------------------------------------
+	def add(self, kind, **args):
+		jobs = self.jobs()
+		number = max([int(job['id'].split('_')[0]) for job in jobs] + [0]) + 1
+		job = {'id': '%04d_%s' % (number, kind), 'kind': kind, 'args': args, 'state': 'queued',
+			   'added': time.time(), 'attempts': 0}
+		save_json(job, self.jobPath(job['id']))
+		return job
+
+	# ------------------------------------------------------------------
+	# Change the state of a job (and journal it)
+	# ------------------------------------------------------------------
+	def update(self, job, state, **fields):
+		job['state'] = state
+		job.update(fields)
+		save_json(job, self.jobPath(job['id']))
+		if self.journal is not None:
+			self.journal.record('job_' + state, job=job['id'], kind=job['kind'], **fields)
+
+	# ------------------------------------------------------------------
+	# Next job to run: an interrupted one, else the first queued one
+	# ------------------------------------------------------------------
+	def nextJob(self):
+		jobs = self.jobs()
+		for state in ('running', 'queued'):
+			for job in jobs:
+				if job['state'] == state:
+					return job
+		return None
+
+	# ------------------------------------------------------------------
+	# Put a failed job back in the queue
+	# ------------------------------------------------------------------
+	def retry(self, job_id):
+		with open(self.jobPath(job_id)) as job_file:
+			job = json.load(job_file)
+		self.update(job, 'queued')
+		return job
+
+	# ------------------------------------------------------------------
+	# Run jobs in order until the queue is empty
+	#	run_job(job, interrupted) runs one job; a return value of False
+	#		or an exception fails it
+	#	poll_interval: s between looks for new jobs once the queue is
+	#		empty, None to return instead
+	#	Returns the jobs run
+	# ------------------------------------------------------------------
+	def run(self, run_job, stop_on_failure=True, poll_interval=None):
+		self.journal = RunJournal(os.path.join(self.path, 'queue.jsonl'))
+		finished = []
+		try:
+			while True:
+				job = self.nextJob()
+				if job is None:
+					if poll_interval is None:
+						break
+					time.sleep(poll_interval)
+					continue
+
+				interrupted = job['state'] == 'running'
+				self.update(job, 'running', started=time.time(), attempts=job.get('attempts', 0) + 1,
+					interrupted=interrupted)
+				print(f">>>>> Job {job['id']} started" + (' (resumed)' if interrupted else ''))
+				try:
+					result = run_job(job, interrupted)
+					error = None if result is not False else 'job returned False'
+				except Exception as ex:
+					error = type(ex).__name__ + ': ' + str(ex)
+				finished.append(job)
+
+				if error is None:
+					self.update(job, 'done', finished=time.time())
+					print(f">>>>> Job {job['id']} done")
+					continue
+				self.update(job, 'failed', finished=time.time(), error=error)
+				print(f"!!!!! Job {job['id']} failed: {error}")
+				if stop_on_failure:
+					break
+		finally:
+			self.journal.close()
+			self.journal = None
+		return finished
+
+# -------------------------------------------------------------------
+# Command line: add, list and retry jobs
+#	Values of name=value arguments are parsed as JSON if possible
+#	(num_rounds=3), else kept as strings (expt_name=sample_2)
+# -------------------------------------------------------------------
+def parse_arguments(arguments):
+	args = {}
+	for argument in arguments:
+		name, value = argument.split('=', 1)
+		try:
+			args[name] = json.loads(value)
+		except ValueError:
+			args[name] = value
+	return args
+
+if __name__ == '__main__':
+	command, queue = sys.argv[1], JobQueue(sys.argv[2])
+	if command == 'add':
+		print(queue.add(sys.argv[3], **parse_arguments(sys.argv[4:]))['id'])
+	elif command == 'retry':
+		queue.retry(sys.argv[3])
+	elif command == 'list':
+		for job in queue.jobs():
+			print('%-30s %-8s %s %s' % (job['id'], job['state'], json.dumps(job['args']),
+				job.get('error', '')))
+	else:
+		sys.exit('Unknown command: ' + command)
@@ -0,0 +1,57 @@
+# # !/usr/bin/env python3
+
+# -------------------------------------------------------------------
+# Structured run journal
+#	One JSON record per line, written next to the free-text log so
+#	that events (drift, imaging, ...) can be parsed back after a run
+# -------------------------------------------------------------------
+
+# -------------------------------------------------------------------
+# Import
+# -------------------------------------------------------------------
+import json
+import threading
+import time
+
+# -------------------------------------------------------------------
+# Run Journal Class Definition
+# -------------------------------------------------------------------
+class RunJournal():
+	def __init__(self, path):
+		self.path = path
+		self.lock = threading.Lock() # records may come from background stages
+		self.file = open(path, mode='a+')
+
+	# ------------------------------------------------------------------
+	# Append one event record
+	# ------------------------------------------------------------------
+	def record(self, event, **fields):
+		entry = {'time': time.time(), 'event': event}
+		entry.update(fields)
+		line = json.dumps(entry)
+		with self.lock:
+			print(line, file=self.file, flush=True)
+		return entry
+
+	# ------------------------------------------------------------------
+	# Close journal file
+	# ------------------------------------------------------------------
+	def close(self):
+		with self.lock:
+			self.file.close()
+
+# -------------------------------------------------------------------
+# Read back all records of a journal file
+# -------------------------------------------------------------------
+def read_journal(path):
+	entries = []
+	with open(path) as journal_file:
+		for line in journal_file:
+			line = line.strip()
+			if not line:
+				continue
+			try:
+				entries.append(json.loads(line))
+			except ValueError: # last line may be cut off by a crash
+				continue
+	return entries
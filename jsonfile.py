@@ -0,0 +1,22 @@
+# # !/usr/bin/env python3
+
+# -------------------------------------------------------------------
+# JSON documents written in place (plans, job files, cleaning state)
+#	The document is written next to its path and moved over it, so a
+#	reader (or a restart after a crash) never sees a half-written file
+# -------------------------------------------------------------------
+
+# -------------------------------------------------------------------
+# Import
+# -------------------------------------------------------------------
+import json
+import os
+
+# -------------------------------------------------------------------
+# Write `document` to `path` atomically
+# -------------------------------------------------------------------
+def save_json(document, path, indent=1):
+	temporary_path = path + '.tmp'
+	with open(temporary_path, 'w') as json_file:
+		json.dump(document, json_file, indent=indent)
+	os.replace(temporary_path, path)
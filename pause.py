@@ -0,0 +1,148 @@
+# # !/usr/bin/env python3
+
+# -------------------------------------------------------------------
+# Pause/resume of a run
+#	Pumping and incubation run as timers on the monotonic clock that
+#	wake up as soon as the run is paused, instead of plain sleeps. A
+#	pumping timer stops the pump while paused and restarts it for the
+#	remaining time on resume; an incubation timer keeps counting while
+#	paused (the reagent stays on the sample), so it ends exactly
+#	time_reaction after it started unless the pause outlasts it.
+#
+#	on_pause(reason) and on_resume(seconds_paused) are called in the
+#	thread that pauses/resumes (e.g. the control socket), so they can
+#	pause devices the run is blocked on, such as a Fusion acquisition.
+#
+#	cancel() aborts the run: timers and waits raise deadline.Cancelled,
+#	paused or not, and so do device waits (see deadline.cancel()).
+# -------------------------------------------------------------------
+
+# -------------------------------------------------------------------
+# Import
+# -------------------------------------------------------------------
+import threading
+import time
+
+import deadline
+
+# -------------------------------------------------------------------
+# Pause Control Class Definition
+# -------------------------------------------------------------------
+class PauseControl():
+	def __init__(self, on_pause=None, on_resume=None):
+		self.on_pause = on_pause
+		self.on_resume = on_resume
+		self.condition = threading.Condition()
+		self.paused = False
+		self.reason = None
+		self.paused_since = None
+		self.total_paused = 0.0
+		self.cancelled = None # reason, once cancelled
+
+	# ------------------------------------------------------------------
+	# Pause/resume (from any thread); return False if nothing changed
+	# ------------------------------------------------------------------
+	def pause(self, reason='operator'):
+		with self.condition:
+			if self.paused:
+				return False
+			self.paused = True
+			self.reason = reason
+			self.paused_since = time.monotonic()
+			self.condition.notify_all()
+		if self.on_pause is not None:
+			self.on_pause(reason)
+		return True
+
+	def resume(self):
+		with self.condition:
+			if not self.paused:
+				return False
+			seconds = time.monotonic() - self.paused_since
+			self.paused = False
+			self.reason = None
+			self.paused_since = None
+			self.total_paused += seconds
+			self.condition.notify_all()
+		if self.on_resume is not None:
+			self.on_resume(seconds)
+		return True
+
+	# ------------------------------------------------------------------
+	# Cancel the run (from any thread); return False if already cancelled
+	# ------------------------------------------------------------------
+	def cancel(self, reason='operator'):
+		with self.condition:
+			if self.cancelled is not None:
+				return False
+			self.cancelled = reason
+			self.condition.notify_all()
+		deadline.cancel() # device waits in progress
+		return True
+
+	def _checkCancelled(self):
+		if self.cancelled is not None:
+			raise deadline.Cancelled('Run cancelled (' + self.cancelled + ')')
+
+	# ------------------------------------------------------------------
+	# Handle a control socket request (see plan.ControlHandler)
+	# ------------------------------------------------------------------
+	def handleRequest(self, request):
+		command = request.get('command')
+		if command == 'pause':
+			changed = self.pause(request.get('reason', 'operator'))
+		elif command == 'resume':
+			changed = self.resume()
+		elif command == 'abort':
+			changed = self.cancel(request.get('reason', 'operator'))
+		else:
+			return {'ok': False, 'errors': ['Unknown command: ' + str(command)]}
+		return {'ok': True, 'changed': changed}
+
+	# ------------------------------------------------------------------
+	# Block while paused (e.g. at a step boundary)
+	# ------------------------------------------------------------------
+	def waitWhilePaused(self):
+		with self.condition:
+			self.condition.wait_for(lambda: not self.paused or self.cancelled is not None)
+			self._checkCancelled()
+
+	# ------------------------------------------------------------------
+	# Timer: wait `seconds` of running time
+	#	counts_while_paused: paused time counts towards `seconds`
+	#	on_pause() / on_resume(remaining) are called in the waiting
+	#		thread when a pause starts/ends (e.g. stop/restart the pump)
+	#	Returns the seconds spent paused; raises deadline.Cancelled once
+	#		cancelled
+	# ------------------------------------------------------------------
+	def wait(self, seconds, counts_while_paused=False, on_pause=None, on_resume=None):
+		remaining = float(seconds)
+		paused_for = 0.0
+		running_since = time.monotonic()
+		while True:
+			with self.condition:
+				self._checkCancelled()
+				if not self.paused:
+					if remaining <= 0:
+						return paused_for
+					self.condition.wait_for(lambda: self.paused or self.cancelled is not None,
+						timeout=remaining)
+					# running time ends when the pause was requested
+					ended = max(self.paused_since, running_since) if self.paused else time.monotonic()
+					remaining -= ended - running_since
+					running_since = ended
+					continue
+				pause_started = max(self.paused_since, running_since)
+
+			if on_pause is not None:
+				on_pause()
+			with self.condition:
+				self.condition.wait_for(lambda: not self.paused or self.cancelled is not None)
+				self._checkCancelled()
+			seconds_paused = time.monotonic() - pause_started
+			paused_for += seconds_paused
+			if counts_while_paused:
+				remaining -= seconds_paused
+			if on_resume is not None and remaining > 0:
+				on_resume(remaining)
+			running_since = time.monotonic() # after the restart (e.g. of the pump)
@@ -0,0 +1,221 @@
+# # !/usr/bin/env python3
+
+# -------------------------------------------------------------------
+# Remaining step plan of a live run
+#	The plan is a list of JSON-serializable step dicts. The run takes
+#	steps from the front with nextStep(); between steps, a replacement
+#	plan can be swapped in atomically, either from a watched file or
+#	from the local control socket. Every replacement is validated
+#	first and reported through on_edit. The remaining plan is written
+#	to a checkpoint file after every step so a run can be restarted
+#	without repeating steps.
+# -------------------------------------------------------------------
+
+# -------------------------------------------------------------------
+# Import
+# -------------------------------------------------------------------
+import json
+import os
+import socketserver
+import threading
+import time
+
+from jsonfile import save_json
+
+# -------------------------------------------------------------------
+# Load a plan (list of steps) from a JSON file
+# -------------------------------------------------------------------
+def load_plan(path):
+	with open(path) as plan_file:
+		plan = json.load(plan_file)
+	if not isinstance(plan, list) or not all(isinstance(step, dict) for step in plan):
+		raise ValueError('A plan must be a list of steps')
+	return plan
+
+# -------------------------------------------------------------------
+# Write a plan so that readers never see a half-written file
+# -------------------------------------------------------------------
+def save_plan(plan, path):
+	save_json(plan, path)
+
+# -------------------------------------------------------------------
+# Plan Control Class Definition
+#	validate(plan) returns a list of error strings (empty if valid)
+#	check_state(plan) does the same against the current device state
+#		(valves, pump, Fusion protocols); it is only called at step
+#		boundaries from the thread running the plan, so it may talk to
+#		the devices
+#	on_edit(source, old_plan, new_plan) is called after a replacement
+#	Edits are picked up from edit_path (if it exists) and from
+#	replace() calls, which the control socket uses.
+#	pause_control: PauseControl (see pause.py) the control socket can
+#		pause, resume and abort
+# -------------------------------------------------------------------
+class PlanControl():
+	def __init__(self, plan, checkpoint_path, validate, check_state=None, on_edit=None,
+				 control_port=None, pause_control=None):
+		self.plan = list(plan)
+		self.checkpoint_path = checkpoint_path
+		self.edit_path = os.path.splitext(checkpoint_path)[0] + '.edit.json'
+		self.validate = validate
+		self.check_state = check_state
+		self.on_edit = on_edit
+		self.pause_control = pause_control
+		self.current_step = None
+		self.steps_done = 0
+
+		self.lock = threading.Lock() # guards plan and pending edit
+		self.pending = None # (source, plan) waiting for the next step boundary
+
+		self.server = None
+		if control_port is not None:
+			self.server = start_control_server(self, control_port)
+
+		save_plan(self.plan, self.checkpoint_path)
+
+	# ------------------------------------------------------------------
+	# Remaining steps after the one currently running (copy)
+	#	A replacement plan takes the place of exactly these steps
+	# ------------------------------------------------------------------
+	def remaining(self):
+		with self.lock:
+			plan = self.plan
+			if plan and plan[0] is self.current_step:
+				plan = plan[1:]
+			return [dict(step) for step in plan]
+
+	# ------------------------------------------------------------------
+	# Queue a replacement plan, applied at the next step boundary
+	#	Returns the list of validation errors (nothing queued if any)
+	# ------------------------------------------------------------------
+	def replace(self, plan, source='socket'):
+		errors = self.validate(plan)
+		if not errors:
+			with self.lock:
+				self.pending = (source, plan)
+		return errors
+
+	# ------------------------------------------------------------------
+	# Step boundary: apply pending edits, then take the next step
+	#	check_state runs outside the lock (it may talk to the devices),
+	#	so the control socket is never blocked by it
+	#	Returns None when the plan is finished
+	# ------------------------------------------------------------------
+	def nextStep(self):
+		self._checkEditFile()
+		with self.lock:
+			pending, self.pending = self.pending, None
+		if pending is not None:
+			source, plan = pending
+			errors = self.check_state(plan) if self.check_state is not None else []
+			if errors:
+				print('!!!!! Plan edit from ' + source + ' rejected: ' + '; '.join(errors))
+			else:
+				with self.lock:
+					old_plan = self.plan
+					self.plan = [dict(step) for step in plan]
+					save_plan(self.plan, self.checkpoint_path)
+				if self.on_edit is not None:
+					self.on_edit(source, old_plan, self.plan)
+
+		with self.lock:
+			if not self.plan:
+				self.current_step = None
+				return None
+			self.current_step = self.plan[0]
+			return dict(self.current_step)
+
+	# ------------------------------------------------------------------
+	# Handle one control socket request (see ControlHandler)
+	# ------------------------------------------------------------------
+	def handleRequest(self, request):
+		command = request.get('command')
+		if command == 'get_plan':
+			with self.lock:
+				current = dict(self.current_step) if self.current_step is not None else None
+			paused = self.pause_control is not None and self.pause_control.paused
+			return {'ok': True, 'current': current, 'plan': self.remaining(), 'paused': paused}
+		if command == 'replace_plan':
+			plan = request.get('plan')
+			if not isinstance(plan, list) or not all(isinstance(step, dict) for step in plan):
+				return {'ok': False, 'errors': ['A plan must be a list of steps']}
+			errors = self.replace(plan)
+			return {'ok': not errors, 'errors': errors}
+		if command in ('pause', 'resume', 'abort'):
+			if self.pause_control is None:
+				return {'ok': False, 'errors': ['This run cannot be paused or aborted']}
+			return self.pause_control.handleRequest(request)
+		return {'ok': False, 'errors': ['Unknown command: ' + str(command)]}
+
+	# ------------------------------------------------------------------
+	# Mark the step returned by nextStep() as done and checkpoint
+	# ------------------------------------------------------------------
+	def stepDone(self):
+		with self.lock:
+			if self.plan and self.plan[0] is self.current_step:
+				self.plan.pop(0)
+			self.current_step = None
+			self.steps_done += 1
+			save_plan(self.plan, self.checkpoint_path)
+
+	# ------------------------------------------------------------------
+	# Stop the control socket
+	# ------------------------------------------------------------------
+	def close(self):
+		if self.server is not None:
+			self.server.shutdown()
+			self.server.server_close()
+
+	# ------------------------------------------------------------------
+	# Pick up an edit file: applied edits are renamed to .applied_<time>,
+	#	invalid ones to .rejected so they are not read again
+	# ------------------------------------------------------------------
+	def _checkEditFile(self):
+		if not os.path.exists(self.edit_path):
+			return
+		try:
+			plan = load_plan(self.edit_path)
+		except ValueError as ex:
+			errors = [str(ex)]
+		else:
+			errors = self.replace(plan, source=self.edit_path)
+
+		if errors:
+			print('!!!!! Plan edit ' + self.edit_path + ' rejected: ' + '; '.join(errors))
+			os.replace(self.edit_path, self.edit_path + '.rejected')
+		else:
+			os.replace(self.edit_path, self.edit_path + time.strftime('.applied_%m-%d-%Y_%H-%M-%S'))
+
+# -------------------------------------------------------------------
+# Local control socket: one JSON request per line, one JSON reply
+#	Requests go to controller.handleRequest(request): a PlanControl
+#	during a run, a PauseControl (pause/resume/abort only) during
+#	maintenance programs such as the cleaning cycle
+#	{"command": "get_plan"}
+#	{"command": "replace_plan", "plan": [...]}
+#	{"command": "pause", "reason": "refill reader3"}, {"command": "resume"}
+#	{"command": "abort", "reason": "leak"}: stops the run (see PauseControl.cancel)
+# -------------------------------------------------------------------
+class ControlServer(socketserver.ThreadingTCPServer):
+	daemon_threads = True
+	allow_reuse_address = True
+
+class ControlHandler(socketserver.StreamRequestHandler):
+	def handle(self):
+		for line in self.rfile:
+			try:
+				request = json.loads(line)
+				reply = self.server.controller.handleRequest(request)
+			except Exception as ex:
+				reply = {'ok': False, 'errors': [str(ex)]}
+			self.wfile.write((json.dumps(reply) + '\n').encode())
+
+# -------------------------------------------------------------------
+# Serve the control socket on 127.0.0.1:port in a daemon thread
+#	Stop it with server.shutdown() and server.server_close()
+# -------------------------------------------------------------------
+def start_control_server(controller, port):
+	server = ControlServer(('127.0.0.1', port), ControlHandler)
+	server.controller = controller
+	threading.Thread(target=server.serve_forever, daemon=True).start()
+	return server
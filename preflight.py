@@ -0,0 +1,64 @@
+# # !/usr/bin/env python3
+
+# -------------------------------------------------------------------
+# Unattended preflight
+#	Runs device checks in parallel, each with its own deadline, and
+#	collects a single pass/fail report. A check is a function that
+#	returns (ok, detail); exceptions count as failures.
+# -------------------------------------------------------------------
+
+# -------------------------------------------------------------------
+# Import
+# -------------------------------------------------------------------
+import concurrent.futures
+import threading
+import time
+
+import deadline
+
+# -------------------------------------------------------------------
+# Run checks: [(name, function, deadline_seconds), ...]
+#	Returns [(name, ok, detail, seconds), ...] in the given order
+#	Checks that miss their deadline fail and are cancelled: each check
+#	runs in its own cancel scope (see deadline.py), so it stops at its
+#	next wait. Returns only once every check has stopped, so no check
+#	is left talking to a device (the serial read or REST call in
+#	progress still runs to its own timeout)
+# -------------------------------------------------------------------
+def run_checks(checks):
+	executor = concurrent.futures.ThreadPoolExecutor(max_workers=max(len(checks), 1))
+	started = time.monotonic()
+
+	def timed(function, event):
+		with deadline.cancel_scope(event):
+			check_started = time.monotonic()
+			ok, detail = function()
+			return ok, detail, time.monotonic() - check_started
+
+	events = [threading.Event() for check in checks]
+	futures = [executor.submit(timed, function, event)
+			   for (name, function, seconds), event in zip(checks, events)]
+	results = []
+	for (name, function, seconds), event, future in zip(checks, events, futures):
+		remaining = max(0.0, started + seconds - time.monotonic())
+		try:
+			ok, detail, seconds = future.result(timeout=remaining)
+		except concurrent.futures.TimeoutError:
+			event.set()
+			ok, detail = False, 'no answer within %g s' % seconds
+		except Exception as ex:
+			ok, detail, seconds = False, 'error: ' + repr(ex), time.monotonic() - started
+		results.append((name, bool(ok), detail, seconds))
+
+	executor.shutdown(wait=True)
+	return results
+
+# -------------------------------------------------------------------
+# Format results as a report, overall PASS only if every check passed
+# -------------------------------------------------------------------
+def format_report(results):
+	passed = all(ok for name, ok, detail, seconds in results)
+	lines = ['Preflight ' + ('PASS' if passed else 'FAIL')]
+	for name, ok, detail, seconds in results:
+		lines.append('   %-4s %-20s %6.2f s  %s' % ('ok' if ok else 'FAIL', name, seconds, detail))
+	return '\n'.join(lines)
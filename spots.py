@@ -0,0 +1,179 @@
+# # !/usr/bin/env python3
+
+# -------------------------------------------------------------------
+# Incremental spot detection across reader rounds
+#	Each round is processed in the background as soon as it has been
+#	imaged (while the next round hybridizes). Spots are appended to a
+#	columnar table keyed by round, channel and tile, and running totals
+#	per reader and per position are kept up to date.
+# -------------------------------------------------------------------
+
+# -------------------------------------------------------------------
+# Import
+# -------------------------------------------------------------------
+import queue
+import threading
+
+import numpy as np
+from scipy import ndimage
+
+import images
+
+# -------------------------------------------------------------------
+# Difference of Gaussians spot detection on one 2D image
+#	threshold is in robust standard deviations (MAD) of the DoG image
+#	Returns y, x, intensity (DoG response) arrays of the spots
+# -------------------------------------------------------------------
+def detect_spots(image, sigma=1.5, threshold=5.0):
+	image = np.asarray(image, dtype=np.float32)
+	dog = ndimage.gaussian_filter(image, sigma) - ndimage.gaussian_filter(image, 1.6*sigma)
+
+	median = np.median(dog)
+	mad = 1.4826 * np.median(np.abs(dog - median)) + 1e-6
+	size = 2*int(np.ceil(sigma)) + 1
+	peaks = (dog == ndimage.maximum_filter(dog, size=size)) & (dog > median + threshold*mad)
+
+	y, x = np.nonzero(peaks)
+	return y.astype(np.float32), x.astype(np.float32), dog[y, x]
+
+# -------------------------------------------------------------------
+# Spot Table Class Definition
+#	One numpy array per column, grown by doubling
+# -------------------------------------------------------------------
+class SpotTable():
+	fields = [('round', np.int16),
+			  ('channel', np.int8),
+			  ('tile', np.int16),
+			  ('y', np.float32),
+			  ('x', np.float32),
+			  ('intensity', np.float32)]
+
+	def __init__(self, capacity=65536):
+		self.size = 0
+		self.columns = {name: np.empty(capacity, dtype=dtype) for name, dtype in self.fields}
+
+	def __len__(self):
+		return self.size
+
+	# ------------------------------------------------------------------
+	# Append spots of one round/channel/tile
+	# ------------------------------------------------------------------
+	def append(self, round, channel, tile, y, x, intensity):
+		count = len(y)
+		capacity = len(self.columns['y'])
+		if self.size + count > capacity:
+			while self.size + count > capacity:
+				capacity *= 2
+			for name in self.columns:
+				grown = np.empty(capacity, dtype=self.columns[name].dtype)
+				grown[:self.size] = self.columns[name][:self.size]
+				self.columns[name] = grown
+
+		rows = slice(self.size, self.size + count)
+		self.columns['round'][rows] = round
+		self.columns['channel'][rows] = channel
+		self.columns['tile'][rows] = tile
+		self.columns['y'][rows] = y
+		self.columns['x'][rows] = x
+		self.columns['intensity'][rows] = intensity
+		self.size += count
+
+	# ------------------------------------------------------------------
+	# Get a column (view of the filled part)
+	# ------------------------------------------------------------------
+	def column(self, name):
+		return self.columns[name][:self.size]
+
+	# ------------------------------------------------------------------
+	# Save/load as compressed .npz
+	# ------------------------------------------------------------------
+	def save(self, path):
+		np.savez_compressed(path, **{name: self.column(name) for name, dtype in self.fields})
+
+	@classmethod
+	def load(cls, path):
+		data = np.load(path)
+		table = cls(capacity=max(len(data['y']), 1))
+		table.append(data['round'], data['channel'], data['tile'],
+					 data['y'], data['x'], data['intensity'])
+		return table
+
+# -------------------------------------------------------------------
+# Spot Detector Class Definition
+#	submit() queues a round; a single worker thread processes rounds
+#	in order. on_round(round, reader, counts) is called after each
+#	round with counts = {tile: spots}.
+# -------------------------------------------------------------------
+class SpotDetector():
+	def __init__(self, image_pattern, channels, sigma=1.5, threshold=5.0, on_round=None):
+		self.image_pattern = image_pattern
+		self.channels = channels
+		self.sigma = sigma
+		self.threshold = threshold
+		self.on_round = on_round
+
+		self.table = SpotTable()
+		self.lock = threading.Lock() # guards table and totals
+		self.reader_totals = {}
+		self.position_totals = {}
+		self.round_totals = {}
+		self.errors = []
+
+		self.queue = queue.Queue()
+		self.thread = threading.Thread(target=self._work, daemon=True)
+		self.thread.start()
+
+	# ------------------------------------------------------------------
+	# Queue the acquisition of a round (images written between `since`
+	#	and `until`, the start and end of the acquisition)
+	# ------------------------------------------------------------------
+	def submit(self, round, reader, since, until=None):
+		self.queue.put((round, reader, since, until))
+
+	# ------------------------------------------------------------------
+	# Finish queued rounds and stop the worker
+	# ------------------------------------------------------------------
+	def close(self):
+		self.queue.put(None)
+		self.thread.join()
+
+	# ------------------------------------------------------------------
+	# Running totals (copies, safe to read while detection is going on)
+	# ------------------------------------------------------------------
+	def totals(self):
+		with self.lock:
+			return {'reader': dict(self.reader_totals),
+					'position': dict(self.position_totals),
+					'round': dict(self.round_totals)}
+
+	def _work(self):
+		while True:
+			item = self.queue.get()
+			if item is None:
+				return
+			try:
+				self.processRound(*item)
+			except Exception as ex:
+				print(f"!!!!! Spot detection failed for Round #{item[0]+1}: {ex}")
+				self.errors.append((item[0], ex))
+
+	# ------------------------------------------------------------------
+	# Detect spots on all tiles and channels of one round
+	# ------------------------------------------------------------------
+	def processRound(self, round, reader, since, until=None):
+		paths = images.find_images(self.image_pattern, since, until)
+		counts = {}
+		for tile, path in sorted(paths.items()):
+			counts[tile] = 0
+			for channel in self.channels:
+				projection = images.load_projection(path, channel)
+				y, x, intensity = detect_spots(projection, self.sigma, self.threshold)
+				with self.lock:
+					self.table.append(round, channel, tile, y, x, intensity)
+					self.reader_totals[reader] = self.reader_totals.get(reader, 0) + len(y)
+					self.position_totals[tile] = self.position_totals.get(tile, 0) + len(y)
+					self.round_totals[round] = self.round_totals.get(round, 0) + len(y)
+				counts[tile] += len(y)
+		if self.on_round is not None:
+			self.on_round(round, reader, counts)
+		return counts
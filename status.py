@@ -0,0 +1,123 @@
+# # !/usr/bin/env python3
+
+# -------------------------------------------------------------------
+# Run status snapshot and local HTTP status endpoint
+#	The orchestrator pushes what it does (current step, round, reagent,
+#	ETA, journal events) into a RunStatus; device state comes from
+#	providers that only read attributes the drivers already keep
+#	(valve ports, commanded pump state, last Fusion state), never the
+#	serial ports or the REST API. The JSON snapshot is rebuilt at most
+#	every max_age seconds, so any number of dashboards can poll
+#	GET /status without slowing the control loop.
+# -------------------------------------------------------------------
+
+# -------------------------------------------------------------------
+# Import
+# -------------------------------------------------------------------
+import collections
+import http.server
+import json
+import threading
+import time
+
+# -------------------------------------------------------------------
+# Run Status Class Definition
+#	providers: {name: function returning a JSON-serializable value},
+#		called from the HTTP threads, so they must not talk to devices
+#	error_events: journal events that are kept as recent errors
+# -------------------------------------------------------------------
+class RunStatus():
+	def __init__(self, providers=None, max_age=0.5, history=50,
+				 error_events=('imaging_error', 'arm_error', 'pump_alarm', 'spots_low', 'device_timeout',
+								 'serial_reconnect')):
+		self.providers = providers or {}
+		self.max_age = max_age
+		self.error_events = set(error_events)
+		self.lock = threading.Lock()
+		self.state = {'started': time.time(), 'step': None, 'step_index': 0, 'steps_total': 0,
+					  'step_started': None, 'round': None, 'reagent': None, 'eta': None}
+		self.events = collections.deque(maxlen=history)
+		self.errors = collections.deque(maxlen=history)
+		self.cached = None # (time.monotonic(), JSON bytes)
+
+	# ------------------------------------------------------------------
+	# Update snapshot fields
+	# ------------------------------------------------------------------
+	def update(self, **fields):
+		with self.lock:
+			self.state.update(fields)
+			self.cached = None
+
+	# ------------------------------------------------------------------
+	# Record a journal event (errors are also kept separately)
+	# ------------------------------------------------------------------
+	def event(self, entry):
+		with self.lock:
+			self.events.append(entry)
+			if entry.get('event') in self.error_events:
+				self.errors.append(entry)
+			self.cached = None
+
+	# ------------------------------------------------------------------
+	# Snapshot as a dict
+	# ------------------------------------------------------------------
+	def snapshot(self):
+		with self.lock:
+			snapshot = dict(self.state)
+			snapshot['recent_events'] = list(self.events)[-10:]
+			snapshot['recent_errors'] = list(self.errors)
+		snapshot['time'] = time.time()
+		for name, provider in self.providers.items():
+			try:
+				snapshot[name] = provider()
+			except Exception as ex:
+				snapshot[name] = {'error': str(ex)}
+		return snapshot
+
+	# ------------------------------------------------------------------
+	# Snapshot as JSON bytes, rebuilt at most every max_age seconds
+	# ------------------------------------------------------------------
+	def snapshotJSON(self):
+		cached = self.cached
+		if cached is not None and time.monotonic() - cached[0] < self.max_age:
+			return cached[1]
+		body = json.dumps(self.snapshot(), default=str).encode()
+		self.cached = (time.monotonic(), body)
+		return body
+
+# -------------------------------------------------------------------
+# Status Server Class Definition
+#	GET /status (or /) returns the snapshot, served from its own threads
+# -------------------------------------------------------------------
+class StatusHandler(http.server.BaseHTTPRequestHandler):
+	def do_GET(self):
+		if self.path.split('?')[0] not in ('/', '/status'):
+			self.send_error(404)
+			return
+		body = self.server.run_status.snapshotJSON()
+		self.send_response(200)
+		self.send_header('Content-Type', 'application/json')
+		self.send_header('Content-Length', str(len(body)))
+		self.send_header('Cache-Control', 'no-store')
+		self.end_headers()
+		self.wfile.write(body)
+
+	def log_message(self, format, *args): # keep the console for the run
+		pass
+
+class StatusServer(http.server.ThreadingHTTPServer):
+	daemon_threads = True
+	allow_reuse_address = True
+
+	def __init__(self, run_status, port, host='127.0.0.1'):
+		super().__init__((host, port), StatusHandler)
+		self.run_status = run_status
+		self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+		self.thread.start()
+
+	# ------------------------------------------------------------------
+	# Stop serving
+	# ------------------------------------------------------------------
+	def close(self):
+		self.shutdown()
+		self.server_close()
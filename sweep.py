@@ -0,0 +1,335 @@
+# # !/usr/bin/env python3
+
+# -------------------------------------------------------------------
+# Protocol parameter sweep on a simulated rig
+#	Every protocol variant (pump speed, delivered volumes, SSC wash
+#	repeats, flush placement) runs the real useqFISH plan and step
+#	code against simulated valves, pump and Fusion under a virtual
+#	clock, so a 30-hour run takes well under a second. Variants run in
+#	parallel in a process pool (each worker has its own copy of the
+#	useqFISH module state).
+#
+#	Variants that break the declared minimums (volume per delivery,
+#	SSC washes after each reagent, incubation per reagent) are
+#	rejected; of the rest the fastest is reported together with the
+#	Pareto table of wall time vs reagent use.
+#
+#	python sweep.py [num_rounds]
+# -------------------------------------------------------------------
+
+# -------------------------------------------------------------------
+# Import
+# -------------------------------------------------------------------
+import concurrent.futures
+import contextlib
+import io
+import itertools
+import sys
+import time
+
+# Simulated device timings (s), e.g. from a serial trace of the rig
+valve_command_time = 0.2	# per valve move command
+valve_step_time = 0.25	# per port stepped over
+pump_command_time = 0.3	# per pump command (startFlow sends two)
+imaging_time = 20 * 60	# per Fusion acquisition
+
+# -------------------------------------------------------------------
+# Virtual clock: stands in for the time module inside useqFISH
+# -------------------------------------------------------------------
+class VirtualClock():
+	def __init__(self, start=1.7e9):
+		self.now = start
+
+	def sleep(self, seconds):
+		self.now += max(0.0, seconds)
+
+	def time(self):
+		return self.now
+
+	def monotonic(self):
+		return self.now
+
+	perf_counter = monotonic
+
+	def localtime(self, seconds=None):
+		return time.localtime(self.now if seconds is None else seconds)
+
+	def strftime(self, format, struct_time=None):
+		return time.strftime(format, struct_time or self.localtime())
+
+# -------------------------------------------------------------------
+# Simulated valve chain (the HamiltonMVP calls useqFISH makes)
+# -------------------------------------------------------------------
+class SimulatedValves():
+	def __init__(self, clock, num_valves=2, ports_per_valve=8):
+		self.clock = clock
+		self.num_valves = num_valves
+		self.max_ports_per_valve = [ports_per_valve] * num_valves
+		self.current_port = [1] * num_valves
+		self.moves = 0
+
+	def changePort(self, valve_ID, port_ID, direction=0, wait_until_done=True):
+		distance = abs(self.current_port[valve_ID] - port_ID)
+		distance = min(distance, self.max_ports_per_valve[valve_ID] - distance)
+		self.clock.sleep(valve_command_time + valve_step_time * distance)
+		self.current_port[valve_ID] = port_ID
+		self.moves += 1
+		return True
+
+	def changePorts(self, route, wait_until_done=True):
+		for valve_ID, port_ID in route:
+			self.changePort(valve_ID, port_ID)
+		return True
+
+	def isValidValve(self, valve_ID):
+		return 0 <= valve_ID < self.num_valves
+
+	def isValidPort(self, valve_ID, port_ID):
+		return self.isValidValve(valve_ID) and 0 < port_ID <= self.max_ports_per_valve[valve_ID]
+
+	def getStatus(self, valve_ID):
+		return (self.current_port[valve_ID] - 1, True, False) # port 0-7, as HamiltonMVP
+
+	def getChainStatus(self, valve_IDs=None):
+		return [self.getStatus(valve_ID) for valve_ID in (valve_IDs or range(self.num_valves))]
+
+# -------------------------------------------------------------------
+# Simulated pump: keeps a log of deliveries
+#	[(start, end, reagent, volume_ul), ...]; the reagent is the one
+#	whose route matches the valve positions when the flow starts
+#	rate: function(reagent, speed) -> ul/s
+# -------------------------------------------------------------------
+class SimulatedPump():
+	def __init__(self, clock, valves, fluidic_graph, rate):
+		self.clock = clock
+		self.valves = valves
+		self.fluidic_graph = fluidic_graph
+		self.rate = rate
+		self.flow_status = 'Stopped'
+		self.speed = 0.0
+		self.direction = 'Forward'
+		self.started = None
+		self.reagent = None
+		self.deliveries = []
+
+	def startFlow(self, speed, direction='Forward'):
+		self.clock.sleep(2 * pump_command_time)
+		self.flow_status = 'Flowing' if speed > 0 else 'Stopped'
+		self.speed = speed
+		self.direction = direction
+		self.started = self.clock.now
+		self.reagent = None
+		for reagent, route in self.fluidic_graph.routes.items():
+			if self.fluidic_graph.moves(self.valves.current_port, route) == []:
+				self.reagent = reagent
+				break
+
+	def stopFlow(self):
+		self.clock.sleep(pump_command_time)
+		if self.flow_status == 'Flowing':
+			seconds = self.clock.now - self.started - pump_command_time
+			self.deliveries.append((self.started, self.clock.now, self.reagent,
+				seconds * self.rate(self.reagent, self.speed)))
+		self.flow_status = 'Stopped'
+		return True
+
+	def getStatus(self):
+		return (self.flow_status, float(self.speed), self.direction, 'Remote', 'Disabled', 'No Error')
+
+# -------------------------------------------------------------------
+# Simulated Fusion (the fusionrest calls useqFISH makes)
+# -------------------------------------------------------------------
+class SimulatedFusion():
+	def __init__(self, clock):
+		self.clock = clock
+		self.acquisitions = 0
+
+	def arm(self, names):
+		pass
+
+	def run_protocol_completely(self, protocol_name):
+		self.clock.sleep(imaging_time)
+		self.acquisitions += 1
+
+# -------------------------------------------------------------------
+# Plan of a variant
+#	variant: {'speed', 'volumes': [valve_0_ul, valve_1_ul, flush_ul],
+#		'ssc_repeats', 'flush': 'all' | 'after_reagents'}
+#	'after_reagents' drops the flushes after SSC washes (flushes that
+#	push a reagent into an incubation are kept)
+# -------------------------------------------------------------------
+def build_variant_plan(useqFISH, variant, num_rounds, protocol_name='sweep'):
+	plan = useqFISH.build_sequencing_plan(num_rounds, protocol_name)
+	steps = []
+	for step in plan:
+		step = dict(step)
+		if step['step'] == 'flow' and step['reagent'] == 'ssc' and step['repeats'] > 1:
+			step['repeats'] = variant['ssc_repeats']
+		if (variant['flush'] == 'after_reagents' and step['step'] == 'flow'
+				and step['reagent'] == 'flush' and step['time_reaction'] == 0):
+			continue
+		steps.append(step)
+	return steps
+
+# -------------------------------------------------------------------
+# Index in time_pumping/volumes of the line a reagent is pumped through
+#	(as used by build_sequencing_plan)
+# -------------------------------------------------------------------
+def pumping_index(reagent):
+	if reagent == 'flush':
+		return 2
+	return 1 if reagent is not None and reagent.startswith('reader') else 0
+
+# -------------------------------------------------------------------
+# Run one variant (in a worker process)
+#	Returns a result dict: variant, wall time, reagent use per reagent,
+#	and the measured quantities the minimums are checked against
+#	The useqFISH globals the variant replaces are put back afterwards,
+#	so variants (and anything else in the process) never see each
+#	other's rig, clock or settings
+# -------------------------------------------------------------------
+simulated_globals = ['time', 'MVPchain', 'pump', 'fusionrest', 'speed', 'time_pumping', 'pump_rate',
+					 'primed_reagent', 'run_journal', 'run_status', 'drift_monitor', 'spot_detector']
+unset = object() # global not defined yet (the devices only exist once __main__ ran)
+
+def simulate(variant, num_rounds=2):
+	import useqFISH
+
+	# ul/s per unit of pump speed of each time_pumping entry (500 ul in
+	#	time_pumping[i] s at the configured speed)
+	flow_rates = [500 / (seconds * useqFISH.speed) for seconds in useqFISH.time_pumping]
+	def rate(reagent, speed):
+		return flow_rates[pumping_index(reagent)] * speed
+
+	clock = VirtualClock()
+	valves = SimulatedValves(clock)
+	pump = SimulatedPump(clock, valves, useqFISH.fluidic_graph, rate)
+	fusion = SimulatedFusion(clock)
+
+	saved = {name: getattr(useqFISH, name, unset) for name in simulated_globals}
+	try:
+		useqFISH.time = clock
+		useqFISH.MVPchain = valves
+		useqFISH.pump = pump
+		useqFISH.fusionrest = fusion
+		useqFISH.speed = variant['speed']
+		useqFISH.time_pumping = [volume / (flow_rates[i] * variant['speed'])
+								 for i, volume in enumerate(variant['volumes'])]
+		useqFISH.pump_rate = flow_rates[0] * variant['speed']
+		useqFISH.primed_reagent = None
+		useqFISH.run_journal = None
+		useqFISH.run_status = None
+		useqFISH.drift_monitor = None
+		useqFISH.spot_detector = None
+
+		plan = build_variant_plan(useqFISH, variant, num_rounds)
+		started = clock.now
+		with contextlib.redirect_stdout(io.StringIO()):
+			for i, step in enumerate(plan):
+				upcoming = [s for s in plan[i+1:] if s['step'] == 'flow']
+				useqFISH.run_step(step, next_reagent=upcoming[0]['reagent'] if upcoming else None)
+	finally:
+		for name, value in saved.items():
+			if value is unset:
+				delattr(useqFISH, name)
+			else:
+				setattr(useqFISH, name, value)
+
+	return dict(variant=variant, wall_time=clock.now - started, acquisitions=fusion.acquisitions,
+				valve_moves=valves.moves, **measure(pump.deliveries, clock.now))
+
+# -------------------------------------------------------------------
+# Quantities the minimums are checked against, from the deliveries
+#	min_volume: smallest delivery of a non-flush reagent (ul)
+#	washes: {reagent: fewest SSC deliveries between it and the next reagent}
+#	incubation: {reagent: shortest time from delivery end to the next
+#		delivery other than the flush pushing it in (s)}
+# -------------------------------------------------------------------
+def measure(deliveries, end_time):
+	reagent_use = {}
+	for start, end, reagent, volume in deliveries:
+		reagent_use[reagent] = reagent_use.get(reagent, 0.0) + volume
+
+	volumes = [volume for start, end, reagent, volume in deliveries if reagent != 'flush']
+	main = [(start, end, reagent) for start, end, reagent, volume in deliveries
+			if reagent not in ('flush', 'ssc')]
+	washes = {}
+	incubation = {}
+	for i, (start, end, reagent) in enumerate(main):
+		next_start = main[i+1][0] if i + 1 < len(main) else end_time
+		count = sum(1 for s, e, r, v in deliveries if r == 'ssc' and end <= s < next_start)
+		washes[reagent] = min(washes.get(reagent, count), count)
+		next_wash = min([s for s, e, r, v in deliveries if r != 'flush' and s >= end] + [end_time])
+		incubation[reagent] = min(incubation.get(reagent, float('inf')), next_wash - end)
+	return {'reagent_use': reagent_use, 'total_volume': sum(reagent_use.values()),
+			'min_volume': min(volumes) if volumes else 0.0,
+			'washes': washes, 'incubation': incubation}
+
+# -------------------------------------------------------------------
+# Check a result against the declared minimums
+#	minimums: {'volume': ul, 'washes': {reagent: n},
+#		'incubation': {reagent: s}}; reagent names match by prefix
+#		('reader' covers reader1..reader8)
+#	Returns a list of violations (empty if feasible)
+# -------------------------------------------------------------------
+def violations(result, minimums):
+	problems = []
+	if result['min_volume'] < minimums.get('volume', 0):
+		problems.append('volume %.0f ul' % result['min_volume'])
+	for key, unit in (('washes', 'washes'), ('incubation', 's incubation')):
+		for reagent, minimum in minimums.get(key, {}).items():
+			for measured_reagent, measured in result[key].items():
+				if measured_reagent.startswith(reagent) and measured < minimum:
+					problems.append('%s: %g %s' % (measured_reagent, round(measured), unit))
+	return problems
+
+# -------------------------------------------------------------------
+# Pareto front: results no other result beats on both wall time and
+#	reagent use, sorted by wall time
+# -------------------------------------------------------------------
+def pareto_front(results):
+	front = []
+	for result in sorted(results, key=lambda result: (result['wall_time'], result['total_volume'])):
+		if not front or result['total_volume'] < front[-1]['total_volume']:
+			front.append(result)
+	return front
+
+# -------------------------------------------------------------------
+# Run a sweep: grid = {parameter: [values]}, see build_variant_plan
+# -------------------------------------------------------------------
+def run_sweep(grid, minimums, num_rounds=2, max_workers=None):
+	names = sorted(grid)
+	variants = [dict(zip(names, values)) for values in itertools.product(*(grid[name] for name in names))]
+	with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+		results = list(executor.map(simulate, variants, [num_rounds] * len(variants)))
+	for result in results:
+		result['violations'] = violations(result, minimums)
+	feasible = [result for result in results if not result['violations']]
+	best = min(feasible, key=lambda result: result['wall_time']) if feasible else None
+	return results, feasible, best
+
+def format_variant(variant):
+	return 'speed %g, volumes %s ul, ssc x%d, flush %s' % (variant['speed'],
+		'/'.join('%g' % volume for volume in variant['volumes']), variant['ssc_repeats'], variant['flush'])
+
+# Variants and minimums swept by default
+default_grid = {'speed': [20, 30, 40, 48],
+				'volumes': [[500, 500, 250], [400, 500, 200], [500, 630, 240], [600, 630, 300]],
+				'ssc_repeats': [2, 3, 5],
+				'flush': ['all', 'after_reagents']}
+default_minimums = {'volume': 400,
+					'washes': {'reader': 2, 'hcr': 2, 'displacement': 2, 'stripping': 2, 'dt': 2},
+					'incubation': {'reader': 30*60, 'hcr': 60*60, 'dapi': 10*60,
+								   'displacement': 60*60, 'stripping': 60*60}}
+
+if __name__ == '__main__':
+	num_rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 2
+	results, feasible, best = run_sweep(default_grid, default_minimums, num_rounds)
+	print(f'{len(results)} variants, {len(feasible)} meet the minimums ({num_rounds} rounds simulated)')
+	if best is not None:
+		print('Fastest: %s: %.2f h' % (format_variant(best['variant']), best['wall_time'] / 3600))
+	print('Pareto front (wall time vs reagent use)')
+	print('   %9s %11s  %s' % ('hours', 'reagent ul', 'variant'))
+	for result in pareto_front(feasible):
+		print('   %9.2f %11.0f  %s' % (result['wall_time'] / 3600, result['total_volume'],
+			format_variant(result['variant'])))
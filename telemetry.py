@@ -0,0 +1,174 @@
+# # !/usr/bin/env python3
+
+# -------------------------------------------------------------------
+# Background pump telemetry
+#	A low-priority thread reads the Minipuls display between commands
+#	(giving the line back to any command that comes in, see
+#	APump.sampleDisplay) and keeps the samples in a fixed-size numpy
+#	ring buffer. Rolling
+#	statistics and alarms (stalled or reversed flow against what was
+#	commanded) are computed from the buffer.
+# -------------------------------------------------------------------
+
+# -------------------------------------------------------------------
+# Import
+# -------------------------------------------------------------------
+import threading
+import time
+
+import numpy as np
+
+sample_type = np.dtype([('time', 'f8'),		# time.time()
+						('speed', 'f4'),	# displayed speed
+						('direction', 'i1'),	# 0 not running, 1 forward, -1 reverse, 2 unknown
+						('control', 'i1')])	# 1 remote, 0 keypad, 2 unknown
+
+direction_codes = {'Not Running': 0, 'Forward': 1, 'Reverse': -1}
+control_codes = {'Remote': 1, 'Keypad': 0}
+
+# -------------------------------------------------------------------
+# Pump Telemetry Class Definition
+#	rate: samples per second
+#	min_idle: only sample when no command was sent for this long (s),
+#		so sampling never competes with the run's own commands
+#	stall_samples: consecutive samples showing no flow while flow is
+#		commanded before the 'stalled' alarm is raised
+#	on_alarm(kind, sample) is called from the sampler thread
+#	verbose: print every failed sample, otherwise only the first one
+#		of a run of failures and the recovery
+# -------------------------------------------------------------------
+class PumpTelemetry():
+	def __init__(self, pump, rate=0.2, capacity=65536, min_idle=0.5, stall_samples=3,
+				 on_alarm=None, verbose=False):
+		self.pump = pump
+		self.rate = rate
+		self.min_idle = min_idle
+		self.stall_samples = stall_samples
+		self.on_alarm = on_alarm
+		self.verbose = verbose
+
+		self.buffer = np.zeros(capacity, dtype=sample_type)
+		self.count = 0 # samples taken in total
+		self.buffer_lock = threading.Lock()
+		self.alarms = {} # kind -> time.time() when raised
+		self.skipped = 0 # samples skipped because the pump was busy
+		self.failed = 0 # samples failed in a row (e.g. pump unplugged)
+
+		self.stop_event = threading.Event()
+		self.thread = None
+
+	# ------------------------------------------------------------------
+	# Start/stop sampling
+	# ------------------------------------------------------------------
+	def start(self):
+		self.stop_event.clear()
+		self.thread = threading.Thread(target=self._run, daemon=True)
+		self.thread.start()
+
+	def stop(self):
+		self.stop_event.set()
+		if self.thread is not None:
+			self.thread.join()
+			self.thread = None
+
+	def _run(self):
+		while not self.stop_event.wait(1.0 / self.rate):
+			self.sampleSafely()
+
+	# ------------------------------------------------------------------
+	# Take one sample, report failures without flooding the console
+	#	(telemetry must never stop the run)
+	# ------------------------------------------------------------------
+	def sampleSafely(self):
+		try:
+			sampled = self.sampleOnce()
+		except Exception as ex:
+			self.failed += 1
+			if self.failed == 1 or self.verbose:
+				print('Pump telemetry sample failed: ' + str(ex))
+			return False
+		if self.failed and sampled:
+			print('Pump telemetry sampling again after ' + str(self.failed) + ' failed samples')
+			self.failed = 0
+		return sampled
+
+	# ------------------------------------------------------------------
+	# Take one sample if the pump is idle; returns False if skipped
+	# ------------------------------------------------------------------
+	def sampleOnce(self):
+		if time.monotonic() - self.pump.last_command_time < self.min_idle:
+			self.skipped += 1
+			return False
+		sample = self.pump.sampleDisplay() # None if a command needs the pump
+		if sample is None:
+			self.skipped += 1
+			return False
+		message, read_time = sample
+		status = self.pump.parseStatus(message)
+		self.pump.checkMirror(status, read_time)
+		self.append(time.time(), status[1], direction_codes.get(status[2], 2),
+					control_codes.get(status[3], 2))
+		self.checkAlarms()
+		return True
+
+	# ------------------------------------------------------------------
+	# Append a sample to the ring buffer
+	# ------------------------------------------------------------------
+	def append(self, timestamp, speed, direction, control):
+		with self.buffer_lock:
+			self.buffer[self.count % len(self.buffer)] = (timestamp, speed, direction, control)
+			self.count += 1
+
+	# ------------------------------------------------------------------
+	# Samples in time order (copy), optionally only the last `last` ones
+	# ------------------------------------------------------------------
+	def samples(self, last=None):
+		with self.buffer_lock:
+			size = min(self.count, len(self.buffer))
+			if last is not None:
+				size = min(size, last)
+			index = (np.arange(self.count - size, self.count)) % len(self.buffer)
+			return self.buffer[index]
+
+	# ------------------------------------------------------------------
+	# Rolling statistics over the last `window` seconds
+	# ------------------------------------------------------------------
+	def statistics(self, window=60):
+		samples = self.samples()
+		samples = samples[samples['time'] >= time.time() - window]
+		if len(samples) == 0:
+			return {'samples': 0}
+		flowing = samples['direction'] != 0
+		return {'samples': int(len(samples)),
+				'speed_mean': float(samples['speed'].mean()),
+				'speed_min': float(samples['speed'].min()),
+				'speed_max': float(samples['speed'].max()),
+				'flowing_fraction': float(flowing.mean()),
+				'reverse_fraction': float((samples['direction'] == -1).mean()),
+				'remote_fraction': float((samples['control'] == 1).mean())}
+
+	# ------------------------------------------------------------------
+	# Compare the latest samples with the commanded pump state
+	#	stalled: flow commanded, but no flow (or zero speed) displayed
+	#	reversed: flowing against the commanded direction
+	#	keypad: pump left remote control
+	# ------------------------------------------------------------------
+	def checkAlarms(self):
+		samples = self.samples(last=self.stall_samples)
+		latest = samples[-1]
+		commanded_flow = self.pump.flow_status == 'Flowing'
+		commanded_direction = direction_codes.get(self.pump.direction, 1)
+
+		active = {}
+		if commanded_flow and len(samples) >= self.stall_samples:
+			active['stalled'] = bool(np.all((samples['direction'] == 0) | (samples['speed'] == 0)))
+		active['reversed'] = bool(commanded_flow and latest['direction'] == -commanded_direction)
+		active['keypad'] = bool(latest['control'] == 0)
+
+		for kind, raised in active.items():
+			if raised and kind not in self.alarms:
+				self.alarms[kind] = float(latest['time'])
+				if self.on_alarm is not None:
+					self.on_alarm(kind, latest)
+			elif not raised:
+				self.alarms.pop(kind, None)
@@ -0,0 +1,120 @@
+# -------------------------------------------------------------------
+# The modules live at the top of the repository (no package)
+# -------------------------------------------------------------------
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import types
+
+import pytest
+
+# -------------------------------------------------------------------
+# useqFISH wired to the sweep simulators (valves, pump, Fusion) under a
+#	virtual clock; the device globals only exist once __main__ ran
+# -------------------------------------------------------------------
+@pytest.fixture
+def rig(monkeypatch):
+	import sweep
+	import useqFISH
+	clock = sweep.VirtualClock()
+	valves = sweep.SimulatedValves(clock)
+	pump = sweep.SimulatedPump(clock, valves, useqFISH.fluidic_graph, lambda reagent, speed: 1.0)
+	fusion = sweep.SimulatedFusion(clock)
+	for name, value in (('time', clock), ('MVPchain', valves), ('pump', pump), ('fusionrest', fusion),
+						('pause_control', None), ('primed_reagent', None), ('run_journal', None),
+						('run_status', None)):
+		monkeypatch.setattr(useqFISH, name, value, raising=False)
+	return types.SimpleNamespace(clock=clock, valves=valves, pump=pump, fusion=fusion)
+
+# -------------------------------------------------------------------
+# Gilson Minipuls 3 units on a GSIOC line, as a fake serial port
+#	Units answer their select byte with its echo, echo the characters
+#	of buffered commands (run when the closing \r arrives) and answer
+#	immediate commands one character per acknowledge, the last with
+#	its high bit set. on_select(unit) is called on every select.
+# -------------------------------------------------------------------
+class FakeGSIOC():
+	def __init__(self, units=(30,), on_select=None):
+		self.units = {unit: {'speed': 0.0, 'running': None, 'control': 'K'} for unit in units}
+		self.on_select = on_select
+		self.selected = None
+		self.command = None # buffered command being received
+		self.answer = '' # rest of an immediate answer
+		self.pending = b''
+		self.log = [] # (unit, buffered command)
+		self.selects = 0
+
+	def write(self, data):
+		for character in data.decode():
+			self.receive(character)
+		return len(data)
+
+	def read(self, size=1):
+		data, self.pending = self.pending[:size], self.pending[size:]
+		return data
+
+	def send(self, characters):
+		self.pending += characters.encode('ISO-8859-1')
+
+	def receive(self, character):
+		if character == '\xff': # disconnect, also drops a command being received
+			self.selected = None
+			self.command = None
+		elif ord(character) & 0x80:
+			self.selected = ord(character) & 0x7f if ord(character) & 0x7f in self.units else None
+			if self.selected is not None:
+				self.selects += 1
+				self.send(character)
+				if self.on_select is not None:
+					self.on_select(self.selected)
+		elif self.selected is None:
+			return
+		elif character == '\n':
+			self.command = ''
+			self.send(character)
+		elif self.command is not None:
+			self.send(character)
+			if character == '\r':
+				self.run(self.command)
+				self.command = None
+			else:
+				self.command += character
+		elif character == '\x06':
+			self.sendAnswer()
+		else:
+			self.answer = self.immediate(character)
+			self.sendAnswer()
+
+	def sendAnswer(self):
+		character, self.answer = self.answer[:1], self.answer[1:]
+		if character:
+			self.send(character if self.answer else chr(ord(character) | 0x80))
+
+	def run(self, command):
+		unit = self.units[self.selected]
+		self.log.append((self.selected, command))
+		if command == 'KH':
+			unit['running'] = None
+		elif command in ('K<', 'K>'):
+			unit['running'] = command
+		elif command[0] == 'R':
+			unit['speed'] = int(command[1:]) / 100
+		elif command in ('SR', 'SK'):
+			unit['control'] = command[1]
+
+	def immediate(self, command):
+		unit = self.units[self.selected]
+		if command == 'R': # display: direction, speed, control
+			direction = {None: ' ', 'K<': '-', 'K>': '+'}[unit['running']]
+			return direction + '%.2f' % unit['speed'] + ' ' + unit['control']
+		if command == '?':
+			return unit['control']
+		return '$'
+
+	def flush(self):
+		pass
+
+	def close(self):
+		pass
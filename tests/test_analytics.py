@@ -0,0 +1,69 @@
+# -------------------------------------------------------------------
+# Cross-run analytics (analytics.py)
+# -------------------------------------------------------------------
+import json
+
+import numpy as np
+import pytest
+
+import analytics
+
+def write_log(path, lines):
+	path.write_text('\n'.join(lines) + '\n')
+	return str(path)
+
+def test_old_log_lines_take_the_date_from_the_file_name(tmp_path):
+	path = write_log(tmp_path / 'log_expt_03-01-2024.txt', [
+		'>>>>> ssc reaction 1/2 started at 23:59:00',
+		'>>>>> ssc reaction 2/2 started at 23:59:40',
+		'>>>>> Round #1, imaging started at 00:00:10', # next day
+		'>>>>> Round #1, imaging finished at 00:10:10'])
+	steps = analytics.parse_log(path)
+	assert [(step['kind'], step['name'], step['round'], step['repeat']) for step in steps] == [
+		('reaction', 'ssc', -1, 0), ('reaction', 'ssc', -1, 1), ('imaging', '', 0, -1)]
+	assert [step['duration'] for step in steps] == [40, 30, 600]
+
+def test_new_log_lines_name_the_protocol(tmp_path):
+	path = write_log(tmp_path / 'log_expt.txt', [
+		'>>>>> Round #2, imaging (quick) started at 03-01-2024 10:00:00',
+		'!!!!! Error running Fusion protocol for Round #2 at 03-01-2024 10:02:00',
+		'>>>>> Round #2, imaging (full) started at 03-01-2024 10:03:00',
+		'>>>>> Round #2, imaging finished at 03-01-2024 10:13:00',
+		'>>>>> ssc priming started at 03-01-2024 10:14:00'])
+	steps = analytics.parse_log(path)
+	assert [(step['name'], step['round'], step['duration']) for step in steps[:2]] == [
+		('quick', 1, 120), ('full', 1, 600)]
+	assert steps[2]['kind'] == 'priming' and np.isnan(steps[2]['duration'])
+
+def test_group_quantiles_interpolate_within_each_group():
+	keys = np.array(['a'] * 5 + ['b'] * 3, dtype=object)
+	values = np.array([5, 1, 4, 2, 3, 10, np.nan, 20])
+	statistics = analytics.group_statistics(keys, values)
+	assert statistics['a'] == {'count': 5, 'mean': 3.0, 'median': 3.0, 'p10': pytest.approx(1.4),
+							   'p90': pytest.approx(4.6), 'max': 5.0, 'total': 15.0}
+	assert statistics['b']['median'] == 15.0 and statistics['b']['p10'] == pytest.approx(11.0)
+	assert analytics.group_statistics(np.array(['a']), np.array([np.nan])) == {}
+
+def test_single_acquisition_has_no_trend(tmp_path):
+	path = write_log(tmp_path / 'log_expt.txt', [
+		'>>>>> Round #1, imaging (full) started at 03-01-2024 10:00:00',
+		'>>>>> Round #1, imaging finished at 03-01-2024 10:10:00'])
+	trends = analytics.imaging_trends(analytics.load_runs([path]))
+	assert analytics.format_trend('full', trends['full']) == \
+		'   full                           median 600.0 s, trend n/a over 1 acquisitions'
+
+def flow_record(reagent, time_pumping, pumped, primed=0.0):
+	return {'time': 0, 'event': 'flow', 'reagent': reagent, 'repeat': 0, 'started': 0, 'seconds': pumped,
+			'time_pumping': time_pumping, 'time_reaction': 0, 'pumped': pumped, 'primed': primed}
+
+def test_pumping_corrections_are_per_time_pumping_entry(tmp_path):
+	# ssc: time_pumping 38 s, pumped once, as a 2x wash and primed (6 s saved);
+	#	every pump delivers 1 s of extra volume per time_pumping entry
+	records = [{'time': 0, 'event': 'run_started'},
+			   flow_record('ssc', 38, 39), flow_record('ssc', 76, 78), flow_record('ssc', 32, 33, primed=6),
+			   flow_record('reader1', 48, 49.5)]
+	path = tmp_path / 'journal_expt.jsonl'
+	path.write_text(''.join(json.dumps(record) + '\n' for record in records))
+	corrections = analytics.pumping_corrections(analytics.load_runs([str(path)]))
+	assert corrections['ssc'] == (38, 39, 37)
+	assert corrections['reader1'] == (48, 49.5, 46.5)
@@ -0,0 +1,116 @@
+# -------------------------------------------------------------------
+# Device broker (broker.py): command whitelist and query answers
+# -------------------------------------------------------------------
+import threading
+import time
+
+import pytest
+
+import broker
+import deadline
+import hamilton
+import useqFISH
+
+class SlowPump():
+	def __init__(self):
+		self.flow_status = 'Stopped'
+		self.reads = 0
+		self.reading = threading.Event()
+		self.release = threading.Event()
+		self.release.set()
+
+	def getStatus(self):
+		self.reads += 1
+		status = self.flow_status
+		self.reading.set()
+		self.release.wait()
+		return status
+
+	def startFlow(self, speed, direction='Forward'):
+		self.flow_status = 'Flowing'
+
+	def closeRemote(self):
+		raise AssertionError('only the broker owner releases remote control')
+
+@pytest.fixture
+def pump_broker():
+	pump = SlowPump()
+	device_broker = broker.DeviceBroker({'pump': pump}, port=0)
+	yield device_broker, pump
+	device_broker.close()
+
+def call(device_broker, method, *args):
+	return device_broker.handleRequest({'command': 'call', 'device': 'pump', 'method': method, 'args': list(args)})
+
+def test_clients_cannot_release_remote_control(pump_broker):
+	device_broker, pump = pump_broker
+	assert call(device_broker, 'closeRemote') == {'ok': False, 'error': 'Unknown method: closeRemote'}
+	assert call(device_broker, 'enableRemoteControl', 0)['ok'] is False
+	broker.RemoteDevice(None, 'pump').closeRemote() # no-op, nothing sent
+
+def test_recent_answers_are_reused(pump_broker):
+	device_broker, pump = pump_broker
+	assert call(device_broker, 'getStatus')['result'] == 'Stopped'
+	assert call(device_broker, 'getStatus')['result'] == 'Stopped'
+	assert pump.reads == 1
+
+def test_answer_asked_before_a_command_is_not_kept(pump_broker):
+	device_broker, pump = pump_broker
+	pump.release.clear()
+	replies = []
+	query = threading.Thread(target=lambda: replies.append(call(device_broker, 'getStatus')))
+	query.start()
+	pump.reading.wait() # status read in progress ...
+	command = threading.Thread(target=call, args=(device_broker, 'startFlow', 20))
+	command.start() # ... when a command comes in
+	while device_broker.generations['pump'] == 0:
+		time.sleep(0.001)
+	pump.release.set()
+	query.join()
+	command.join()
+	assert replies[0]['result'] == 'Stopped' # answered before the command ran
+	assert call(device_broker, 'getStatus')['result'] == 'Flowing' # not the stale answer
+	assert pump.reads == 2
+
+# -------------------------------------------------------------------
+# Device timeouts behind the broker reach the run's recovery
+# -------------------------------------------------------------------
+class StuckValves():
+	def __init__(self):
+		self.current_port = [1, 1]
+		self.recovered = 0
+
+	def getStatus(self, valve_ID):
+		if not self.recovered:
+			raise hamilton.ValveTimeout('Valve ' + str(valve_ID) + ' movement', 60)
+		return (0, True, False)
+
+	def recoverConnection(self):
+		self.recovered += 1
+		return self.current_port
+
+def test_timeout_through_the_broker_is_recovered(monkeypatch):
+	valves = StuckValves()
+	device_broker = broker.DeviceBroker({'valves': valves}, port=0)
+	client = broker.BrokerClient(device_broker.server.server_address[1])
+	try:
+		remote = client.device('valves')
+		with pytest.raises(hamilton.ValveTimeout) as raised:
+			remote.getStatus(valve_ID=0)
+		assert (raised.value.what, raised.value.seconds) == ('Valve 0 movement', 60)
+
+		monkeypatch.setattr(useqFISH, 'MVPchain', remote, raising=False)
+		monkeypatch.setattr(useqFISH, 'run_journal', None, raising=False)
+		monkeypatch.setattr(deadline, 'recovery', useqFISH.recover_device)
+		assert useqFISH.waitForValve(0) == [0, True, False] # retried after recoverConnection
+		assert valves.recovered == 1
+	finally:
+		client.close()
+		device_broker.close()
+
+def test_other_errors_stay_broker_errors(pump_broker):
+	device_broker, pump = pump_broker
+	reply = call(device_broker, 'startFlow', 'fast', 'sideways', 'extra')
+	assert reply['ok'] is False and reply['error_type'] == 'TypeError'
+	with pytest.raises(broker.BrokerError, match='TypeError'):
+		raise broker.remote_error(reply)
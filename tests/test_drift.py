@@ -0,0 +1,62 @@
+# -------------------------------------------------------------------
+# Round-to-round drift estimation (drift.py)
+# -------------------------------------------------------------------
+import os
+
+import numpy as np
+import pytest
+
+import drift
+
+def sample_image(size=128, seed=0):
+	rng = np.random.default_rng(seed)
+	image = rng.random((size, size))
+	# smooth it so a fractional shift is well defined
+	kernel = np.exp(-np.fft.fftfreq(size)[:, None]**2 * 40 - np.fft.fftfreq(size)[None, :]**2 * 40)
+	return np.real(np.fft.ifft2(np.fft.fft2(image) * kernel))
+
+def fourier_shift(image, dy, dx):
+	fy = np.fft.fftfreq(image.shape[0])[:, None]
+	fx = np.fft.fftfreq(image.shape[1])[None, :]
+	return np.real(np.fft.ifft2(np.fft.fft2(image) * np.exp(-2j * np.pi * (fy*dy + fx*dx))))
+
+def correlate(reference, image):
+	window = np.ones(reference.shape)
+	reference_fft = np.fft.rfft2(reference[None] - reference.mean())
+	return drift.phase_correlate(reference_fft, image[None] - image.mean(), window)
+
+def test_integer_shift():
+	reference = sample_image()
+	shifts, peaks = correlate(reference, np.roll(reference, (12, -20), axis=(0, 1)))
+	assert shifts[0] == pytest.approx([12, -20], abs=0.01)
+	assert peaks[0] > 0.9
+
+def test_subpixel_shift():
+	reference = sample_image()
+	shifts, peaks = correlate(reference, fourier_shift(reference, -3.4, 4.6))
+	assert shifts[0] == pytest.approx([-3.4, 4.6], abs=0.2)
+
+def write(path, array, modified):
+	np.save(path, array[None].astype(np.float32)) # one z plane
+	os.utime(path, (modified, modified))
+
+def test_check_flags_positions_beyond_tolerance(tmp_path):
+	reference = sample_image(256)
+	write(tmp_path / 'round0_F0.npy', reference, 100)
+	write(tmp_path / 'round0_F1.npy', reference, 100)
+	write(tmp_path / 'round1_F0.npy', np.roll(reference, (4, 0), axis=(0, 1)), 200)
+	write(tmp_path / 'round1_F1.npy', np.roll(reference, (0, 16), axis=(0, 1)), 200)
+	monitor = drift.DriftMonitor(str(tmp_path / '*.npy'), downsample=2, tolerance=10.0)
+
+	first = monitor.check(since=50, until=150) # becomes the reference
+	assert first == {0: (0.0, 0.0, 1.0, False), 1: (0.0, 0.0, 1.0, False)}
+
+	results = monitor.check(since=150, until=250)
+	assert results[0][:2] == pytest.approx((4, 0), abs=1)
+	assert results[1][:2] == pytest.approx((0, 16), abs=1)
+	assert [results[position][3] for position in (0, 1)] == [False, True]
+
+def test_check_without_images(tmp_path):
+	monitor = drift.DriftMonitor(str(tmp_path / '*.npy'))
+	assert monitor.check(since=0) == {}
+	assert monitor.reference_fft is None
@@ -0,0 +1,113 @@
+# -------------------------------------------------------------------
+# Reagent routing through the valve chain (fluidics.py)
+# -------------------------------------------------------------------
+import pytest
+
+import fluidics
+
+# Valve 0 feeds the sample, port 8 of valve 0 is fed by valve 1 and
+#	port 8 of valve 1 by valve 2
+valve_links = {(0, 8): 1, (1, 8): 2}
+fluidics_setup = {'ssc': [1, 0, 0],
+				  'hcr': [8, 3, 0],
+				  'dapi': [8, 8, 5]}
+
+def test_routes_follow_the_links_from_the_sample():
+	routes = fluidics.build_routing_table(fluidics_setup, valve_links)
+	assert routes['ssc'] == [(0, 1)] # valves off the path are never moved
+	assert routes['hcr'] == [(0, 8), (1, 3)]
+	assert routes['dapi'] == [(0, 8), (1, 8), (2, 5)]
+
+def test_bad_links_are_reported():
+	with pytest.raises(ValueError, match='No port given for valve 1'):
+		fluidics.find_route([8], valve_links)
+	with pytest.raises(ValueError, match='loop'):
+		fluidics.find_route([8, 8], {(0, 8): 1, (1, 8): 0})
+
+def test_bypass_valve_routes_to_sample_or_waste():
+	graph = fluidics.FluidicGraph(fluidics_setup, valve_links, bypass_valve=(3, 1, 2))
+	assert graph.route('ssc') == [(0, 1), (3, 1)]
+	assert graph.route('ssc', 'waste') == [(0, 1), (3, 2)]
+	with pytest.raises(ValueError):
+		fluidics.FluidicGraph(fluidics_setup, valve_links).route('ssc', 'waste')
+
+def test_only_valves_off_their_port_are_moved():
+	graph = fluidics.FluidicGraph(fluidics_setup, valve_links)
+	assert graph.moves([8, 3, None], graph.route('hcr')) == []
+	assert graph.moves([8, 1], graph.route('dapi')) == [(1, 8), (2, 5)] # valve 2 unknown
+
+def test_volume_adds_the_segments_on_the_path():
+	graph = fluidics.FluidicGraph(fluidics_setup, valve_links,
+		default_volumes={'port': 1, 'link': 10, 'outlet': 100}, volumes={('link', 0, 8): 20})
+	assert graph.volume('ssc') == 101
+	assert graph.volume('hcr') == 100 + 1 + 20 + 1
+
+def test_prefetch_leaves_the_active_path_alone():
+	graph = fluidics.FluidicGraph(fluidics_setup, valve_links)
+	current_port = [8, 3, 1]
+	assert graph.prefetchMoves(current_port, graph.route('hcr'), graph.route('dapi')) == [(2, 5)]
+	assert graph.prefetchMoves(current_port, graph.route('dapi'), graph.route('hcr')) == []
+	assert graph.prefetchMoves([1, 1, 1], graph.route('ssc'), graph.route('dapi')) == [(1, 8), (2, 5)]
+
+def test_prefetch_comes_off_the_incubation(rig):
+	import useqFISH
+	useqFISH.flow('ssc', time_pumping=10, time_reaction=100, prefetch='reader3')
+	assert rig.valves.current_port == [7, 3] # valve B moved during the reaction
+	pumping_ended = rig.pump.deliveries[-1][1]
+	assert rig.clock.now - pumping_ended == pytest.approx(100)
+
+def test_travel_takes_the_shorter_way_round():
+	graph = fluidics.FluidicGraph(fluidics_setup, valve_links)
+	assert graph.travel([2, 3, 1], graph.route('ssc'), [8, 8, 8]) == 1
+	assert graph.travel([7, 3, 1], graph.route('ssc'), [8, 8, 8]) == 2 # 7 -> 8 -> 1
+	assert graph.travel([1, None], graph.route('hcr'), [8, 8, 8]) == 1 + 4 # unknown: half a turn
+
+def test_reagents_are_ordered_by_valve_travel():
+	graph = fluidics.FluidicGraph(fluidics_setup, valve_links)
+	assert graph.orderByTravel(['dapi', 'ssc', 'hcr'], [8, 3, 5], [8, 8, 8]) == ['hcr', 'ssc', 'dapi']
+
+# useqFISH rig with a bypass valve (valve 2: port 1 to the sample, 2 to waste)
+@pytest.fixture
+def bypass_rig(rig, monkeypatch):
+	import sweep
+	import useqFISH
+	graph = fluidics.FluidicGraph(useqFISH.fluidics_setup, useqFISH.valve_links, bypass_valve=(2, 1, 2),
+		default_volumes=useqFISH.dead_volume_model)
+	rig.valves = sweep.SimulatedValves(rig.clock, num_valves=3)
+	rig.pump = sweep.SimulatedPump(rig.clock, rig.valves, graph, lambda reagent, speed: 1.0)
+	for name, value in (('bypass_valve', (2, 1, 2)), ('fluidic_graph', graph),
+						('MVPchain', rig.valves), ('pump', rig.pump)):
+		monkeypatch.setattr(useqFISH, name, value)
+	return rig
+
+def pumped_seconds(delivery):
+	return delivery[3] # volume at 1 ul/s
+
+def test_primed_line_skips_the_dead_volume(bypass_rig):
+	import useqFISH
+	time_priming = useqFISH.dead_volume('ssc') / useqFISH.pump_rate
+	assert useqFISH.prime_line('ssc') == pytest.approx(time_priming)
+	assert bypass_rig.valves.current_port[2] == 2 # primed to waste
+	assert useqFISH.primed_reagent == 'ssc'
+
+	useqFISH.flow('ssc', time_pumping=40, repeats=2)
+	first, second = bypass_rig.pump.deliveries[-2:]
+	assert pumped_seconds(first) == pytest.approx(40 - time_priming)
+	assert pumped_seconds(second) == pytest.approx(40) # only the first repeat
+	assert bypass_rig.valves.current_port[2] == 1
+	assert useqFISH.primed_reagent is None
+
+def test_prime_during_the_incubation(bypass_rig):
+	import useqFISH
+	useqFISH.flow('hcr', time_pumping=10, time_reaction=600, prime='ssc')
+	assert useqFISH.primed_reagent == 'ssc'
+	assert [delivery[2] for delivery in bypass_rig.pump.deliveries] == ['hcr', 'ssc']
+
+def test_prime_is_cleared_by_another_reagent(bypass_rig):
+	import useqFISH
+	useqFISH.prime_line('ssc')
+	useqFISH.flow('dapi', time_pumping=40)
+	assert pumped_seconds(bypass_rig.pump.deliveries[-1]) == pytest.approx(40) # nothing saved
+	assert useqFISH.primed_reagent is None
+	useqFISH.flow('ssc', time_pumping=40)
+	assert pumped_seconds(bypass_rig.pump.deliveries[-1]) == pytest.approx(40) # the dapi flow used the line
@@ -0,0 +1,51 @@
+# -------------------------------------------------------------------
+# Cleaning cycle (useqFISH.run_flushing) on the sweep simulators
+# -------------------------------------------------------------------
+import json
+import os
+
+import pytest
+
+import deadline
+import useqFISH
+
+@pytest.fixture
+def cleaning(rig, tmp_path, monkeypatch):
+	monkeypatch.setattr(useqFISH, 'time_pumping', [0.001, 0.002, 0.003]) # real seconds (pause timers)
+	monkeypatch.setattr(useqFISH, 'control_port', None)
+	monkeypatch.setattr(useqFISH, 'cleaning_state_path', str(tmp_path / 'cleaning_state.json'))
+	return rig
+
+def cleaned(rig):
+	return [reagent for start, end, reagent, volume in rig.pump.deliveries]
+
+def test_every_line_is_cleaned_once(cleaning):
+	assert useqFISH.run_flushing()
+	lines = cleaned(cleaning)
+	assert set(lines) == set(useqFISH.fluidics_setup) # the flush line too
+	assert all(lines.count(reagent) == 1 for reagent in useqFISH.fluidics_setup if reagent != 'flush')
+	assert ('flush', 'flush') not in zip(lines, lines[1:]) # no group flush right after the flush line
+	assert lines[-1] == 'flush' # the last group's shared tubing
+	assert not os.path.exists(useqFISH.cleaning_state_path)
+	assert useqFISH.pause_control is None
+
+def test_cycle_resumes_from_the_state_file(cleaning):
+	with open(useqFISH.cleaning_state_path, 'w') as state_file:
+		json.dump([reagent for reagent in useqFISH.fluidics_setup if reagent != 'ssc'], state_file)
+	useqFISH.run_flushing()
+	assert cleaned(cleaning) == ['ssc', 'flush']
+
+def test_abort_keeps_the_progress(cleaning, monkeypatch):
+	start_flow = cleaning.pump.startFlow
+	def abort_third_line(speed, direction='Forward'):
+		start_flow(speed, direction)
+		if len(cleaning.pump.deliveries) == 2:
+			useqFISH.pause_control.cancel('test')
+	monkeypatch.setattr(cleaning.pump, 'startFlow', abort_third_line)
+	with pytest.raises(deadline.Cancelled):
+		useqFISH.run_flushing()
+	assert not deadline.cancelled() # reset to stop the pump
+	assert cleaning.pump.flow_status == 'Stopped'
+	with open(useqFISH.cleaning_state_path) as state_file:
+		done = json.load(state_file)
+	assert 1 <= len(done) <= 2 and 'flush' not in done[:-1]
@@ -0,0 +1,182 @@
+# -------------------------------------------------------------------
+# Fusion REST client (fusionrest.py) against a stubbed HTTP session
+# -------------------------------------------------------------------
+import asyncio
+import json
+import threading
+import time
+
+import pytest
+
+import deadline
+import fusionrest
+
+# -------------------------------------------------------------------
+# Fusion as seen through its REST API: protocols that can be selected,
+#	a run takes `run_checks` state queries, `states` (if given) are the
+#	answers to the next state queries
+# -------------------------------------------------------------------
+class FakeFusion():
+	def __init__(self, protocols=('quick', 'full'), run_checks=2):
+		self.protocols = protocols
+		self.run_checks = run_checks
+		self.state = 'Idle'
+		self.selected = protocols[0]
+		self.states = []
+		self.checks = 0 # state queries since the run started
+		self.started = [] # protocols run
+		self.requests = [] # (method, endpoint, body)
+		self.lock = threading.Lock()
+
+	def handle(self, method, endpoint, body):
+		self.requests.append((method, endpoint, body))
+		if endpoint == '/v1/protocol/state' and method == 'GET':
+			if self.states:
+				return 200, {'State': self.states.pop(0)}
+			state = self.state
+			if state == 'Running':
+				self.checks += 1
+				if self.checks >= self.run_checks:
+					self.state = 'Idle'
+			return 200, {'State': state}
+		if endpoint == '/v1/protocol/state' and method == 'PUT':
+			self.state = json.loads(body)['State']
+			if self.state == 'Running':
+				self.started.append(self.selected)
+				self.checks = 0
+			return 200, None
+		if endpoint == '/v1/protocol/current' and method == 'GET':
+			return 200, {'Name': self.selected}
+		if endpoint == '/v1/protocol/current' and method == 'PUT':
+			name = json.loads(body)['Name']
+			if name in self.protocols: # unknown names are ignored, as Fusion does
+				self.selected = name
+			return 200, None
+		if endpoint == '/v1/protocol/progress':
+			return 200, {'Progress': 0.5}
+		return 404, None
+
+class FakeResponse():
+	def __init__(self, code, body):
+		self.status_code = code
+		self.reason = 'OK' if code == 200 else 'Not Found'
+		self.body = body
+
+	def json(self):
+		return self.body
+
+	@property
+	def text(self):
+		return json.dumps(self.body)
+
+class FakeSession():
+	def __init__(self, fusion):
+		self.fusion = fusion
+		self.closed = False
+
+	def request(self, method, url, data=None, timeout=None):
+		with self.fusion.lock:
+			return FakeResponse(*self.fusion.handle(method, url.split(':15120', 1)[1], data))
+
+	def close(self):
+		self.closed = True
+
+@pytest.fixture
+def fusion(monkeypatch):
+	fake = FakeFusion()
+	monkeypatch.setattr(fusionrest.requests, 'Session', lambda: FakeSession(fake))
+	monkeypatch.setattr(deadline, 'recovery', None)
+	return fake
+
+@pytest.fixture
+def no_polling_delay(monkeypatch):
+	monkeypatch.setattr(deadline.Deadline, 'sleep', lambda self, seconds: self.check())
+
+def test_armed_protocol_is_only_started(fusion, no_polling_delay):
+	client = fusionrest.FusionClient()
+	client.arm(['quick', 'full'])
+	assert client.armed_protocols == ['quick', 'full']
+	assert fusion.selected == 'quick' # the first one is left selected
+	assert client.is_armed('quick') and not client.is_armed('full')
+
+	del fusion.requests[:]
+	client.run_protocol_completely('quick')
+	assert ('PUT', '/v1/protocol/current', json.dumps({'Name': 'quick'})) not in fusion.requests
+	assert fusion.started == ['quick']
+	assert fusion.selected == 'full' # the next armed protocol
+	assert client.armed_protocols == ['full']
+
+	client.run_protocol_completely('full')
+	assert fusion.started == ['quick', 'full']
+	assert client.armed_protocols == []
+
+def test_unarmed_protocol_is_selected_and_clears_the_queue(fusion, no_polling_delay):
+	client = fusionrest.FusionClient()
+	client.arm(['quick', 'full'])
+	client.run_protocol_completely('full') # out of order
+	assert fusion.started == ['full']
+	assert client.armed_protocols == []
+
+def test_arm_fails_on_a_busy_fusion_or_a_misspelled_name(fusion):
+	client = fusionrest.FusionClient()
+	with pytest.raises(fusionrest.ProtocolError, match='quikc'):
+		client.arm(['quikc', 'full'])
+	assert client.armed_protocols == []
+	fusion.state = 'Running'
+	with pytest.raises(fusionrest.ProtocolError, match='not idle'):
+		client.arm('quick')
+
+def test_metrics_count_calls_and_errors(fusion):
+	client = fusionrest.FusionClient()
+	client.get_state()
+	client.get_state()
+	with pytest.raises(fusionrest.ApiError):
+		client._get('/v1/nothing')
+	metrics = client.metrics()
+	assert metrics['GET /v1/protocol/state']['calls'] == 2
+	assert metrics['GET /v1/protocol/state']['errors'] == 0
+	assert (metrics['GET /v1/nothing']['calls'], metrics['GET /v1/nothing']['errors']) == (1, 1)
+
+def test_sessions_are_pooled(fusion, monkeypatch):
+	client = fusionrest.FusionClient(pool_size=2)
+	sessions = list(client._sessions.queue)
+	in_use = []
+	peak = []
+	original = FakeSession.request
+	def request(session, *args, **kwargs):
+		in_use.append(session)
+		peak.append(len(in_use))
+		time.sleep(0.02)
+		in_use.remove(session)
+		return original(session, *args, **kwargs)
+	monkeypatch.setattr(FakeSession, 'request', request)
+	threads = [threading.Thread(target=client.get_state) for i in range(6)]
+	for thread in threads:
+		thread.start()
+	for thread in threads:
+		thread.join()
+	assert max(peak) == 2
+	client.close()
+	assert all(session.closed for session in sessions)
+
+def test_paused_time_extends_the_deadline(fusion):
+	client = fusionrest.FusionClient()
+	fusion.states = ['Running'] + ['Paused'] * 16 + ['Running', 'Idle']
+	client.wait_until_state('Idle', 0.05, timeout=0.5) # about 0.9 s, 0.8 of it paused
+	fusion.states = ['Running'] * 40
+	with pytest.raises(fusionrest.FusionTimeout):
+		client.wait_until_state('Idle', 0.05, timeout=0.5)
+
+def test_async_wait_extends_the_deadline_while_paused(fusion):
+	client = fusionrest.FusionClient()
+	fusion.states = ['Running'] + ['Paused'] * 16 + ['Idle']
+	asyncio.run(client.wait_until_state_async('Idle', 0.05, timeout=0.5))
+	fusion.states = ['Running'] * 40
+	with pytest.raises(fusionrest.FusionTimeout):
+		asyncio.run(client.wait_until_state_async('Idle', 0.05, timeout=0.5))
+
+def test_async_run(fusion, no_polling_delay):
+	client = fusionrest.FusionClient()
+	asyncio.run(client.run_protocol_completely_async('full'))
+	assert fusion.started == ['full'] and fusion.state == 'Idle'
+	assert asyncio.run(client.get_state_async()) == 'Idle'
@@ -0,0 +1,234 @@
+# -------------------------------------------------------------------
+# Gilson Minipuls 3 driver on a fake GSIOC line (gilsonMP3.py)
+# -------------------------------------------------------------------
+import threading
+import time
+
+import pytest
+
+from conftest import FakeGSIOC
+
+import gilsonMP3
+import telemetry
+import transport
+
+def open_pump(line):
+	return gilsonMP3.APump(verbose=False, transport=line, verify_interval=None)
+
+def wait_for_lock_waiter(pump):
+	holder = threading.Thread(target=lambda: pump.lock.acquire() and pump.lock.release())
+	holder.start()
+	while not pump.lock.waiting:
+		time.sleep(0.001)
+	return holder
+
+def test_sampler_reads_the_display():
+	line = FakeGSIOC()
+	pump = open_pump(line)
+	pump.startFlow(20)
+	message, read_time = pump.sampleDisplay()
+	assert pump.parseStatus(message)[:4] == ('Flowing', 20.0, 'Forward', 'Remote')
+
+def test_sampler_gives_way_to_a_waiting_command():
+	line = FakeGSIOC()
+	pump = open_pump(line)
+	holding = threading.Event()
+	release = threading.Event()
+	def command():
+		with pump.lock:
+			holding.set()
+			release.wait()
+	running = threading.Thread(target=command)
+	running.start()
+	holding.wait()
+	assert pump.sampleDisplay() is None # busy
+	waiting = wait_for_lock_waiter(pump)
+	release.set()
+	running.join()
+	waiting.join()
+
+def test_sampler_yields_after_the_select():
+	waiters = []
+	line = FakeGSIOC(on_select=lambda unit: waiters.append(wait_for_lock_waiter(pump)) if sampling else None)
+	sampling = False
+	pump = open_pump(line)
+	sampling = True
+	assert pump.sampleDisplay() is None # a command came in during the select
+	sampling = False
+	waiters[0].join()
+	assert line.selected is None # line given back (disconnected)
+
+def test_unplugged_pump_is_reported_once(capsys):
+	line = FakeGSIOC()
+	pump = open_pump(line)
+	pump.last_command_time = 0
+	sampler = telemetry.PumpTelemetry(pump)
+	def unplugged():
+		raise OSError('port gone')
+	pump.sampleDisplay = unplugged
+	for sample in range(5):
+		assert sampler.sampleSafely() is False
+	del pump.sampleDisplay # plugged back in
+	assert sampler.sampleSafely() is True
+	lines = capsys.readouterr().out.splitlines()
+	assert [line for line in lines if 'telemetry' in line] == [
+		'Pump telemetry sample failed: port gone',
+		'Pump telemetry sampling again after 5 failed samples']
+	assert sampler.failed == 0
+
+# -------------------------------------------------------------------
+# GilsonBus: units waiting for the line are served round-robin
+# -------------------------------------------------------------------
+def wait_for_turns(bus, count):
+	while sum(bus.waiting.values()) < count:
+		time.sleep(0.001)
+
+def take_turns(bus, unit, turns, order):
+	for turn in range(turns):
+		with bus.turn(unit):
+			order.append(unit)
+
+def test_next_unit_follows_the_last_one_served():
+	bus = gilsonMP3.GilsonBus(transport=FakeGSIOC(units=(1, 3, 5)))
+	bus.waiting = {1: 1, 3: 2, 5: 1}
+	assert bus.nextUnit() == 1
+	bus.last_unit = 3
+	assert bus.nextUnit() == 5
+	bus.last_unit = 5
+	assert bus.nextUnit() == 1
+	bus.waiting = {1: 0}
+	assert bus.nextUnit() is None
+
+def test_busy_unit_cannot_starve_the_others():
+	bus = gilsonMP3.GilsonBus(transport=FakeGSIOC(units=(1, 2, 3)))
+	order = []
+	with bus.turn(9): # hold the line until every unit waits for it
+		threads = [threading.Thread(target=take_turns, args=(bus, unit, turns, order))
+				   for unit, turns in ((3, 1), (1, 5), (2, 1))]
+		for thread in threads:
+			thread.start()
+		wait_for_turns(bus, 3)
+	for thread in threads:
+		thread.join()
+	assert order[:3] == [1, 2, 3] # unit 1 asked again at once, but waits its turn
+	assert sorted(order) == [1, 1, 1, 1, 1, 2, 3]
+	assert bus.transactions == {9: 1, 1: 5, 2: 1, 3: 1}
+
+def test_units_share_the_line():
+	line = FakeGSIOC(units=(1, 2))
+	bus = gilsonMP3.GilsonBus(transport=line)
+	pumps = {unit: bus.addPump(unit) for unit in (1, 2)}
+	for pump in pumps.values():
+		pump.verify_interval = None
+	bus.startFlows({1: (10, 'Forward'), 2: (20, 'Reverse')})
+	assert line.units[1]['speed'] == 10 and line.units[1]['running'] == 'K<'
+	assert line.units[2]['speed'] == 20 and line.units[2]['running'] == 'K>'
+	bus.stopAll()
+	assert [unit['running'] for unit in line.units.values()] == [None, None]
+
+# -------------------------------------------------------------------
+# State mirror: commands that would not change anything are skipped
+# -------------------------------------------------------------------
+def test_start_at_speed_zero_is_not_running():
+	line = FakeGSIOC()
+	pump = open_pump(line)
+	assert pump.mirror == {'speed': 0.0, 'direction': 'Forward', 'running': False}
+	assert pump.verifyMirror() # display shows the direction, but no flow
+	del line.log[:]
+	pump.startFlow(20)
+	assert line.log == [(30, 'R2000'), (30, 'K<')] # not skipped as already running
+	assert pump.mirror['running'] is True
+	del line.log[:]
+	pump.startFlow(20)
+	assert line.log == []
+	assert pump.verifyMirror()
+
+# -------------------------------------------------------------------
+# Port reopened in the middle of a command (ReconnectingTransport)
+# -------------------------------------------------------------------
+class FlakyLine():
+	# Fails once: on the read after `after` was written (the device got
+	#	the command) or on the write of `before` (it never did)
+	def __init__(self, line, after=None, before=None):
+		self.line = line
+		self.after = after
+		self.before = before
+		self.written = b''
+		self.fail_read = False
+
+	def write(self, data):
+		if self.before is not None and (self.written + data).endswith(self.before):
+			self.before = None
+			raise OSError('cable pulled')
+		self.written += data
+		written = self.line.write(data)
+		if self.after is not None and self.written.endswith(self.after):
+			self.after = None
+			self.fail_read = True
+		return written
+
+	def read(self, size=1):
+		if self.fail_read:
+			self.fail_read = False
+			raise OSError('cable pulled')
+		return self.line.read(size)
+
+	def flush(self):
+		pass
+
+	def close(self): # a reopened port starts with empty buffers
+		self.line.pending = b''
+
+def open_flaky_pump(line, **fail):
+	flaky = FlakyLine(line, **fail)
+	reconnecting = transport.ReconnectingTransport(lambda: flaky, delay=0)
+	return gilsonMP3.APump(verbose=False, transport=reconnecting, verify_interval=None), reconnecting
+
+def test_command_the_pump_got_is_confirmed_not_resent():
+	line = FakeGSIOC()
+	pump, reconnecting = open_flaky_pump(line)
+	reconnecting.port.after = b'K<\r' # drops while reading the echo of the start
+	del line.log[:]
+	pump.startFlow(20)
+	assert reconnecting.reconnects == 1
+	assert line.log.count((30, 'K<')) == 1 # the pump shows it running: not sent twice
+	assert line.units[30]['running'] == 'K<' and line.units[30]['speed'] == 20
+
+def test_command_the_pump_never_got_is_resent():
+	line = FakeGSIOC()
+	pump, reconnecting = open_flaky_pump(line)
+	reconnecting.port.before = b'\nR' # drops before the speed command goes out
+	del line.log[:]
+	pump.startFlow(20)
+	assert reconnecting.reconnects == 1
+	assert line.log == [(30, 'R2000'), (30, 'K<')]
+	assert line.units[30]['running'] == 'K<' and line.units[30]['speed'] == 20
+
+def test_reopen_backs_off_exponentially(monkeypatch):
+	delays = []
+	monkeypatch.setattr(transport.deadline, 'wait_cancelled', lambda seconds: delays.append(seconds) or False)
+	opened = []
+	def open_port():
+		opened.append(1)
+		if 1 < len(opened) < 6: # the first reopen attempts fail
+			raise OSError('no such port')
+		return FlakyLine(FakeGSIOC(), before=b'x' if len(opened) == 1 else None)
+	reconnecting = transport.ReconnectingTransport(open_port, delay=0.5, max_delay=2)
+	with pytest.raises(transport.Reconnected):
+		reconnecting.write(b'x')
+	assert delays == [0.5, 1, 2, 2, 2]
+	assert reconnecting.reconnects == 1
+	reconnecting.write(b'y') # works again, the next fault starts over
+	assert reconnecting.failed_attempts == 0
+
+def test_reopen_gives_up_after_the_attempts(monkeypatch):
+	monkeypatch.setattr(transport.deadline, 'wait_cancelled', lambda seconds: False)
+	ports = [FlakyLine(FakeGSIOC(), before=b'x')]
+	def open_port():
+		if ports:
+			return ports.pop()
+		raise OSError('no such port')
+	reconnecting = transport.ReconnectingTransport(open_port, attempts=3)
+	with pytest.raises(OSError, match='cable pulled'):
+		reconnecting.write(b'x')
+	assert reconnecting.failed_attempts == 3
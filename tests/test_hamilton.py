@@ -0,0 +1,150 @@
+# -------------------------------------------------------------------
+# Hamilton MVP driver over handwritten serial traces (ReplayTransport)
+# -------------------------------------------------------------------
+import pytest
+
+import deadline
+import hamilton
+import transport
+
+# -------------------------------------------------------------------
+# Write a trace of (host bytes, device reply) exchanges
+# -------------------------------------------------------------------
+def write_trace(path, exchanges):
+	with open(path, 'wb') as trace_file:
+		trace_file.write(transport.MAGIC)
+		for host, device in exchanges:
+			for direction, data in ((transport.WRITE, host), (transport.READ, device)):
+				if data:
+					trace_file.write(transport.record_header.pack(0.0, direction, len(data)) + data)
+
+# Startup of a chain of two 8 port valves, both at port 1
+def startup(max_valves=16):
+	return [(b'1a\r', b''),
+			(b''.join(bytes([97 + valve_ID]) + b'LXR\r' for valve_ID in range(max_valves)), b'\x06\r\x06\r'),
+			(b'aLQT\rbLQT\r', b'\x062\r\x062\r'),
+			(b'aF\r', b'\x06Y\r'), (b'aLQP\r', b'\x061\r'),
+			(b'bF\r', b'\x06Y\r'), (b'bLQP\r', b'\x061\r')]
+
+@pytest.fixture(autouse=True)
+def no_polling_delay(monkeypatch):
+	monkeypatch.setattr(deadline.Deadline, 'sleep', lambda self, seconds: self.check())
+
+def open_chain(tmp_path, exchanges):
+	write_trace(str(tmp_path / 'trace.bin'), exchanges)
+	replay = transport.ReplayTransport(str(tmp_path / 'trace.bin'))
+	return hamilton.HamiltonMVP(transport=replay), replay
+
+# A replayed port that fails once, on the first write starting with
+#	fail_on, behind a ReconnectingTransport (which reopens it)
+class FlakyPort():
+	def __init__(self, replay, fail_on):
+		self.replay = replay
+		self.fail_on = fail_on
+
+	def write(self, data):
+		if self.fail_on is not None and bytes(data).startswith(self.fail_on):
+			self.fail_on = None
+			raise OSError('cable pulled')
+		return self.replay.write(data)
+
+	def read(self, size=1):
+		return self.replay.read(size)
+
+	def flush(self):
+		pass
+
+	def close(self):
+		pass
+
+def open_flaky_chain(tmp_path, exchanges, fail_on):
+	write_trace(str(tmp_path / 'trace.bin'), exchanges)
+	replay = transport.ReplayTransport(str(tmp_path / 'trace.bin'))
+	port = FlakyPort(replay, fail_on)
+	reconnecting = transport.ReconnectingTransport(lambda: port, delay=0)
+	return hamilton.HamiltonMVP(transport=reconnecting), reconnecting, replay
+
+def test_startup_discovers_the_chain(tmp_path):
+	valves, replay = open_chain(tmp_path, startup())
+	assert valves.num_valves == 2
+	assert valves.max_ports_per_valve == [8, 8]
+	assert valves.current_port == [1, 1]
+	assert replay.finished()
+
+def test_only_discovered_valves_are_valid(tmp_path):
+	valves, replay = open_chain(tmp_path, startup() + [(b'bLP03R\r', b'\x06\r'), (b'bF\r', b'\x06Y\r')])
+	assert valves.isValidValve(1) and not valves.isValidValve(2) and not valves.isValidValve(-1)
+	assert not valves.isValidPort(2, 1)
+	assert valves.changePort(2, 1) is False # probed address, but no valve there: no I/O
+	assert valves.changePorts([(2, 1)]) is False
+	assert valves.changePorts([(0, 1), (1, 3)]) is True # valve 0 already there
+	assert valves.current_port == [1, 3]
+	assert replay.finished()
+
+def test_valves_are_initialized_before_they_are_queried(tmp_path):
+	valves, replay = open_chain(tmp_path, startup())
+	host = replay.expected
+	assert host.index(b'aLXR\r') < host.index(b'aLQT\r')
+	assert host.count(b'LQT\r') == 2 # only the valves that acknowledged
+
+def test_no_valves_found(tmp_path):
+	valves, replay = open_chain(tmp_path, [(host, b'') for host, device in startup()[:2]])
+	assert valves.num_valves == 0
+	assert replay.finished()
+
+def test_probe_is_repeated_after_the_port_reopens(tmp_path):
+	# The LXR burst is lost: the chain is readdressed and probed again
+	valves, reconnecting, replay = open_flaky_chain(tmp_path, [(b'1a\r', b'')] + startup(), b'aLXR')
+	assert reconnecting.reconnects == 1
+	assert valves.num_valves == 2
+	assert valves.current_port == [1, 1]
+	assert replay.finished()
+
+def test_auto_address_is_repeated_after_the_port_reopens(tmp_path):
+	valves, reconnecting, replay = open_flaky_chain(tmp_path, startup(), b'1a')
+	assert reconnecting.reconnects == 1
+	assert valves.num_valves == 2
+	assert replay.finished()
+
+def test_recover_connection_reads_all_positions_in_one_burst(tmp_path):
+	valves, replay = open_chain(tmp_path, startup() + [(b'aLQP\rbLQP\r', b'\x063\r\x061\r')])
+	assert valves.recoverConnection() == [3, 1]
+	assert replay.finished()
+
+def test_recover_connection_readdresses_a_silent_chain(tmp_path):
+	valves, replay = open_chain(tmp_path, startup() + [(b'aLQP\rbLQP\r', b''), (b'1a\r', b''),
+													  (b'aLQP\rbLQP\r', b'\x062\r\x064\r')])
+	assert valves.recoverConnection() == [2, 4]
+	assert replay.finished()
+
+def test_recover_connection_repeats_after_the_port_reopens(tmp_path):
+	exchanges = startup() + [(b'aLQP\rbLQP\r', b'\x065\r\x061\r')]
+	valves, reconnecting, replay = open_flaky_chain(tmp_path, exchanges, b'aLQP\rbLQP')
+	assert valves.recoverConnection() == [5, 1]
+	assert reconnecting.reconnects == 1
+	assert replay.finished()
+
+# -------------------------------------------------------------------
+# MVPCodec
+# -------------------------------------------------------------------
+def test_codec_encodes_precomputed_and_other_frames():
+	codec = hamilton.MVPCodec(['a', 'b'])
+	assert codec.encode(1, 'LQP\r') == b'bLQP\r'
+	assert codec.encode(0, 'LP03R\r') == b'aLP03R\r'
+	assert codec.encode(0, 'LP09R\r') == b'aLP09R\r' # not precomputed
+
+def test_codec_decodes_replies():
+	codec = hamilton.MVPCodec(['a'])
+	assert codec.decodeQuery('position', '') == hamilton.Reply('No response', False, '')
+	assert codec.decodeQuery('position', '!') == hamilton.Reply('Negative Acknowledge', False, '!')
+	assert codec.decodeQuery('position', '\x063\r') == hamilton.Reply(2, True, '\x063\r')
+	assert codec.decodeQuery('position', '\x069\r') == hamilton.Reply('Unknown Port', False, '\x069\r')
+	assert codec.decodeQuery('configuration', '\x062\r').value == '8 ports'
+	assert codec.decodeQuery('moving', '\x06Y\r') == hamilton.Reply(True, True, '\x06Y\r')
+	assert codec.decodeQuery('initialize', '\x06\r') == hamilton.Reply('Acknowledge', True, '\x06\r')
+
+def test_codec_splits_bursts():
+	codec = hamilton.MVPCodec(['a', 'b', 'c'])
+	assert codec.split('\x061\r\x062\r') == ['\x061\r', '\x062\r']
+	assert codec.split('\x061\r\x06') == ['\x061\r'] # last reply incomplete
+	assert codec.split('!!\x063\r') == ['!', '!', '\x063\r'] # NAKs come without a CR
@@ -0,0 +1,29 @@
+# -------------------------------------------------------------------
+# Image helpers of the online QC stages (images.py)
+# -------------------------------------------------------------------
+import os
+
+import numpy as np
+
+import images
+
+def write(path, array, modified):
+	np.save(path, array)
+	os.utime(path, (modified, modified))
+	return str(path)
+
+def test_find_images_keeps_to_one_acquisition(tmp_path):
+	write(tmp_path / 'round0_F0.npy', np.zeros((2, 2)), 100)
+	current = write(tmp_path / 'round1_F0.npy', np.zeros((2, 2)), 200)
+	write(tmp_path / 'round2_F0.npy', np.zeros((2, 2)), 300) # next acquisition
+	pattern = str(tmp_path / '*.npy')
+	assert images.find_images(pattern, since=150, until=250) == {0: current}
+	assert images.find_images(pattern, since=150)[0].endswith('round2_F0.npy')
+
+def test_load_projection_reads_into_memory(tmp_path):
+	stack = np.arange(24, dtype=np.float32).reshape(2, 3, 4)
+	path = write(tmp_path / 'stack.npy', stack, 100)
+	projection = images.load_projection(path)
+	assert np.array_equal(projection, stack.max(axis=0))
+	projection += 1 # a copy, not a read-only view of the file
+	os.remove(path) # the file is not held open
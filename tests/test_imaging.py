@@ -0,0 +1,48 @@
+# -------------------------------------------------------------------
+# Imaging steps of useqFISH on the sweep simulators
+# -------------------------------------------------------------------
+import os
+
+import numpy as np
+import pytest
+
+import useqFISH
+
+# Fusion that saves one (c, z, y, x) image per acquisition, with spots left
+#	in the reader channels if `residual` is set
+@pytest.fixture
+def saving_fusion(rig, tmp_path, monkeypatch):
+	protocols = []
+	def run_protocol_completely(protocol_name):
+		rig.clock.sleep(60)
+		stack = np.random.default_rng(len(protocols)).normal(100, 1, (4, 2, 32, 32))
+		if rig.residual:
+			stack[1:, :, 10:12, 10:12] = 1000
+		path = tmp_path / ('acquisition%d_F0.npy' % len(protocols))
+		np.save(path, stack.astype(np.float32))
+		os.utime(path, (rig.clock.now - 1, rig.clock.now - 1))
+		protocols.append(protocol_name)
+	monkeypatch.setattr(rig.fusion, 'run_protocol_completely', run_protocol_completely)
+	monkeypatch.setattr(useqFISH, 'image_pattern', str(tmp_path / '*.npy'))
+	monkeypatch.setattr(useqFISH, 'verification_protocol_name', 'quick')
+	rig.residual = False
+	return protocols
+
+def test_clean_verification_skips_the_full_protocol(rig, saving_fusion):
+	useqFISH.imaging(0, 'full', verify=True)
+	assert saving_fusion == ['quick']
+	assert not useqFISH.needs_full_imaging(0, rig.clock.now - 3600, rig.clock.now)
+
+def test_residual_signal_escalates_to_the_full_protocol(rig, saving_fusion):
+	rig.residual = True
+	useqFISH.imaging(0, 'full', verify=True)
+	assert saving_fusion == ['quick', 'full']
+
+def test_missing_verification_images_escalate(rig, tmp_path, monkeypatch):
+	monkeypatch.setattr(useqFISH, 'image_pattern', str(tmp_path / '*.npy'))
+	assert useqFISH.needs_full_imaging(0, 0, rig.clock.now) is True
+
+def test_without_verification_protocol_only_the_full_protocol_runs(rig, saving_fusion, monkeypatch):
+	monkeypatch.setattr(useqFISH, 'verification_protocol_name', None)
+	useqFISH.imaging(0, 'full', verify=True)
+	assert saving_fusion == ['full']
@@ -0,0 +1,100 @@
+# -------------------------------------------------------------------
+# Persistent job queue (jobs.py)
+# -------------------------------------------------------------------
+import pytest
+
+from jobs import JobQueue, parse_arguments
+from journal import read_journal
+
+def test_jobs_run_in_the_order_they_were_added(tmp_path):
+	queue = JobQueue(str(tmp_path))
+	first = queue.add('flow', reagent='ssc')
+	second = queue.add('flushing')
+	assert [job['id'] for job in queue.jobs()] == [first['id'], second['id']]
+	ran = []
+	finished = queue.run(lambda job, interrupted: ran.append((job['id'], interrupted)))
+	assert ran == [(first['id'], False), (second['id'], False)]
+	assert [job['id'] for job in finished] == [first['id'], second['id']]
+	assert [job['state'] for job in queue.jobs()] == ['done', 'done']
+
+def test_interrupted_job_runs_first_and_is_resumed(tmp_path):
+	queue = JobQueue(str(tmp_path))
+	queue.add('flow', reagent='ssc')
+	interrupted = queue.add('sequencing', expt_name='sample_1')
+	queue.update(interrupted, 'running') # the rig stopped during this job
+	ran = []
+	queue.run(lambda job, resumed: ran.append((job['id'], resumed)))
+	assert ran[0] == (interrupted['id'], True)
+	assert len(ran) == 2
+
+def test_a_failed_job_stops_the_queue(tmp_path):
+	queue = JobQueue(str(tmp_path))
+	failing = queue.add('flow', reagent='ssc')
+	queue.add('flushing')
+	def run_job(job, interrupted):
+		raise RuntimeError('valve jammed')
+	finished = queue.run(run_job)
+	assert [job['id'] for job in finished] == [failing['id']]
+	states = [(job['state'], job.get('error')) for job in queue.jobs()]
+	assert states == [('failed', 'RuntimeError: valve jammed'), ('queued', None)]
+
+def test_a_job_returning_false_fails(tmp_path):
+	queue = JobQueue(str(tmp_path))
+	queue.add('flow')
+	queue.add('flushing')
+	finished = queue.run(lambda job, interrupted: False, stop_on_failure=False)
+	assert len(finished) == 2
+	assert [job['error'] for job in queue.jobs()] == ['job returned False'] * 2
+
+def test_retry_queues_a_failed_job_again(tmp_path):
+	queue = JobQueue(str(tmp_path))
+	job = queue.add('flow')
+	queue.run(lambda job, interrupted: False)
+	queue.retry(job['id'])
+	assert queue.nextJob()['state'] == 'queued'
+	queue.run(lambda job, interrupted: True)
+	job = queue.jobs()[0]
+	assert job['state'] == 'done' and job['attempts'] == 2
+
+def test_queue_persists_across_instances(tmp_path):
+	JobQueue(str(tmp_path)).add('sequencing', expt_name='sample_1', num_rounds=3)
+	JobQueue(str(tmp_path)).add('flushing')
+	queue = JobQueue(str(tmp_path)) # e.g. after a restart
+	jobs = queue.jobs()
+	assert [job['id'] for job in jobs] == ['0001_sequencing', '0002_flushing']
+	assert jobs[0]['args'] == {'expt_name': 'sample_1', 'num_rounds': 3}
+	queue.run(lambda job, interrupted: True)
+	assert [job['state'] for job in JobQueue(str(tmp_path)).jobs()] == ['done', 'done']
+
+def test_half_written_job_files_are_skipped(tmp_path):
+	queue = JobQueue(str(tmp_path))
+	queue.add('flow')
+	(tmp_path / '0002_flow.json').write_text('{"id": "0002_fl')
+	assert [job['id'] for job in queue.jobs()] == ['0001_flow']
+
+def test_state_changes_are_journaled(tmp_path):
+	queue = JobQueue(str(tmp_path))
+	job = queue.add('flow')
+	queue.run(lambda job, interrupted: True)
+	entries = read_journal(str(tmp_path / 'queue.jsonl'))
+	assert [entry['event'] for entry in entries] == ['job_running', 'job_done']
+	assert all(entry['job'] == job['id'] for entry in entries)
+
+def test_command_line_values_are_parsed_as_json():
+	assert parse_arguments(['num_rounds=3', 'expt_name=sample_2', 'flags=[1, 2]']) == \
+		{'num_rounds': 3, 'expt_name': 'sample_2', 'flags': [1, 2]}
+
+def test_unknown_job_kind_is_rejected():
+	import useqFISH
+	with pytest.raises(ValueError):
+		useqFISH.run_job({'id': '0001_test', 'kind': 'test', 'args': {}})
+
+def test_failed_flow_job_stops_the_pump(rig, monkeypatch):
+	import useqFISH
+	def stuck(seconds, route):
+		assert rig.pump.flow_status == 'Flowing'
+		raise RuntimeError('valve jammed')
+	monkeypatch.setattr(useqFISH, 'pump_for', stuck)
+	with pytest.raises(RuntimeError):
+		useqFISH.run_job({'id': '0001_flow', 'kind': 'flow', 'args': {'reagent': 'ssc', 'time_pumping': 10}})
+	assert rig.pump.flow_status == 'Stopped'
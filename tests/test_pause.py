@@ -0,0 +1,109 @@
+# -------------------------------------------------------------------
+# Pause, resume and abort of a run (pause.py)
+# -------------------------------------------------------------------
+import threading
+import time
+
+import pytest
+
+import deadline
+import pause
+
+@pytest.fixture(autouse=True)
+def reset_cancel():
+	yield
+	deadline.reset()
+
+def later(seconds, function, *args):
+	timer = threading.Timer(seconds, function, args)
+	timer.start()
+	return timer
+
+def test_abort_stops_a_timer_and_device_waits():
+	pause_control = pause.PauseControl()
+	later(0.05, pause_control.handleRequest, {'command': 'abort', 'reason': 'leak'})
+	started = time.monotonic()
+	with pytest.raises(deadline.Cancelled, match='leak'):
+		pause_control.wait(10)
+	assert time.monotonic() - started < 5
+	with pytest.raises(deadline.Cancelled):
+		deadline.Deadline(10).check()
+	assert pause_control.cancel() is False # already cancelled
+
+def test_abort_while_paused():
+	pause_control = pause.PauseControl()
+	pause_control.pause('refill')
+	later(0.05, pause_control.cancel, 'operator')
+	with pytest.raises(deadline.Cancelled):
+		pause_control.waitWhilePaused()
+	with pytest.raises(deadline.Cancelled):
+		pause_control.wait(10, counts_while_paused=True)
+
+def test_unknown_request():
+	assert pause.PauseControl().handleRequest({'command': 'jump'})['ok'] is False
+
+# -------------------------------------------------------------------
+# Timers
+# -------------------------------------------------------------------
+def test_timer_without_pause():
+	pause_control = pause.PauseControl()
+	started = time.monotonic()
+	assert pause_control.wait(0.1) == 0.0
+	assert 0.1 <= time.monotonic() - started < 1
+
+def test_paused_time_does_not_count():
+	pause_control = pause.PauseControl()
+	later(0.05, pause_control.pause, 'refill')
+	later(0.35, pause_control.resume)
+	started = time.monotonic()
+	paused_for = pause_control.wait(0.2)
+	assert 0.25 <= paused_for < 0.5
+	assert time.monotonic() - started >= 0.2 + paused_for - 0.01
+	assert pause_control.total_paused == pytest.approx(0.3, abs=0.1)
+
+def test_paused_time_counts_for_incubation():
+	pause_control = pause.PauseControl()
+	later(0.05, pause_control.pause)
+	later(0.15, pause_control.resume)
+	started = time.monotonic()
+	pause_control.wait(0.3, counts_while_paused=True)
+	assert 0.3 <= time.monotonic() - started < 0.45
+
+def test_incubation_ends_while_still_paused_on_resume():
+	pause_control = pause.PauseControl()
+	pause_control.pause()
+	later(0.2, pause_control.resume)
+	resumed = []
+	pause_control.wait(0.05, counts_while_paused=True, on_resume=resumed.append)
+	assert resumed == [] # nothing left to restart
+
+def test_timer_callbacks_get_the_remaining_time():
+	pause_control = pause.PauseControl()
+	events = []
+	later(0.1, pause_control.pause)
+	later(0.2, pause_control.resume)
+	pause_control.wait(0.3, on_pause=lambda: events.append('pause'),
+		on_resume=lambda remaining: events.append(remaining))
+	assert events[0] == 'pause'
+	assert events[1] == pytest.approx(0.2, abs=0.05)
+	assert len(events) == 2
+
+def test_pause_and_resume_callbacks():
+	events = []
+	pause_control = pause.PauseControl(on_pause=events.append, on_resume=events.append)
+	assert pause_control.pause('refill') is True
+	assert pause_control.pause('again') is False
+	time.sleep(0.05)
+	assert pause_control.handleRequest({'command': 'resume'}) == {'ok': True, 'changed': True}
+	assert pause_control.resume() is False
+	assert events[0] == 'refill'
+	assert 0.05 <= events[1] < 1
+	assert pause_control.total_paused == events[1]
+
+def test_wait_while_paused_returns_on_resume():
+	pause_control = pause.PauseControl()
+	pause_control.waitWhilePaused() # not paused: returns at once
+	pause_control.pause()
+	later(0.05, pause_control.resume)
+	pause_control.waitWhilePaused()
+	assert not pause_control.paused
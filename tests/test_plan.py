@@ -0,0 +1,103 @@
+# -------------------------------------------------------------------
+# Plan edit and apply (plan.py) and the checks useqFISH runs on edits
+# -------------------------------------------------------------------
+import os
+
+import plan
+import useqFISH
+
+def flow(reagent):
+	return useqFISH.flow_step(reagent, time_pumping=10)
+
+def control(tmp_path, steps, check_state=None, on_edit=None):
+	return plan.PlanControl(steps, str(tmp_path / 'plan.json'), useqFISH.validate_plan,
+		check_state=check_state, on_edit=on_edit)
+
+def test_steps_are_taken_and_checkpointed(tmp_path):
+	plan_control = control(tmp_path, [flow('ssc'), flow('hcr')])
+	assert plan_control.nextStep()['reagent'] == 'ssc'
+	assert [step['reagent'] for step in plan_control.remaining()] == ['hcr']
+	plan_control.stepDone()
+	assert [step['reagent'] for step in plan.load_plan(plan_control.checkpoint_path)] == ['hcr']
+	plan_control.nextStep()
+	plan_control.stepDone()
+	assert plan_control.nextStep() is None
+	assert plan.load_plan(plan_control.checkpoint_path) == []
+
+def test_edit_replaces_the_remaining_steps_at_the_next_boundary(tmp_path):
+	edits = []
+	plan_control = control(tmp_path, [flow('ssc'), flow('hcr')],
+		on_edit=lambda source, old_plan, new_plan: edits.append((source, len(old_plan), len(new_plan))))
+	plan_control.nextStep()
+	assert plan_control.replace([flow('dapi'), flow('flush'), flow('ssc')]) == []
+	assert plan_control.remaining()[0]['reagent'] == 'hcr' # not applied mid-step
+	plan_control.stepDone()
+	assert plan_control.nextStep()['reagent'] == 'dapi'
+	assert edits == [('socket', 1, 3)]
+
+def test_invalid_edits_are_refused(tmp_path):
+	plan_control = control(tmp_path, [flow('ssc')])
+	errors = plan_control.replace([flow('nonexistent'), {'step': 'imaging', 'round': 'one'}])
+	assert len(errors) == 3
+	reply = plan_control.handleRequest({'command': 'replace_plan', 'plan': 'not a plan'})
+	assert reply['ok'] is False
+	assert plan_control.nextStep()['reagent'] == 'ssc'
+
+def test_state_check_runs_outside_the_lock(tmp_path):
+	held = []
+	def check_state(steps):
+		held.append(plan_control.lock.locked())
+		return ['pump is still running']
+	plan_control = control(tmp_path, [flow('ssc')], check_state=check_state)
+	plan_control.replace([flow('hcr')])
+	assert plan_control.nextStep()['reagent'] == 'ssc' # rejected, old plan kept
+	assert held == [False]
+
+def test_edit_file_is_picked_up_once(tmp_path):
+	plan_control = control(tmp_path, [flow('ssc')])
+	plan.save_plan([flow('dapi')], plan_control.edit_path)
+	assert plan_control.nextStep()['reagent'] == 'dapi'
+	assert not os.path.exists(plan_control.edit_path)
+	plan.save_plan([flow('unknown')], plan_control.edit_path)
+	assert plan_control.nextStep()['reagent'] == 'dapi'
+	assert os.path.exists(plan_control.edit_path + '.rejected')
+
+def test_get_plan_reports_current_and_remaining(tmp_path):
+	plan_control = control(tmp_path, [flow('ssc'), flow('hcr')])
+	plan_control.nextStep()
+	reply = plan_control.handleRequest({'command': 'get_plan'})
+	assert reply['current']['reagent'] == 'ssc'
+	assert [step['reagent'] for step in reply['plan']] == ['hcr']
+	assert reply['paused'] is False
+
+# check_plan_state against the simulated rig (see conftest.py)
+def test_edited_protocols_are_armed_when_the_edit_is_checked(rig, monkeypatch):
+	armed = []
+	def arm(names):
+		if 'Misspelled' in names:
+			raise ValueError('selected protocol reads back as Min_5channel')
+		armed.extend(names)
+	monkeypatch.setattr(rig.fusion, 'arm', arm)
+	steps = [flow('ssc'), useqFISH.imaging_step(0, 'Min_5channel')]
+	assert useqFISH.check_plan_state(steps) == []
+	assert armed == ['Min_5channel']
+	errors = useqFISH.check_plan_state([useqFISH.imaging_step(0, 'Misspelled')])
+	assert errors == ['Fusion protocols could not be selected: selected protocol reads back as Min_5channel']
+
+def test_running_pump_rejects_an_edit(rig):
+	rig.pump.startFlow(20)
+	assert useqFISH.check_plan_state([flow('ssc')]) == ['pump is still running']
+
+def test_abort_goes_to_the_pause_control(tmp_path):
+	import deadline
+	from pause import PauseControl
+	pause_control = PauseControl()
+	plan_control = plan.PlanControl([flow('ssc')], str(tmp_path / 'plan.json'), useqFISH.validate_plan,
+		pause_control=pause_control)
+	try:
+		assert plan_control.handleRequest({'command': 'abort', 'reason': 'leak'}) == {'ok': True, 'changed': True}
+		assert pause_control.cancelled == 'leak'
+	finally:
+		deadline.reset()
+	no_pause = control(tmp_path, [flow('ssc')])
+	assert no_pause.handleRequest({'command': 'abort'})['ok'] is False
@@ -0,0 +1,63 @@
+# -------------------------------------------------------------------
+# Preflight checks (preflight.py) and cancel scopes (deadline.py)
+# -------------------------------------------------------------------
+import threading
+
+import pytest
+
+import deadline
+import preflight
+
+def test_late_check_is_cancelled_before_the_report():
+	stopped = threading.Event()
+	def stuck():
+		try:
+			wait = deadline.Deadline(60, deadline.DeviceTimeout, 'stuck device')
+			while True:
+				wait.sleep(0.05) # polling a device that never answers
+		finally:
+			stopped.set()
+	results = preflight.run_checks([('quick', lambda: (True, 'fine'), 5), ('stuck', stuck, 0.2)])
+	assert stopped.is_set() # nothing left running once the report is out
+	assert [(name, ok) for name, ok, detail, seconds in results] == [('quick', True), ('stuck', False)]
+	assert results[1][2] == 'no answer within 0.2 s'
+	assert not deadline.cancelled() # only the late check was cancelled
+
+def test_cancel_scope_only_stops_its_own_thread():
+	event = threading.Event()
+	event.set()
+	with deadline.cancel_scope(event):
+		with pytest.raises(deadline.Cancelled):
+			deadline.Deadline(1).check()
+	deadline.Deadline(1).check()
+
+def test_report_fails_if_any_check_fails():
+	report = preflight.format_report([('valves', True, '2 valves', 0.1), ('pump', False, 'no remote', 0.2)])
+	assert report.splitlines()[0] == 'Preflight FAIL'
+
+# -------------------------------------------------------------------
+# Pump check of useqFISH.preflight on a fake GSIOC line
+# -------------------------------------------------------------------
+from conftest import FakeGSIOC
+
+import gilsonMP3
+import useqFISH
+
+def pump_check(monkeypatch, running=None, speed=0.0):
+	line = FakeGSIOC()
+	pump = gilsonMP3.APump(verbose=False, transport=line, verify_interval=None)
+	line.units[30].update(running=running, speed=speed)
+	monkeypatch.setattr(useqFISH, 'pump', pump, raising=False)
+	return useqFISH.preflight_pump()
+
+def test_stopped_pump_passes(monkeypatch):
+	assert pump_check(monkeypatch)[0] is True
+	assert pump_check(monkeypatch, running='K<')[0] is True # forward (flipped), speed 0
+
+def test_running_pump_fails(monkeypatch):
+	ok, detail = pump_check(monkeypatch, running='K<', speed=20.0)
+	assert not ok and 'running' in detail
+
+def test_pump_set_to_reverse_fails(monkeypatch):
+	ok, detail = pump_check(monkeypatch, running='K>')
+	assert not ok and detail == 'pump set to run reverse'
@@ -0,0 +1,51 @@
+# -------------------------------------------------------------------
+# Device timeouts: recovery (useqFISH.recover_device) and the Fusion
+#	wait budget (fusionrest)
+# -------------------------------------------------------------------
+import time
+
+import pytest
+
+import deadline
+import fusionrest
+import gilsonMP3
+import hamilton
+import useqFISH
+
+def test_timed_out_devices_are_recovered_then_escalated(rig, monkeypatch):
+	calls = []
+	monkeypatch.setattr(rig.valves, 'recoverConnection', lambda: calls.append('valves'), raising=False)
+	monkeypatch.setattr(rig.pump, 'disconnect', lambda: calls.append('pump'), raising=False)
+	monkeypatch.setattr(useqFISH, 'timeout_retries', 1)
+	assert useqFISH.recover_device(hamilton.ValveTimeout('Valve 0 movement', 60), 1) is True
+	assert useqFISH.recover_device(gilsonMP3.PumpTimeout('Pump unit 30 select', 30), 1) is True
+	assert calls == ['valves', 'pump']
+	assert useqFISH.recover_device(hamilton.ValveTimeout('Valve 0 movement', 60), 2) is False
+	assert calls == ['valves', 'pump'] # out of retries: not recovered again
+
+def test_failed_recovery_stops_the_retries(rig, monkeypatch):
+	def unplugged():
+		raise OSError('pump port gone')
+	monkeypatch.setattr(rig.pump, 'disconnect', unplugged, raising=False)
+	assert useqFISH.recover_device(gilsonMP3.PumpTimeout('Pump unit 30 select', 30), 1) is False
+
+def test_fusion_wait_that_ran_out_is_not_retried(monkeypatch):
+	calls = []
+	monkeypatch.setattr(deadline, 'recovery', lambda error, attempt: calls.append(error) or True)
+	client = fusionrest.FusionClient()
+	monkeypatch.setattr(client, '_get_state', lambda: 'Running')
+	started = time.monotonic()
+	with pytest.raises(fusionrest.FusionTimeout):
+		client.wait_until_state('Idle', 0.05, timeout=0.2)
+	assert calls == [] # surfaced, not waited for again
+	assert time.monotonic() - started < 0.4
+
+def test_paused_time_does_not_count_against_the_fusion_budget(monkeypatch):
+	monkeypatch.setattr(deadline, 'recovery', None)
+	client = fusionrest.FusionClient()
+	states = iter(['Running'] + ['Paused'] * 16 + ['Running', 'Idle'])
+	monkeypatch.setattr(client, '_get_state', lambda: next(states))
+	client.wait_until_state('Idle', 0.05, timeout=0.5) # about 0.9 s, 0.8 of it paused
+	states = iter(['Running'] * 40)
+	with pytest.raises(fusionrest.FusionTimeout):
+		client.wait_until_state('Idle', 0.05, timeout=0.5)
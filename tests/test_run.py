@@ -0,0 +1,23 @@
+# -------------------------------------------------------------------
+# Whole runs of useqFISH.run_sequencing on the sweep simulators
+# -------------------------------------------------------------------
+import json
+
+import pytest
+
+import plan
+import useqFISH
+
+def journal_events(tmp_path):
+	[path] = tmp_path.glob('journal_*.jsonl')
+	with open(path) as journal_file:
+		return [json.loads(line)['event'] for line in journal_file]
+
+def test_bad_plan_raises_and_closes_the_journal(rig, tmp_path, monkeypatch):
+	monkeypatch.chdir(tmp_path)
+	plan.save_plan([{'step': 'flow', 'reagent': 'nonexistent'}], str(tmp_path / 'bad.json'))
+	with pytest.raises(ValueError, match='Invalid plan'):
+		useqFISH.run_sequencing(1, 'sweep', expt_name='bad', resume_plan=str(tmp_path / 'bad.json'))
+	assert useqFISH.run_journal is None
+	assert journal_events(tmp_path) == ['run_started', 'run_failed']
+	assert rig.pump.flow_status == 'Stopped'
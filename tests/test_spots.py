@@ -0,0 +1,43 @@
+# -------------------------------------------------------------------
+# Background spot detection (spots.py) and its status provider
+# -------------------------------------------------------------------
+import json
+import os
+
+import numpy as np
+
+import spots
+import useqFISH
+
+def spot_image(positions, shape=(64, 64)):
+	image = np.zeros(shape, dtype=np.float32)
+	y, x = np.mgrid[:shape[0], :shape[1]]
+	for py, px in positions:
+		image += 100 * np.exp(-((y - py)**2 + (x - px)**2) / (2 * 1.5**2))
+	return image[np.newaxis] # (z, y, x)
+
+def write(path, array, modified):
+	np.save(path, array)
+	os.utime(path, (modified, modified))
+
+def test_rounds_are_counted_from_their_own_acquisition(tmp_path):
+	write(tmp_path / 'r0_F0.npy', spot_image([(10, 10), (30, 40)]), 100)
+	write(tmp_path / 'r1_F0.npy', spot_image([(20, 20), (40, 10), (50, 50)]), 200)
+	detector = spots.SpotDetector(str(tmp_path / '*.npy'), channels=[0])
+	detector.submit(0, 'reader1', 50, 150)
+	detector.submit(1, 'reader2', 150, 250)
+	detector.close()
+	assert detector.errors == []
+	assert detector.totals() == {'reader': {'reader1': 2, 'reader2': 3}, 'position': {0: 5},
+								 'round': {0: 2, 1: 3}}
+	assert len(detector.table) == 5
+
+def test_running_totals_are_on_the_status_snapshot(tmp_path, monkeypatch):
+	write(tmp_path / 'r0_F0.npy', spot_image([(10, 10)]), 100)
+	detector = spots.SpotDetector(str(tmp_path / '*.npy'), channels=[0])
+	detector.submit(0, 'reader1', 50, 150)
+	detector.close()
+	monkeypatch.setattr(useqFISH, 'spot_detector', detector)
+	monkeypatch.setattr(useqFISH, 'pump_telemetry', None)
+	totals = useqFISH.status_providers()['spots']()
+	assert json.loads(json.dumps(totals)) == {'reader': {'reader1': 1}, 'position': {'0': 1}, 'round': {'0': 1}}
@@ -0,0 +1,50 @@
+# -------------------------------------------------------------------
+# Run status snapshot and HTTP endpoint (status.py)
+# -------------------------------------------------------------------
+import json
+import urllib.error
+import urllib.request
+
+import pytest
+
+import status
+
+def get(server, path='/status'):
+	with urllib.request.urlopen('http://127.0.0.1:%d%s' % (server.server_address[1], path), timeout=5) as response:
+		return response.headers['Content-Type'], json.loads(response.read())
+
+def test_snapshot_is_served_from_the_cache():
+	calls = []
+	def valves():
+		calls.append(1)
+		return [7, 1]
+	run_status = status.RunStatus(providers={'valves': valves}, max_age=60)
+	run_status.update(step='flow', round=2, reagent='ssc')
+	run_status.event({'event': 'flow', 'reagent': 'ssc'})
+	run_status.event({'event': 'pump_alarm', 'kind': 'stalled'})
+	server = status.StatusServer(run_status, port=0)
+	try:
+		content_type, snapshot = get(server)
+		assert content_type == 'application/json'
+		assert (snapshot['step'], snapshot['round'], snapshot['reagent']) == ('flow', 2, 'ssc')
+		assert snapshot['valves'] == [7, 1]
+		assert [entry['event'] for entry in snapshot['recent_events']] == ['flow', 'pump_alarm']
+		assert [entry['event'] for entry in snapshot['recent_errors']] == ['pump_alarm']
+
+		assert get(server, '/')[1] == snapshot # from the cache
+		assert len(calls) == 1
+
+		run_status.update(round=3) # an update drops the cache
+		assert get(server)[1]['round'] == 3
+		assert len(calls) == 2
+
+		with pytest.raises(urllib.error.HTTPError):
+			get(server, '/other')
+	finally:
+		server.close()
+
+def test_failing_provider_is_reported_in_the_snapshot():
+	def fusion():
+		raise ConnectionError('no state yet')
+	snapshot = status.RunStatus(providers={'fusion': fusion}).snapshot()
+	assert snapshot['fusion'] == {'error': 'no state yet'}
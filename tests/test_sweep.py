@@ -0,0 +1,48 @@
+# -------------------------------------------------------------------
+# Protocol sweep on the simulated rig (sweep.py)
+# -------------------------------------------------------------------
+import pytest
+
+import sweep
+import useqFISH
+
+variant = {'speed': 30, 'volumes': [500, 500, 250], 'ssc_repeats': 3, 'flush': 'all'}
+
+# useqFISH is left as simulate() found it
+@pytest.fixture(autouse=True)
+def unchanged_module():
+	before = {name: getattr(useqFISH, name, None) for name in sweep.simulated_globals}
+	defined = [name for name in sweep.simulated_globals if hasattr(useqFISH, name)]
+	before_time_pumping = list(useqFISH.time_pumping)
+	yield
+	assert [name for name in sweep.simulated_globals if hasattr(useqFISH, name)] == defined
+	for name, value in before.items():
+		assert getattr(useqFISH, name, None) is value, name
+	assert useqFISH.time_pumping == before_time_pumping
+
+def test_simulate_delivers_the_variant_volumes():
+	result = sweep.simulate(variant, num_rounds=1)
+	assert abs(result['min_volume'] - 500) < 1 # flush deliveries are not counted
+	assert result['acquisitions'] == 4
+	assert sweep.violations(result, sweep.default_minimums) == []
+
+def test_variants_do_not_leak_into_each_other():
+	# a worker process runs many variants one after the other
+	first = sweep.simulate(variant, num_rounds=1)
+	sweep.simulate(dict(variant, speed=48, volumes=[600, 630, 300]), num_rounds=1)
+	again = sweep.simulate(variant, num_rounds=1)
+	assert again['wall_time'] == first['wall_time']
+	assert again['total_volume'] == first['total_volume']
+
+def test_globals_are_restored_when_a_variant_fails(monkeypatch):
+	def broken_step(step, next_reagent=None):
+		raise RuntimeError('step failed')
+	monkeypatch.setattr(useqFISH, 'run_step', broken_step)
+	with pytest.raises(RuntimeError):
+		sweep.simulate(variant, num_rounds=1)
+	assert useqFISH.time is not None and not isinstance(useqFISH.time, sweep.VirtualClock)
+
+def test_pareto_front():
+	results = [{'wall_time': 3, 'total_volume': 10}, {'wall_time': 1, 'total_volume': 30},
+			   {'wall_time': 2, 'total_volume': 20}, {'wall_time': 4, 'total_volume': 25}]
+	assert [result['wall_time'] for result in sweep.pareto_front(results)] == [1, 2, 3]
@@ -0,0 +1,71 @@
+# -------------------------------------------------------------------
+# Run-wide tracing (tracing.py)
+# -------------------------------------------------------------------
+import os
+import threading
+
+import pytest
+
+import tracing
+
+def event(name, category, ts, dur, tid=1, **args):
+	event = {'name': name, 'cat': category, 'ph': 'X', 'pid': 1, 'tid': tid, 'ts': ts * 1e6, 'dur': dur * 1e6}
+	if args:
+		event['args'] = args
+	return event
+
+# run 0-100 s: ssc 0-50 (pumping 0-20, incubation 20-50), imaging 60-90;
+#	a drift check on another thread, 50-80
+trace = [event('run', 'run', 0, 100),
+		 event('ssc', 'reaction', 0, 50, nominal=45),
+		 event('pumping', 'pumping', 0, 20),
+		 event('incubation', 'incubation', 20, 30),
+		 event('imaging', 'acquisition', 60, 30),
+		 event('drift', 'qc', 50, 30, tid=2)]
+
+def test_self_times_leave_out_nested_spans():
+	timed = {item[0]['name']: (item[1] / 1e6, item[2]) for item in tracing.self_times(trace)}
+	assert timed == {'run': (20, 0), 'ssc': (0, 1), 'pumping': (20, 2), 'incubation': (30, 2),
+					 'imaging': (30, 1), 'drift': (30, 0)}
+
+def test_summary_and_critical_path():
+	summary = tracing.summarize({'traceEvents': trace})
+	assert summary['categories']['run'] == {'count': 1, 'total': 100, 'self': 20}
+	assert summary['overhead'] == {'reaction:ssc': {'count': 1, 'nominal': 45, 'measured': 50, 'overhead': 5}}
+	critical_path = summary['critical_path']
+	assert critical_path['seconds'] == 100
+	assert 'qc' not in critical_path['categories'] # other thread, the run did not wait on it
+	assert sum(critical_path['categories'].values()) == pytest.approx(100)
+	assert critical_path['longest'][0] == ('ssc', 'reaction', 50)
+	text = tracing.format_summary(summary)
+	assert 'Critical path: 100.0 s' in text
+	assert 'reaction:ssc' in text
+
+def test_empty_trace():
+	assert tracing.summarize([])['critical_path'] is None
+
+def test_spans_are_exported_as_chrome_trace_events(monkeypatch):
+	monkeypatch.setattr(tracing, 'active', None)
+	tracer = tracing.start()
+	try:
+		@tracing.traced('valve')
+		def changePort():
+			pass
+		with tracing.span('ssc', 'reaction', nominal=5):
+			changePort()
+	finally:
+		assert tracing.stop() is tracer
+	exported = tracer.chromeTrace()
+	events = [event for event in exported['traceEvents'] if event['ph'] == 'X']
+	assert [(event['name'], event['cat']) for event in events] == [
+		('test_spans_are_exported_as_chrome_trace_events.<locals>.changePort', 'valve'), ('ssc', 'reaction')]
+	outer = events[1]
+	assert outer['args'] == {'nominal': 5}
+	assert 'args' not in events[0]
+	assert outer['pid'] == os.getpid() and outer['tid'] == threading.get_ident()
+	assert outer['ts'] <= events[0]['ts'] and events[0]['dur'] <= outer['dur']
+	[metadata] = [event for event in exported['traceEvents'] if event['ph'] == 'M']
+	assert metadata['name'] == 'thread_name' and metadata['args']['name'] == threading.current_thread().name
+	with tracing.span('off', 'none') as args: # no tracer: nothing recorded
+		pass
+	assert len(tracer.events) == 2
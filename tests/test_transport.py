@@ -0,0 +1,46 @@
+# -------------------------------------------------------------------
+# Serial traces: recording and replay (transport.py)
+# -------------------------------------------------------------------
+import pytest
+
+import transport
+
+class LoopbackPort():
+	def __init__(self):
+		self.buffer = b''
+
+	def write(self, data):
+		self.buffer += data
+		return len(data)
+
+	def read(self, size=1):
+		data, self.buffer = self.buffer[:size], self.buffer[size:]
+		return data
+
+	def close(self):
+		pass
+
+def test_records_are_readable_before_the_trace_is_closed(tmp_path):
+	path = str(tmp_path / 'trace.bin')
+	port = transport.RecordingTransport(LoopbackPort(), path, sync_every=2)
+	port.write(b'aLQP\r')
+	assert port.read(64) == b'aLQP\r'
+	port.read(64)
+	records = transport.read_trace(path) # as after a crash: nothing closed
+	assert [(direction, data) for seconds, direction, data in records] == [
+		(transport.WRITE, b'aLQP\r'), (transport.READ, b'aLQP\r'), (transport.READ, b'')]
+	port.close()
+
+def test_replay_checks_what_the_driver_writes(tmp_path):
+	path = str(tmp_path / 'trace.bin')
+	port = transport.RecordingTransport(LoopbackPort(), path)
+	port.write(b'aF\r')
+	port.read(64)
+	port.close()
+	replay = transport.ReplayTransport(path)
+	assert replay.read(64) == b'' # nothing before the query
+	replay.write(b'aF\r')
+	assert replay.read(64) == b'aF\r'
+	assert replay.finished()
+	with pytest.raises(transport.ReplayMismatch):
+		transport.ReplayTransport(path).write(b'bF\r')
@@ -0,0 +1,207 @@
+# # !/usr/bin/env python3
+
+# -------------------------------------------------------------------
+# Run-wide tracing
+#	Spans (name, category, start, duration, thread) are collected by
+#	the active Tracer and exported as Chrome trace / Perfetto JSON
+#	(load in chrome://tracing or ui.perfetto.dev). With no active
+#	tracer, span() and @traced cost one global lookup.
+#
+#	summarize() reports per category the total and the self time
+#	(time not spent in nested spans), overhead against the nominal
+#	time of spans that carry one, and the critical path: the spans of
+#	the thread running the root span, which is what the run waits on.
+#
+#	python tracing.py trace_<expt>_<date>.json
+# -------------------------------------------------------------------
+
+# -------------------------------------------------------------------
+# Import
+# -------------------------------------------------------------------
+import contextlib
+import functools
+import json
+import os
+import sys
+import threading
+import time
+
+active = None # Tracer receiving spans, None = tracing off
+
+# -------------------------------------------------------------------
+# Tracer Class Definition
+# -------------------------------------------------------------------
+class Tracer():
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.events = []
+		self.start_time = time.perf_counter()
+		self.wall_start = time.time()
+
+	# ------------------------------------------------------------------
+	# Add a finished span (perf_counter start/end)
+	# ------------------------------------------------------------------
+	def record(self, name, category, start, end, args=None):
+		event = {'name': name, 'cat': category, 'ph': 'X', 'pid': os.getpid(),
+				 'tid': threading.get_ident(),
+				 'ts': (start - self.start_time) * 1e6, 'dur': (end - start) * 1e6}
+		if args:
+			event['args'] = args
+		with self.lock:
+			self.events.append(event)
+
+	# ------------------------------------------------------------------
+	# Chrome trace JSON object, thread names included
+	# ------------------------------------------------------------------
+	def chromeTrace(self):
+		with self.lock:
+			events = list(self.events)
+		names = {thread.ident: thread.name for thread in threading.enumerate()}
+		metadata = [{'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(), 'tid': tid,
+					 'args': {'name': names.get(tid, str(tid))}}
+					for tid in sorted(set(event['tid'] for event in events))]
+		return {'traceEvents': metadata + events, 'displayTimeUnit': 'ms',
+				'otherData': {'wall_start': self.wall_start}}
+
+	def save(self, path):
+		with open(path, 'w') as trace_file:
+			json.dump(self.chromeTrace(), trace_file)
+
+# -------------------------------------------------------------------
+# Start/stop tracing for the whole process
+# -------------------------------------------------------------------
+def start():
+	global active
+	active = Tracer()
+	return active
+
+def stop():
+	global active
+	tracer, active = active, None
+	return tracer
+
+# -------------------------------------------------------------------
+# Span context manager: with span('changePort', 'valve', valve=0): ...
+# -------------------------------------------------------------------
+@contextlib.contextmanager
+def _span(tracer, name, category, args):
+	start = time.perf_counter()
+	try:
+		yield args
+	finally:
+		tracer.record(name, category, start, time.perf_counter(), args)
+
+def span(name, category, **args):
+	tracer = active
+	if tracer is None:
+		return contextlib.nullcontext(args)
+	return _span(tracer, name, category, args)
+
+# -------------------------------------------------------------------
+# Decorator tracing every call of a function or method
+# -------------------------------------------------------------------
+def traced(category, name=None):
+	def decorate(function):
+		span_name = name or function.__qualname__
+		@functools.wraps(function)
+		def wrapper(*args, **kwargs):
+			tracer = active
+			if tracer is None:
+				return function(*args, **kwargs)
+			with _span(tracer, span_name, category, None):
+				return function(*args, **kwargs)
+		return wrapper
+	return decorate
+
+# -------------------------------------------------------------------
+# Self time of every span: its duration minus that of directly nested
+#	spans on the same thread. Returns [(event, self_us, depth), ...]
+# -------------------------------------------------------------------
+def self_times(events):
+	spans = [event for event in events if event.get('ph') == 'X']
+	spans.sort(key=lambda event: (event['tid'], event['ts'], -event['dur']))
+	children = [0.0] * len(spans)
+	depths = [0] * len(spans)
+	stack = [] # indices of open spans on the current thread
+	for i, event in enumerate(spans):
+		while stack and (spans[stack[-1]]['tid'] != event['tid']
+				or spans[stack[-1]]['ts'] + spans[stack[-1]]['dur'] <= event['ts']):
+			stack.pop()
+		if stack:
+			children[stack[-1]] += event['dur']
+			depths[i] = len(stack)
+		stack.append(i)
+	return [(event, max(0.0, event['dur'] - children[i]), depths[i]) for i, event in enumerate(spans)]
+
+# -------------------------------------------------------------------
+# Summary of a trace (Chrome trace JSON object or list of events)
+#	root: name of the span covering the run (its thread is the
+#		critical path); the longest span is used if it is not found
+# -------------------------------------------------------------------
+def summarize(trace, root='run', top=10):
+	events = trace['traceEvents'] if isinstance(trace, dict) else trace
+	timed = self_times(events)
+	if not timed:
+		return {'categories': {}, 'overhead': {}, 'critical_path': None}
+
+	categories = {}
+	for event, self_us, depth in timed:
+		entry = categories.setdefault(event['cat'], {'count': 0, 'total': 0.0, 'self': 0.0})
+		entry['count'] += 1
+		entry['total'] += event['dur'] / 1e6
+		entry['self'] += self_us / 1e6
+
+	overhead = {}
+	for event, self_us, depth in timed:
+		nominal = (event.get('args') or {}).get('nominal')
+		if nominal is None:
+			continue
+		entry = overhead.setdefault(event['cat'] + ':' + event['name'],
+									{'count': 0, 'nominal': 0.0, 'measured': 0.0})
+		entry['count'] += 1
+		entry['nominal'] += nominal
+		entry['measured'] += event['dur'] / 1e6
+	for entry in overhead.values():
+		entry['overhead'] = entry['measured'] - entry['nominal']
+
+	roots = [event for event, self_us, depth in timed if event['name'] == root and depth == 0]
+	root_event = max(roots or [event for event, self_us, depth in timed], key=lambda event: event['dur'])
+	on_path = [(event, self_us) for event, self_us, depth in timed
+			   if event['tid'] == root_event['tid'] and event['ts'] >= root_event['ts']
+			   and event['ts'] + event['dur'] <= root_event['ts'] + root_event['dur']]
+	path_categories = {}
+	for event, self_us in on_path:
+		path_categories[event['cat']] = path_categories.get(event['cat'], 0.0) + self_us / 1e6
+	longest = sorted(on_path, key=lambda item: -item[0]['dur'])
+	longest = [(event['name'], event['cat'], event['dur'] / 1e6) for event, self_us in longest
+			   if event is not root_event][:top]
+	critical_path = {'seconds': root_event['dur'] / 1e6, 'categories': path_categories,
+					 'longest': longest}
+	return {'categories': categories, 'overhead': overhead, 'critical_path': critical_path}
+
+# -------------------------------------------------------------------
+# Summary as text
+# -------------------------------------------------------------------
+def format_summary(summary):
+	lines = ['Time per category (s)', '   %-20s %7s %12s %12s' % ('category', 'spans', 'total', 'self')]
+	for category, entry in sorted(summary['categories'].items(), key=lambda item: -item[1]['self']):
+		lines.append('   %-20s %7d %12.1f %12.1f' % (category, entry['count'], entry['total'], entry['self']))
+	if summary['overhead']:
+		lines.append('Overhead over nominal time (s)')
+		for key, entry in sorted(summary['overhead'].items(), key=lambda item: -item[1]['overhead']):
+			lines.append('   %-30s %5d spans, nominal %10.1f, measured %10.1f, overhead %+8.1f' % (
+				key, entry['count'], entry['nominal'], entry['measured'], entry['overhead']))
+	critical_path = summary['critical_path']
+	if critical_path is not None:
+		lines.append('Critical path: %.1f s' % critical_path['seconds'])
+		for category, seconds in sorted(critical_path['categories'].items(), key=lambda item: -item[1]):
+			lines.append('   %-20s %12.1f s  %5.1f %%' % (category, seconds,
+				100 * seconds / max(critical_path['seconds'], 1e-9)))
+		lines.append('   longest spans:')
+		for name, category, seconds in critical_path['longest']:
+			lines.append('      %10.1f s  %-15s %s' % (seconds, category, name))
+	return '\n'.join(lines)
+
+if __name__ == '__main__':
+	with open(sys.argv[1]) as trace_file:
+		print(format_summary(summarize(json.load(trace_file))))
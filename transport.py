@@ -0,0 +1,275 @@
+# # !/usr/bin/env python3
+
+# -------------------------------------------------------------------
+# Serial transports for the device drivers
+#	RecordingTransport wraps an open serial port and writes every
+#	write/read (with timestamps) to a compact binary trace file.
+#	ReplayTransport plays a trace back as a fake serial port, so the
+#	HamiltonMVP/APump drivers can be run and benchmarked off the rig.
+#	ReconnectingTransport reopens a port that failed (e.g. after a
+#	USB-serial adapter reset) and tells the driver, which re-checks the
+#	device state and replays the command that was cut off if needed.
+#
+#	Trace file: MAGIC, then one record per call:
+#		<d: seconds since start> <B: 0 = write, 1 = read> <H: length> <bytes>
+# -------------------------------------------------------------------
+
+# -------------------------------------------------------------------
+# Import
+# -------------------------------------------------------------------
+import os
+import struct
+import sys
+import threading
+import time
+
+import deadline
+
+MAGIC = b'SERTRACE1\n'
+WRITE = 0
+READ = 1
+record_header = struct.Struct('<dBH')
+
+on_reconnect = None # function(what, attempts, error) called after a port is reopened
+
+# -------------------------------------------------------------------
+# Read all records of a trace: [(seconds, direction, data), ...]
+# -------------------------------------------------------------------
+def read_trace(path):
+	with open(path, 'rb') as trace_file:
+		content = trace_file.read()
+	if not content.startswith(MAGIC):
+		raise ValueError('Not a serial trace: ' + path)
+	records = []
+	offset = len(MAGIC)
+	while offset + record_header.size <= len(content):
+		seconds, direction, length = record_header.unpack_from(content, offset)
+		offset += record_header.size
+		records.append((seconds, direction, content[offset:offset + length]))
+		offset += length
+	return records
+
+# -------------------------------------------------------------------
+# Recording Transport Class Definition
+#	Anything not recorded (close, timeout, ...) goes to the wrapped port
+#	Every record is flushed to the OS as it is written, and synced to
+#	disk every sync_every records, so a crash or power cut loses at
+#	most the last few records (the ones that explain it)
+# -------------------------------------------------------------------
+class RecordingTransport():
+	def __init__(self, port, trace_path, sync_every=50):
+		self.port = port
+		self.trace_path = trace_path
+		self.sync_every = sync_every
+		self.lock = threading.Lock()
+		self.trace_file = open(trace_path, 'wb')
+		self.trace_file.write(MAGIC)
+		self.trace_file.flush()
+		self.records = 0
+		self.start_time = time.monotonic()
+
+	def __getattr__(self, name):
+		return getattr(self.port, name)
+
+	def _record(self, direction, data):
+		with self.lock:
+			self.trace_file.write(record_header.pack(time.monotonic() - self.start_time,
+				direction, len(data)) + data)
+			self.trace_file.flush()
+			self.records += 1
+			if self.records % self.sync_every == 0:
+				os.fsync(self.trace_file.fileno())
+
+	def write(self, data):
+		self._record(WRITE, bytes(data))
+		return self.port.write(data)
+
+	def read(self, size=1):
+		data = self.port.read(size)
+		self._record(READ, bytes(data)) # empty reads (timeouts) are kept too
+		return data
+
+	def flush(self):
+		with self.lock:
+			self.trace_file.flush()
+		return self.port.flush()
+
+	def close(self):
+		with self.lock:
+			self.trace_file.close()
+		self.port.close()
+
+# -------------------------------------------------------------------
+# Port was reopened: the transaction in progress was lost, the device
+#	state has to be checked before going on
+# -------------------------------------------------------------------
+class Reconnected(Exception):
+	pass
+
+# -------------------------------------------------------------------
+# Reconnecting Transport Class Definition
+#	open_port() returns a new open port (e.g. serial.Serial(...)).
+#	A write or read that raises OSError (serial.SerialException is
+#	one) closes the port and reopens it, waiting delay, 2*delay, ...
+#	(at most max_delay) between attempts; after `attempts` attempts
+#	without a successful write or read in between (a port that reopens
+#	but keeps failing counts too) the original error is raised.
+#	Once reopened the call
+#	raises Reconnected instead of being retried, since only the driver
+#	knows which commands are safe to send again.
+# -------------------------------------------------------------------
+class ReconnectingTransport():
+	def __init__(self, open_port, what='serial port', attempts=8, delay=0.5, max_delay=10):
+		self.open_port = open_port
+		self.what = what
+		self.attempts = attempts
+		self.delay = delay
+		self.max_delay = max_delay
+		self.reconnects = 0
+		self.failed_attempts = 0 # since the last successful write/read
+		self.closed = False
+		self.port = open_port()
+
+	def __getattr__(self, name):
+		return getattr(self.port, name)
+
+	# ------------------------------------------------------------------
+	# Reopen the port after `error`, raises Reconnected when done
+	# ------------------------------------------------------------------
+	def reconnect(self, error):
+		if self.closed:
+			raise error
+		print('!!!!! ' + self.what + ' failed (' + str(error) + '), reopening')
+		try:
+			self.port.close()
+		except OSError:
+			pass
+		while self.failed_attempts < self.attempts:
+			delay = min(self.delay * 2 ** self.failed_attempts, self.max_delay)
+			self.failed_attempts += 1
+			attempt = self.failed_attempts
+			if deadline.wait_cancelled(delay):
+				raise deadline.Cancelled(self.what + ' reconnect cancelled')
+			try:
+				self.port = self.open_port()
+			except OSError as ex:
+				print('!!!!! ' + self.what + ' reopen attempt ' + str(attempt) + ' failed: ' + str(ex))
+				continue
+			self.reconnects += 1
+			print('>>>>> ' + self.what + ' reopened after ' + str(attempt) + ' attempt(s)')
+			if on_reconnect is not None:
+				on_reconnect(self.what, attempt, error)
+			raise Reconnected(self.what + ' reopened') from error
+		raise error
+
+	def write(self, data):
+		try:
+			written = self.port.write(data)
+		except OSError as ex:
+			self.reconnect(ex)
+		self.failed_attempts = 0
+		return written
+
+	def read(self, size=1):
+		try:
+			data = self.port.read(size)
+		except OSError as ex:
+			self.reconnect(ex)
+		self.failed_attempts = 0
+		return data
+
+	def flush(self):
+		try:
+			return self.port.flush()
+		except OSError as ex:
+			self.reconnect(ex)
+
+	def close(self):
+		self.closed = True
+		self.port.close()
+
+# -------------------------------------------------------------------
+# Replay mismatch: the driver wrote something the device never saw
+# -------------------------------------------------------------------
+class ReplayMismatch(Exception):
+	pass
+
+# -------------------------------------------------------------------
+# Replay Transport Class Definition
+#	Writes are checked against the recorded byte stream (chunking may
+#	differ from the recording). Device bytes become readable once the
+#	host bytes written before them in the trace have been written;
+#	a read with nothing available returns b'' like a serial timeout.
+#	realtime=True reproduces the recorded device timing (for
+#	benchmarks), otherwise replay runs as fast as possible.
+# -------------------------------------------------------------------
+class ReplayTransport():
+	def __init__(self, trace_path, realtime=False, timeout=1):
+		self.realtime = realtime
+		self.timeout = timeout
+		self.is_open = True
+
+		expected = bytearray() # all host bytes of the trace
+		self.device_chunks = [] # (host bytes written before, seconds, data)
+		self.first_write_time = None
+		for seconds, direction, data in read_trace(trace_path):
+			if direction == WRITE:
+				if self.first_write_time is None:
+					self.first_write_time = seconds
+				expected += data
+			elif data:
+				self.device_chunks.append((len(expected), seconds, data))
+		self.expected = bytes(expected)
+
+		self.written = 0
+		self.next_chunk = 0
+		self.available = b''
+		self.available_time = 0.0
+		self.start_time = None
+
+	def _release(self):
+		while (self.next_chunk < len(self.device_chunks)
+				and self.device_chunks[self.next_chunk][0] <= self.written):
+			written_before, seconds, data = self.device_chunks[self.next_chunk]
+			self.available += data
+			self.available_time = seconds - (self.first_write_time or 0.0)
+			self.next_chunk += 1
+
+	def write(self, data):
+		data = bytes(data)
+		if self.start_time is None:
+			self.start_time = time.monotonic()
+		expected = self.expected[self.written:self.written + len(data)]
+		if data != expected:
+			raise ReplayMismatch('At host byte %d wrote %r, trace has %r' % (self.written, data, expected))
+		self.written += len(data)
+		self._release()
+		return len(data)
+
+	def read(self, size=1):
+		self._release()
+		if not self.available:
+			if self.realtime:
+				time.sleep(self.timeout)
+			return b''
+		if self.realtime and self.start_time is not None:
+			time.sleep(max(0.0, self.start_time + self.available_time - time.monotonic()))
+		data = self.available[:size]
+		self.available = self.available[size:]
+		return data
+
+	def finished(self):
+		return self.written == len(self.expected) and self.next_chunk == len(self.device_chunks)
+
+	def flush(self):
+		pass
+
+	def close(self):
+		self.is_open = False
+
+# -------------------------------------------------------------------
+# Print a trace: python transport.py trace_file
+# -------------------------------------------------------------------
+if __name__ == '__main__':
+	for seconds, direction, data in read_trace(sys.argv[1]):
+		print('%10.4f %s %r' % (seconds, '>' if direction == WRITE else '<', data))
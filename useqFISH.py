@@ -14,11 +14,19 @@
 # Import
 # ----------------------------------------------------------------------
 
+import json
 import sys
 import time
+import threading
 import fusionrest
-from gilsonMP3 import APump # Import pump class
-from hamilton import HamiltonMVP # Import MVP valve chain class
+import tracing # Import run-wide tracing (spans, Chrome trace export)
+import deadline # Import wait budgets/cancellation for device waits
+import transport # Import serial transports (reconnect after port faults)
+from journal import RunJournal # Import structured run journal
+from jsonfile import save_json # Import atomic JSON file writes
+from gilsonMP3 import APump, PumpTimeout # Import pump class
+from hamilton import HamiltonMVP, ValveTimeout # Import MVP valve chain class
+from fluidics import FluidicGraph # Import reagent routing/move planning
 
 import os
 # To do: import XML with protocol/experiment/setup settings so it's not
@@ -86,6 +94,110 @@ fluidics_setup = {
 	'reader8': [1, 8],
 	'flush': [8, 1]
 }
+# Online image QC (drift check, spot detection) reads the images Fusion saves
+#	Set image_pattern to where Fusion saves images
+#	(e.g. 'D:/useqFISH/expt/*.ims'), None disables online QC
+image_pattern = None
+
+# Drift check of each round against round 0, run on the DAPI images
+drift_channel = 0	# DAPI channel index in the Fusion protocol
+drift_downsample = 4
+drift_tolerance = 10	# pixels (full resolution)
+
+# Spot detection of each reader round, run while the next round hybridizes
+spot_channels = [1, 2, 3]	# reader channel indices in the Fusion protocol
+spot_sigma = 1.5	# pixels
+spot_threshold = 5	# robust standard deviations of the DoG image
+spot_min_fraction = 0.3	# warn if a round has fewer spots than this fraction of the median round
+
+# Fusion protocol of the run; the unattended preflight at start also checks
+#	that Fusion is idle and that this protocol can be selected
+imaging_protocol_name = 'Min_5channel'
+
+# Cheaper Fusion protocol (fewer z-planes, binning, fewer channels) for the
+#	post-stripping verification imaging, None always runs the full protocol.
+#	The full protocol is run only if the residual signal, the ratio of the
+#	residual_percentile intensity to the median of the verification images,
+#	is above residual_threshold (or cannot be measured)
+verification_protocol_name = None
+verification_channels = [1, 2, 3]	# reader channel indices in the verification protocol
+residual_percentile = 99.9
+residual_threshold = 2.0
+
+# Valve chain layout: (valve_id, port) -> valve_id feeding that port
+#	valve B (readers) feeds port 1 of valve A, valve A goes to the sample
+#	More valves (up to 16 on the chain) are added with more links, e.g.
+#	(1, 8): 2 if valve C feeds port 8 of valve B
+valve_links = {(0, 1): 1}
+
+# Line priming: during long incubations the next reagent is pumped up to a
+#	bypass junction in front of the flow cell, so the next step only has
+#	to deliver the volume the sample needs.
+#	bypass_valve = (valve_id, port_to_sample, port_to_waste), None disables priming
+bypass_valve = None
+# Dead volume model (ul): tubing of each valve port, between daisy chained
+#	valves, and from valve A to the bypass junction. Single segments can
+#	be set in tubing_volumes, e.g. {('link', 0, 1): 55} (see fluidics.py)
+dead_volume_model = {'port': 15, 'link': 40, 'outlet': 60}
+tubing_volumes = {}
+pump_rate = 500 / time_pumping[0]	# ul/s at speed (see time_pumping)
+prime_margin = 30	# s, incubation left over after priming
+
+# Fluidic graph: routes only through the valves on a reagent's path, so
+#	switching reagents never moves valves that do not matter, and valves
+#	off the active path are pre-moved for the next step during incubation
+fluidic_graph = FluidicGraph(fluidics_setup, valve_links, bypass_valve=bypass_valve,
+	default_volumes=dead_volume_model, volumes=tubing_volumes)
+
+# Local control socket (127.0.0.1) to read or replace the remaining plan of a
+#	live run, None disables it. The plan can also be replaced by writing
+#	plan_<expt>_<date>.edit.json next to the log (see plan.py)
+control_port = 15130
+
+# Background pump telemetry: display samples per second while the pump is
+#	idle between commands (see telemetry.py), None disables it
+telemetry_rate = 0.2
+
+# Local HTTP status endpoint (http://127.0.0.1:<status_port>/status) with a
+#	JSON snapshot of the run, None disables it. Fusion progress is queried
+#	every status_progress_interval s during acquisitions, and
+#	imaging_time_estimate (s) is used for the ETA until the run has timed
+#	an acquisition
+status_port = 15140
+status_progress_interval = 30
+imaging_time_estimate = 20 * 60
+
+# Trace the run (flow, imaging, valve moves, pump and REST calls) and write
+#	trace_<expt>_<date>.json (Chrome trace / Perfetto) with a time
+#	breakdown in the log (see tracing.py)
+trace_run = True
+
+# Longest waits (s) for a device before a typed timeout error is raised
+#	(see deadline.py); a timed out wait is retried timeout_retries times,
+#	after recovering the device (see recover_device), before the error
+#	stops the run
+wait_budgets = {'valve_move': 60, 'valve_status': 60, 'pump_select': 30,
+				'fusion_start': 120, 'fusion_idle': 6 * 3600}
+timeout_retries = 1
+
+# Cleaning cycle (run_flushing): lines are sent to waste through the bypass
+#	valve if one is fitted, otherwise through the flow cell. Progress is
+#	kept in cleaning_state_path until the cycle is complete
+cleaning_destination = 'waste' if bypass_valve is not None else 'sample'
+cleaning_state_path = 'cleaning_state.json'
+
+# Device broker (see broker.py): if set, the valves and pump are used through
+#	the broker on this local port instead of opening COM7/COM8, so status
+#	tools and calibration scripts can share the hardware with the run
+broker_port = None
+
+# Job queue (see jobs.py): if set, __main__ runs the jobs queued in this
+#	directory back to back (python jobs.py add queue sequencing
+#	num_rounds=3 protocol_name=Min_5channel expt_name=...), and waits
+#	job_queue_poll s between looks for new jobs (None: exit when empty)
+job_queue_path = None
+job_queue_poll = None
+
 # FluidicsSetup = {
 # 	'reader1': [1],
 # 	'reader2': [2],
@@ -98,10 +210,219 @@ fluidics_setup = {
 # }
 
 
+# Set up by run_sequencing
+run_journal = None
+drift_monitor = None
+drift_thread = None
+drift_results = []
+spot_detector = None
+pump_telemetry = None
+run_status = None
+imaging_times = []
+primed_reagent = None
+pause_control = None
+fusion_paused = False
+
 # ----------------------------------------------------------------------
 # Define functions
 # ----------------------------------------------------------------------
 
+# Add a record to the structured run journal (if a run is in progress)
+def journal(event, **fields):
+	if run_journal is not None:
+		entry = run_journal.record(event, **fields)
+		if run_status is not None:
+			run_status.event(entry)
+
+# Called when a device wait runs out of time: log it, recover the device
+#	and retry the wait up to timeout_retries times, then let the error
+#	stop the run. Recovery: the valve chain is readdressed if the valves
+#	stopped answering and their positions read back, the pump's GSIOC
+#	line is reset (disconnect, the wait holds the line). A failed
+#	recovery stops the run too. Fusion waits are not retried (see
+#	fusionrest.FusionClient.wait_until_state)
+def recover_device(error, attempt):
+	print(f"!!!!! {error} (attempt {attempt}/{timeout_retries + 1})")
+	journal('device_timeout', what=error.what, seconds=error.seconds, attempt=attempt,
+		error=type(error).__name__)
+	if attempt > timeout_retries:
+		return False
+	try:
+		if isinstance(error, ValveTimeout):
+			MVPchain.recoverConnection()
+		elif isinstance(error, PumpTimeout):
+			pump.disconnect()
+	except Exception as ex:
+		print(f"!!!!! {error.what} could not be recovered: {ex}")
+		journal('device_recovery_failed', what=error.what, error=str(ex))
+		return False
+	journal('device_recovered', what=error.what, attempt=attempt)
+	return True
+
+# Called when a device serial port had to be reopened
+def report_reconnect(what, attempts, error):
+	journal('serial_reconnect', what=what, attempts=attempts, error=str(error))
+
+# Pause/resume of a run (see pause.py), e.g. {"command": "pause"} on the
+#	control socket: the pump is stopped by the pumping timer, a running
+#	Fusion acquisition is paused here
+def pause_devices(reason):
+	global fusion_paused
+	print(f"!!!!! Run paused ({reason}) at {time.strftime('%m-%d-%Y %H:%M:%S', time.localtime())}")
+	journal('paused', reason=reason)
+	update_status(paused=True, pause_reason=reason)
+	try:
+		if fusionrest.get_state() == 'Running':
+			fusionrest.pause()
+			fusion_paused = True
+	except Exception as ex:
+		print(f"!!!!! Fusion could not be paused: {ex}")
+
+def resume_devices(seconds):
+	global fusion_paused
+	if fusion_paused:
+		try:
+			fusionrest.resume()
+		except Exception as ex:
+			print(f"!!!!! Fusion could not be resumed: {ex}")
+		fusion_paused = False
+	print(f">>>>> Run resumed after {seconds:.0f} s")
+	journal('resumed', seconds=seconds)
+	update_status(paused=False, pause_reason=None)
+
+# Stop a Fusion acquisition left running or paused by an aborted run
+def stop_acquisition(log=None):
+	global fusion_paused
+	try:
+		state = fusionrest.get_state()
+		if state in ('Running', 'Paused', 'Waiting'):
+			fusionrest.stop()
+			print(f"!!!!! Fusion acquisition stopped ({state})")
+			print(f"!!!!! Fusion acquisition stopped ({state})", file=log)
+			journal('imaging_stopped', state=state)
+	except Exception as ex:
+		print(f"!!!!! Fusion acquisition could not be stopped: {ex}")
+		print(f"!!!!! Fusion acquisition could not be stopped: {ex}", file=log)
+	fusion_paused = False
+
+# Pump for `seconds` (pump already started on `route`); while paused the
+#	pump is stopped, on resume the valves are set back to `route` and it
+#	pumps for the remaining time. Returns the seconds spent paused
+def pump_for(seconds, route):
+	if pause_control is None:
+		time.sleep(seconds)
+		return 0.0
+	def restart(remaining):
+		MVPchain.changePorts(fluidic_graph.moves(MVPchain.current_port, route))
+		pump.startFlow(speed)
+	return pause_control.wait(seconds, on_pause=pump.stopFlow, on_resume=restart)
+
+# Incubate for `seconds`; paused time counts (the reagent stays on the
+#	sample). Returns the seconds spent paused
+def incubate(seconds):
+	if pause_control is None:
+		time.sleep(seconds)
+		return 0.0
+	return pause_control.wait(seconds, counts_while_paused=True)
+
+# Update the status snapshot (if a run is in progress)
+def update_status(**fields):
+	if run_status is not None:
+		run_status.update(**fields)
+
+# Nominal seconds of plan steps, for the ETA
+def plan_duration(steps):
+	imaging_time = sorted(imaging_times)[len(imaging_times)//2] if imaging_times else imaging_time_estimate
+	seconds = 0
+	for step in steps:
+		if step['step'] == 'flow':
+			seconds += step.get('repeats', 1) * (step.get('time_pumping', 0) + step.get('time_reaction', 0))
+		elif step['step'] == 'imaging':
+			seconds += imaging_time
+	return seconds
+
+# Status providers: only attributes the drivers keep, never the devices
+def status_providers():
+	def fusion():
+		client = fusionrest.default_client()
+		return {'state': client.last_state, 'progress': client.last_progress,
+				'armed': list(client.armed_protocols)}
+	providers = {'valves': lambda: list(MVPchain.current_port),
+				 'pump': lambda: {'flow_status': pump.flow_status, 'speed': pump.speed,
+								  'direction': pump.direction},
+				 'fusion': fusion}
+	if pump_telemetry is not None:
+		providers['pump_telemetry'] = lambda: {'alarms': dict(pump_telemetry.alarms),
+			'latest': pump_telemetry.samples(last=1).tolist()}
+	if spot_detector is not None:
+		providers['spots'] = spot_totals
+	return providers
+
+# Running spot totals per reader, position and round (JSON keys)
+def spot_totals():
+	totals = spot_detector.totals()
+	return {kind: {str(key): count for key, count in counts.items()} for kind, counts in totals.items()}
+
+# Drift check, runs in the background during the SSC wash after imaging
+#	so it is finished before the next reader hybridization
+#	since/until: start and end (time.time()) of the acquisition
+def start_drift_check(round, since, until):
+	global drift_thread
+	
+	def check():
+		try:
+			drift_results.append((round, drift_monitor.check(since, until), None))
+		except Exception as ex:
+			drift_results.append((round, {}, ex))
+	
+	drift_thread = threading.Thread(target=check, daemon=True)
+	drift_thread.start()
+
+# Wait for the drift check of the last imaging and report it
+def finish_drift_check(log=None):
+	global drift_thread
+	if drift_thread is None:
+		return
+	with tracing.span('drift_check', 'qc_wait'):
+		drift_thread.join()
+	drift_thread = None
+
+	for round, results, error in drift_results:
+		if error is not None:
+			print(f"!!!!! Drift check failed for Round #{round+1}: {error}")
+			print(f"!!!!! Drift check failed for Round #{round+1}: {error}", file=log)
+			continue
+		shifts = {str(position): [dy, dx] for position, (dy, dx, peak, flagged) in results.items()}
+		flagged = [position for position, result in results.items() if result[3]]
+		journal('drift', round=round, shifts=shifts, flagged=flagged, tolerance=drift_tolerance)
+		for position in flagged:
+			dy, dx = results[position][:2]
+			print(f"!!!!! Round #{round+1}, position {position} drifted by ({dy:.1f}, {dx:.1f}) px")
+			print(f"!!!!! Round #{round+1}, position {position} drifted by ({dy:.1f}, {dx:.1f}) px", file=log)
+	drift_results.clear()
+
+# Called by the spot detector (in its own thread) after each reader round
+def report_spots(round, reader, counts):
+	total = sum(counts.values())
+	print(f">>>>> Round #{round+1}, {reader}: {total} spots")
+	journal('spots', round=round, reader=reader, counts={str(tile): count for tile, count in counts.items()})
+
+	previous = [count for r, count in spot_detector.totals()['round'].items() if r != round]
+	if previous:
+		median = sorted(previous)[len(previous)//2]
+		if total < spot_min_fraction * median:
+			print(f"!!!!! Round #{round+1}, {reader}: only {total} spots (median round {median}), check reader probe")
+			journal('spots_low', round=round, reader=reader, total=total, median=median)
+
+# Called by the pump telemetry (in its own thread) when the displayed pump
+#	state disagrees with the commanded one
+def report_pump_alarm(kind, sample):
+	print(f"!!!!! Pump alarm: {kind} (commanded {pump.flow_status} {pump.direction} at speed {pump.speed}, "
+		f"display speed {sample['speed']:.1f})")
+	journal('pump_alarm', kind=kind, commanded=[pump.flow_status, pump.direction, pump.speed],
+		speed=float(sample['speed']), direction=int(sample['direction']), control=int(sample['control']))
+
+
 # Check valve is in correct position, not moving, not overloaded:
 #	included bool inputs in case only one valve needs to be checked 
 # Do this before starting the pump to ensure the correct reagent goes to sample
@@ -112,22 +433,32 @@ def checkValveStatus(port_ID_A, port_ID_B, checkValveA = True, checkValveB = Tru
 	valveB_portCheck = 10
 	
 	if checkValveA: # Check Valve A
-		valveA_status = MVPchain.getStatus(valve_ID=0)
-		while not valveA_status[1] or valveA_status[2]:
-			print('valve a either still moving or overloaded')
-			valveA_status = MVPchain.getStatus(valve_ID = 0)
+		valveA_status = waitForValve(0)
 		valveA_portCheck = valveA_status[0]
 	
 	if checkValveB: # Check Valve B
-		valveB_status = MVPchain.getStatus(valve_ID = 1)
-		while not valveB_status[1] or valveB_status[2]:
-			print('valve b either still moving or overloaded')
-			valveB_status = MVPchain.getStatus(valve_ID = 1)
+		valveB_status = waitForValve(1)
 		valveB_portCheck = valveB_status[0]
 	
 	# Check if port is in correct position on each valve:
 	return (valveA_portCheck == port_ID_A, valveB_portCheck == port_ID_B)
 
+# Poll valve status until it is done moving and not overloaded,
+#	backing off between polls (0.1 s doubling up to 2 s)
+#	Raises ValveTimeout after the 'valve_status' budget
+@deadline.recoverable
+def waitForValve(valve_ID):
+	wait = deadline.Deadline(deadline.budget('valve_status'), ValveTimeout,
+		'Valve ' + chr(valve_ID + 97) + ' status')
+	pause_time = 0.1
+	valve_status = MVPchain.getStatus(valve_ID = valve_ID)
+	while not valve_status[1] or valve_status[2]:
+		print('valve ' + chr(valve_ID + 97) + ' either still moving or overloaded')
+		wait.sleep(pause_time)
+		pause_time = min(pause_time * 2, 2)
+		valve_status = MVPchain.getStatus(valve_ID = valve_ID)
+	return valve_status
+
 # Check entire fluidics setup
 #	(i.e. correct reagent to correct port on correct valve, make sure
 #	pump is stopped and remote control is enabled on pump)
@@ -188,6 +519,82 @@ def checkFusion():
 	
 	return protocol
 
+# ----------------------------------------------------------------------
+# Unattended preflight: the same checks as checkFluidics/checkFusion,
+#	without prompts, run in parallel with per-check deadlines (s)
+# ----------------------------------------------------------------------
+preflight_deadlines = {'valves': 20, 'pump': 10, 'fusion': 5, 'protocol': 5}
+
+# Every port used by fluidics_setup exists, valves settled and not overloaded
+def preflight_valves():
+	needed = {}
+	for reagent in fluidics_setup:
+		for valve_id, port in fluidic_graph.route(reagent):
+			needed[valve_id] = max(needed.get(valve_id, 0), port)
+	problems = []
+	chain_status = MVPchain.getChainStatus() # all valves in one burst
+	for valve_id, port in sorted(needed.items()):
+		if valve_id >= MVPchain.num_valves:
+			problems.append(f"valve {valve_id} not found")
+			continue
+		if port > MVPchain.max_ports_per_valve[valve_id]:
+			problems.append(f"valve {valve_id} has {MVPchain.max_ports_per_valve[valve_id]} ports, port {port} needed")
+		valve_status = chain_status[valve_id]
+		if valve_status[1] is not True:
+			problems.append(f"valve {valve_id} moving or not answering")
+		if valve_status[2] is True:
+			problems.append(f"valve {valve_id} overloaded")
+	if problems:
+		return False, '; '.join(problems)
+	return True, f"{MVPchain.num_valves} valves, all ports present"
+
+# Pump in remote control, not running and not set to run in reverse
+#	(set forward at speed 0 is fine)
+def preflight_pump():
+	pump_status = pump.getStatus()
+	problems = []
+	if pump_status[3] != 'Remote':
+		problems.append('remote control not enabled')
+	if pump_status[0] == 'Flowing' and pump_status[1] != 0.0:
+		problems.append(f"pump running ({pump_status[2]}, speed {pump_status[1]})")
+	elif pump_status[2] not in ('Not Running', 'Forward'):
+		problems.append(f"pump set to run {pump_status[2].lower()}")
+	if problems:
+		return False, '; '.join(problems)
+	return True, f"{pump_status[3]}, {pump_status[0]}"
+
+# Fusion REST reachable and idle
+def preflight_fusion():
+	state = fusionrest.get_state()
+	return state == 'Idle', 'state ' + state
+
+# Named protocol can be selected in Fusion
+def preflight_protocol(protocol_name):
+	state = fusionrest.get_state()
+	if state != 'Idle':
+		return False, 'Fusion busy (' + state + '), protocol not checked'
+	fusionrest.change_protocol(protocol_name)
+	selected = fusionrest._get_selected_protocol()
+	return selected == protocol_name, 'selected ' + selected
+
+# Run all checks; Fusion is only checked if a protocol name is given
+#	Returns True if every check passed
+def preflight(protocol_name=None, log=None):
+	from preflight import run_checks, format_report
+	checks = [('valves', preflight_valves, preflight_deadlines['valves']),
+			  ('pump', preflight_pump, preflight_deadlines['pump'])]
+	if protocol_name is not None:
+		checks.append(('fusion', preflight_fusion, preflight_deadlines['fusion']))
+		checks.append(('protocol ' + protocol_name, lambda: preflight_protocol(protocol_name),
+			preflight_deadlines['protocol']))
+	results = run_checks(checks)
+	report = format_report(results)
+	print(report)
+	if log is not None:
+		print(report, file=log)
+	journal('preflight', results=[[name, ok, detail] for name, ok, detail, seconds in results])
+	return all(ok for name, ok, detail, seconds in results)
+
 # Change and Check Ports
 #	TO DO: 
 #	1) Turn valve shortest distance to reach port 
@@ -311,19 +718,78 @@ def runSequencing(numCycles, protocolName):
 			except Exception as ex:
 				print('Error running Fusion protocol')
 
-def flow(reagent, time_pumping=0, time_reaction=0, repeats=1, log=None):
-	for valve_id in range(MVPchain.num_valves):
-		MVPchain.changePort(valve_id, fluidics_setup[reagent][valve_id])
+# Dead volume (ul) between a reagent's port and the bypass junction
+def dead_volume(reagent):
+	return fluidic_graph.volume(reagent)
+
+# Pump `reagent` up to the bypass junction (flow cell isolated)
+#	Returns the time spent pumping
+def prime_line(reagent, log=None):
+	global primed_reagent
+	route = fluidic_graph.route(reagent, 'waste')
+	MVPchain.changePorts(fluidic_graph.moves(MVPchain.current_port, route))
+
+	time_priming = dead_volume(reagent) / pump_rate
+	print(f">>>>> {reagent} priming started at {time.strftime('%m-%d-%Y %H:%M:%S', time.localtime())}")
+	print(f">>>>> {reagent} priming started at {time.strftime('%m-%d-%Y %H:%M:%S', time.localtime())}", file=log)
+	started = time.time()
+	pump.startFlow(speed)
+	with tracing.span('priming', 'priming', nominal=time_priming):
+		pump_for(time_priming, route)
+	pump.stopFlow()
+	primed_reagent = reagent
+	journal('prime', reagent=reagent, volume=dead_volume(reagent), time_priming=time_priming,
+		started=started, seconds=time.time() - started)
+	return time_priming
+
+# prime: reagent of the next step, pumped up to the bypass junction during
+#	the last incubation (if a bypass valve is configured and there is time)
+# prefetch: reagent of the next step, valves off the current path are moved
+#	to its route during the incubation
+def flow(reagent, time_pumping=0, time_reaction=0, repeats=1, log=None, prime=None, prefetch=None):
+	global primed_reagent
+	route = fluidic_graph.route(reagent)
+	MVPchain.changePorts(fluidic_graph.moves(MVPchain.current_port, route))
+
+	# Line already filled up to the junction: skip pumping the dead volume
+	time_saved = 0
+	if primed_reagent == reagent:
+		time_saved = min(dead_volume(reagent) / pump_rate, time_pumping)
+	primed_reagent = None
 
 	for repeat in range(repeats):
-		current_time = time.localtime()
-		current_time_string = time.strftime("%m-%d-%Y %H:%M:%S", current_time)
-		print(f">>>>> {reagent} reaction {repeat+1}/{repeats} started at {current_time_string}")
-		print(f">>>>> {reagent} reaction {repeat+1}/{repeats} started at {current_time_string}", file=log)
-		pump.startFlow(speed)
-		time.sleep(time_pumping)
-		pump.stopFlow()
-		time.sleep(time_reaction)
+		time_pumped = time_pumping - (time_saved if repeat == 0 else 0)
+		with tracing.span(reagent, 'reaction', repeat=repeat, nominal=time_pumped + time_reaction):
+			current_time = time.localtime()
+			current_time_string = time.strftime("%m-%d-%Y %H:%M:%S", current_time)
+			print(f">>>>> {reagent} reaction {repeat+1}/{repeats} started at {current_time_string}")
+			print(f">>>>> {reagent} reaction {repeat+1}/{repeats} started at {current_time_string}", file=log)
+			started = time.time()
+			update_status(phase='pumping', reagent=reagent, repeat=repeat, repeats=repeats)
+			pump.startFlow(speed)
+			with tracing.span('pumping', 'pumping'):
+				paused = pump_for(time_pumped, route)
+			pump.stopFlow()
+			pumped = time.time() - started - paused
+
+			# The reaction runs from here on: valve moves and priming made
+			#	during it come off the incubation
+			reaction_started = time.time()
+			if repeat == 0 and prefetch is not None and prefetch != reagent:
+				MVPchain.changePorts(fluidic_graph.prefetchMoves(MVPchain.current_port,
+					route, fluidic_graph.route(prefetch)))
+
+			update_status(phase='incubation')
+			if (repeat == repeats-1 and prime is not None and bypass_valve is not None
+					and time_reaction - (time.time() - reaction_started)
+						>= dead_volume(prime) / pump_rate + prime_margin):
+				prime_line(prime, log=log)
+			time_incubation = max(0.0, time_reaction - (time.time() - reaction_started))
+			with tracing.span('incubation', 'incubation'):
+				paused += incubate(time_incubation)
+			journal('flow', reagent=reagent, repeat=repeat, repeats=repeats, started=started,
+				seconds=time.time() - started, time_pumping=time_pumped, time_reaction=time_reaction,
+				pumped=pumped, paused=paused, primed=time_pumping - time_pumped)
 
 # def sequencing_step(reagent, time_pumping=time_pumping, time_reaction=0, repeats=1, log=None):
 # 	flow(reagent, time_pumping=time_pumping, time_reaction=time_reaction, repeats=repeats, log=log)
@@ -350,128 +816,436 @@ def flow(reagent, time_pumping=0, time_reaction=0, repeats=1, log=None):
 	# 	pump.stopFlow()
 
 
-def imaging(round, protocol_name, log=None):
-	flow('ssc', time_pumping=time_pumping[0]*2)
-
-	time.sleep(2)
+# Run one Fusion protocol and log it
+#	Returns time.time() at the start and end of the acquisition,
+#	None on error
+def acquire(round, protocol_name, log=None):
 	current_time = time.localtime()
 	current_time_string = time.strftime("%m-%d-%Y %H:%M:%S", current_time)
-	print(f">>>>> Round #{round+1}, imaging started at {current_time_string}")
-	print(f">>>>> Round #{round+1}, imaging started at {current_time_string}", file=log)
+	print(f">>>>> Round #{round+1}, imaging ({protocol_name}) started at {current_time_string}")
+	print(f">>>>> Round #{round+1}, imaging ({protocol_name}) started at {current_time_string}", file=log)
+	imaging_started = time.time()
+	update_status(phase='imaging', protocol=protocol_name)
+	journal('imaging_started', round=round, protocol=protocol_name)
 	try:
 		fusionrest.run_protocol_completely(protocol_name)
 		current_time = time.localtime()
 		current_time_string = time.strftime("%m-%d-%Y %H:%M:%S", current_time)
 		print(f">>>>> Round #{round+1}, imaging finished at {current_time_string}")
 		print(f">>>>> Round #{round+1}, imaging finished at {current_time_string}", file=log)
+		journal('imaging_finished', round=round, protocol=protocol_name)
+		imaging_finished = time.time()
+		imaging_times.append(imaging_finished - imaging_started)
+		return imaging_started, imaging_finished
+	except deadline.Cancelled: # the run was aborted, not the acquisition
+		raise
 	except Exception:
 		current_time = time.localtime()
 		current_time_string = time.strftime("%m-%d-%Y %H:%M:%S", current_time)
 		print(f"!!!!! Error running Fusion protocol for Round #{round+1} at {current_time_string}")
 		print(f"!!!!! Error running Fusion protocol for Round #{round+1} at {current_time_string}", file=log)
+		journal('imaging_error', round=round, protocol=protocol_name)
+		return None
+
+# Decide from the verification images (written between since and until)
+#	whether the full protocol is needed (residual signal after stripping
+#	above residual_threshold, or the images could not be measured)
+def needs_full_imaging(round, since, until, log=None):
+	if image_pattern is None:
+		return True
+	try:
+		import images # only needed when online QC is enabled
+		paths = images.find_images(image_pattern, since, until)
+		if not paths:
+			raise ValueError('no verification images found')
+		residual = max(images.signal_ratio(path, verification_channels, residual_percentile)
+			for path in paths.values())
+	except Exception as ex:
+		print(f"!!!!! Round #{round+1}, residual signal could not be measured: {ex}")
+		print(f"!!!!! Round #{round+1}, residual signal could not be measured: {ex}", file=log)
+		return True
+
+	escalate = residual > residual_threshold
+	journal('residual_signal', round=round, residual=residual, threshold=residual_threshold, escalate=escalate)
+	if escalate:
+		print(f"!!!!! Round #{round+1}, residual signal {residual:.2f} above {residual_threshold}, running full protocol")
+		print(f"!!!!! Round #{round+1}, residual signal {residual:.2f} above {residual_threshold}, running full protocol", file=log)
+	return escalate
+
+# Imaging between SSC wash and flush
+#	verify: post-stripping check, uses verification_protocol_name (if set)
+#		and escalates to protocol_name only if signal is left
+def imaging(round, protocol_name, log=None, check_drift=False, reader=None, verify=False):
+	# Select the protocol(s) in Fusion during the wash, so acquisition only
+	#	has to be started (the full protocol is queued after the check)
+	protocols = [protocol_name]
+	if verify and verification_protocol_name is not None:
+		protocols = [verification_protocol_name, protocol_name]
+	try:
+		fusionrest.arm(protocols)
+	except Exception as ex:
+		print(f"!!!!! Round #{round+1}, Fusion protocol not armed: {ex}")
+		print(f"!!!!! Round #{round+1}, Fusion protocol not armed: {ex}", file=log)
+		journal('arm_error', round=round, protocols=protocols, error=str(ex))
+
+	flow('ssc', time_pumping=time_pumping[0]*2)
+
+	time.sleep(2)
+	if verify and verification_protocol_name is not None:
+		acquisition = acquire(round, verification_protocol_name, log)
+		if acquisition is None or needs_full_imaging(round, *acquisition, log=log):
+			acquisition = acquire(round, protocol_name, log)
+	else:
+		acquisition = acquire(round, protocol_name, log)
+
+	if acquisition is not None:
+		imaging_started, imaging_finished = acquisition
+		if check_drift and drift_monitor is not None:
+			start_drift_check(round, imaging_started, imaging_finished)
+		if reader is not None and spot_detector is not None:
+			spot_detector.submit(round, reader, imaging_started, imaging_finished)
 	time.sleep(3)
 
 	flow('flush', time_pumping=time_pumping[0]-5)
 
 
-def run_sequencing(num_rounds, protocol_name, expt_name=" "):
+# Steps of a run are kept as data (see plan.py) so the remaining plan can be
+#	replaced during a live run
+def flow_step(reagent, time_pumping=0, time_reaction=0, repeats=1, log=True, prime=None):
+	return {'step': 'flow', 'reagent': reagent, 'time_pumping': time_pumping,
+			'time_reaction': time_reaction, 'repeats': repeats, 'log': log, 'prime': prime}
+
+def imaging_step(round, protocol_name, check_drift=False, reader=None, verify=False):
+	return {'step': 'imaging', 'round': round, 'protocol': protocol_name,
+			'check_drift': check_drift, 'reader': reader, 'verify': verify}
+
+def build_sequencing_plan(num_rounds, protocol_name):
 	minute = 60
 	# minute = 0
-	
-	current_date = time.localtime()
-	current_date_string = time.strftime("%m-%d-%Y", current_date)
-	log_file_name = "log_" + expt_name + "_" + current_date_string + ".txt"
-	log_object = open(log_file_name, mode='a+')
-    
-	flow('ssc', time_pumping=time_pumping[0], time_reaction=1*minute, repeats=1, log=log_object)   # 2xSSC washing
+	plan = []
+
+	plan.append(flow_step('ssc', time_pumping=time_pumping[0], time_reaction=1*minute, repeats=1))   # 2xSSC washing
 
-	# imaging(-1, protocol_name, log=log_object)
+	# plan.append(imaging_step(-1, protocol_name))
 	for round in range(num_rounds):
-		# if round%2 == 0:
-		# 	sequencing_step('reader1', time_reaction=30*minute, repeats=1)
-		# elif round%2 == 1:
-		# 	sequencing_step('reader2', time_reaction=30*minute, repeats=1)
+		plan.append({'step': 'drift_check'}) # flag drift before the next hybridization
 
 		reagent = 'reader' + str(round%8+1) # i + 1 since port starts at 0
 		# reagent = 'reader1'
-		flow(reagent, time_pumping=time_pumping[1], repeats=1, log=log_object)
-		flow('flush', time_pumping=time_pumping[2], time_reaction=30*minute)
-
-		flow('ssc', time_pumping=time_pumping[0]*2, time_reaction=5*minute, repeats=3, log=log_object)   # 2xSSC washing
-		flow('flush', time_pumping=time_pumping[2])
-		
-		flow('hcr', time_pumping=time_pumping[0], repeats=1, log=log_object)
-		flow('flush', time_pumping=time_pumping[2], time_reaction=60*minute)
-
-		flow('ssc', time_pumping=time_pumping[0]*2, time_reaction=5*minute, repeats=3, log=log_object)   # 2xSSC washing
-		flow('flush', time_pumping=time_pumping[2])
-
-		flow('dapi', time_pumping=time_pumping[0], repeats=1, log=log_object)
-		flow('flush', time_pumping=time_pumping[2], time_reaction=10*minute)
-
-		flow('ssc', time_pumping=time_pumping[0]*2, time_reaction=5*minute, repeats=3, log=log_object) 
-		        
-		imaging(round, protocol_name, log=log_object)
-		
-		flow('displacement', time_pumping=time_pumping[0], repeats=1, log=log_object)    
-		flow('flush', time_pumping=time_pumping[2], time_reaction=60*minute)
-
-		flow('ssc', time_pumping=time_pumping[0]*2, time_reaction=5*minute, repeats=3, log=log_object)
-		flow('flush', time_pumping=time_pumping[2])
-
-		flow('stripping', time_pumping=time_pumping[0], repeats=1, log=log_object)
-		flow('flush', time_pumping=time_pumping[2], time_reaction=60*minute)
-
-		flow('ssc', time_pumping=time_pumping[0]*2, time_reaction=5*minute, repeats=5, log=log_object)   # careful washing after stripping
-
-		imaging(round, protocol_name, log=log_object)
-	
-		
-	imaging(round+1, protocol_name, log=log_object)
-
-	flow('dt', time_pumping=time_pumping[0], repeats=1, log=log_object)
-	flow('flush', time_pumping=time_pumping[2], time_reaction=60*minute)
-
-	flow('ssc', time_pumping=time_pumping[0]*2, time_reaction=1*minute, repeats=2, log=log_object)
-	flow('flush', time_pumping=time_pumping[2])
-
-	flow('dapi', time_pumping=time_pumping[0], repeats=1, log=log_object)
-	flow('flush', time_pumping=time_pumping[2], time_reaction=10*minute)
+		plan.append(flow_step(reagent, time_pumping=time_pumping[1], repeats=1))
+		plan.append(flow_step('flush', time_pumping=time_pumping[2], time_reaction=30*minute, log=False, prime='ssc'))
+
+		plan.append(flow_step('ssc', time_pumping=time_pumping[0]*2, time_reaction=5*minute, repeats=3))   # 2xSSC washing
+		plan.append(flow_step('flush', time_pumping=time_pumping[2], log=False))
+
+		plan.append(flow_step('hcr', time_pumping=time_pumping[0], repeats=1))
+		plan.append(flow_step('flush', time_pumping=time_pumping[2], time_reaction=60*minute, log=False, prime='ssc'))
+
+		plan.append(flow_step('ssc', time_pumping=time_pumping[0]*2, time_reaction=5*minute, repeats=3))   # 2xSSC washing
+		plan.append(flow_step('flush', time_pumping=time_pumping[2], log=False))
+
+		plan.append(flow_step('dapi', time_pumping=time_pumping[0], repeats=1))
+		plan.append(flow_step('flush', time_pumping=time_pumping[2], time_reaction=10*minute, log=False, prime='ssc'))
+
+		plan.append(flow_step('ssc', time_pumping=time_pumping[0]*2, time_reaction=5*minute, repeats=3))
+
+		plan.append(imaging_step(round, protocol_name, check_drift=True, reader=reagent))
+
+		plan.append(flow_step('displacement', time_pumping=time_pumping[0], repeats=1))
+		plan.append(flow_step('flush', time_pumping=time_pumping[2], time_reaction=60*minute, log=False, prime='ssc'))
+
+		plan.append(flow_step('ssc', time_pumping=time_pumping[0]*2, time_reaction=5*minute, repeats=3))
+		plan.append(flow_step('flush', time_pumping=time_pumping[2], log=False))
+
+		plan.append(flow_step('stripping', time_pumping=time_pumping[0], repeats=1))
+		plan.append(flow_step('flush', time_pumping=time_pumping[2], time_reaction=60*minute, log=False, prime='ssc'))
+
+		plan.append(flow_step('ssc', time_pumping=time_pumping[0]*2, time_reaction=5*minute, repeats=5))   # careful washing after stripping
+
+		plan.append(imaging_step(round, protocol_name, verify=True))
+
+	plan.append(imaging_step(num_rounds, protocol_name, check_drift=True))
+
+	plan.append(flow_step('dt', time_pumping=time_pumping[0], repeats=1))
+	plan.append(flow_step('flush', time_pumping=time_pumping[2], time_reaction=60*minute, log=False, prime='ssc'))
+
+	plan.append(flow_step('ssc', time_pumping=time_pumping[0]*2, time_reaction=1*minute, repeats=2))
+	plan.append(flow_step('flush', time_pumping=time_pumping[2], log=False))
+
+	plan.append(flow_step('dapi', time_pumping=time_pumping[0], repeats=1))
+	plan.append(flow_step('flush', time_pumping=time_pumping[2], time_reaction=10*minute, log=False, prime='ssc'))
+
+	plan.append(imaging_step(num_rounds+1, protocol_name))
+	plan.append({'step': 'drift_check'})
+	return plan
+
+# Check a plan before it replaces the remaining steps of a run
+#	Returns a list of errors (empty if the plan can be run)
+def validate_plan(plan):
+	errors = []
+	for i, step in enumerate(plan):
+		kind = step.get('step')
+		if kind == 'flow':
+			reagents = [step.get('reagent')]
+			if step.get('prime') is not None:
+				reagents.append(step['prime'])
+			for reagent in reagents:
+				if reagent not in fluidics_setup:
+					errors.append(f"step {i}: unknown reagent {reagent}")
+			for key in ('time_pumping', 'time_reaction'):
+				if not isinstance(step.get(key, 0), (int, float)) or step.get(key, 0) < 0:
+					errors.append(f"step {i}: {key} must be a number >= 0")
+			if not isinstance(step.get('repeats', 1), int) or step.get('repeats', 1) < 1:
+				errors.append(f"step {i}: repeats must be an integer >= 1")
+		elif kind == 'imaging':
+			if not isinstance(step.get('round'), int):
+				errors.append(f"step {i}: round must be an integer")
+			if not isinstance(step.get('protocol'), str) or not step.get('protocol'):
+				errors.append(f"step {i}: protocol name missing")
+		elif kind != 'drift_check':
+			errors.append(f"step {i}: unknown step type {kind}")
+	return errors
+
+# Check a plan against the current valve, pump and Fusion state (at a step
+#	boundary); its imaging protocols are armed, so a misspelled name is
+#	rejected with the edit instead of failing at imaging time
+def check_plan_state(plan):
+	errors = []
+	for step in plan:
+		if step.get('step') != 'flow':
+			continue
+		for valve_id, port in fluidic_graph.route(step['reagent']):
+			if not MVPchain.isValidPort(valve_id, port):
+				errors.append(f"{step['reagent']}: port {port} not available on valve {valve_id}")
+	for valve_id, valve_status in enumerate(MVPchain.getChainStatus()):
+		if valve_status[2]:
+			errors.append(f"valve {valve_id} is overloaded")
+	pump_status = pump.getStatus()
+	if pump_status[0] == 'Flowing' and pump_status[1] != 0.0:
+		errors.append('pump is still running')
+	protocols = sorted(set(step['protocol'] for step in plan if step.get('step') == 'imaging'))
+	if protocols:
+		try:
+			fusionrest.arm(protocols)
+		except Exception as ex:
+			errors.append('Fusion protocols could not be selected: ' + str(ex))
+	return sorted(set(errors))
+
+# next_reagent: reagent of the next flow step, for valve prefetching
+def run_step(step, log=None, next_reagent=None):
+	if step['step'] == 'flow':
+		flow(step['reagent'], time_pumping=step.get('time_pumping', 0),
+			time_reaction=step.get('time_reaction', 0), repeats=step.get('repeats', 1),
+			log=log if step.get('log', True) else None, prime=step.get('prime'),
+			prefetch=next_reagent)
+	elif step['step'] == 'imaging':
+		imaging(step['round'], step['protocol'], log=log, check_drift=step.get('check_drift', False),
+			reader=step.get('reader'), verify=step.get('verify', False))
+	elif step['step'] == 'drift_check':
+		finish_drift_check(log=log)
+
+# Run steps until the plan is done, picking up edits between steps
+def run_plan(plan_control, log=None):
+	while True:
+		if pause_control is not None:
+			pause_control.waitWhilePaused() # edits made while paused apply now
+		step = plan_control.nextStep()
+		if step is None:
+			return True
+		remaining = plan_control.remaining()
+		update_status(step=step, step_index=plan_control.steps_done, steps_total=plan_control.steps_done + len(remaining) + 1,
+			step_started=time.time(), eta=time.time() + plan_duration([step] + remaining),
+			reagent=step.get('reagent'), **({'round': step['round']} if 'round' in step else {}))
+		upcoming = [s for s in remaining if s['step'] == 'flow']
+		with tracing.span(step['step'], 'step', **({'nominal': plan_duration([step])} if step['step'] == 'flow' else {})):
+			run_step(step, log=log, next_reagent=upcoming[0]['reagent'] if upcoming else None)
+		plan_control.stepDone()
+
+# Record a plan edit in the log and journal
+def log_plan_edit(source, old_plan, new_plan, log=None):
+	current_time_string = time.strftime("%m-%d-%Y %H:%M:%S", time.localtime())
+	print(f">>>>> Plan replaced from {source} at {current_time_string}: {len(old_plan)} -> {len(new_plan)} steps")
+	print(f">>>>> Plan replaced from {source} at {current_time_string}: {len(old_plan)} -> {len(new_plan)} steps", file=log)
+	journal('plan_edit', source=source, old_plan=old_plan, new_plan=new_plan)
+
+# resume_plan: checkpoint file (plan_<expt>_<date>.json) of an interrupted run,
+#	its remaining steps are run instead of a new plan
+# plan_path: plan checkpoint, default plan_<expt>_<date>.json
+def run_sequencing(num_rounds, protocol_name, expt_name=" ", resume_plan=None, plan_path=None):
+	global run_journal, drift_monitor, spot_detector, pump_telemetry, run_status, pause_control
+	from pause import PauseControl
+	from plan import PlanControl, load_plan
+	deadline.budgets.update(wait_budgets)
+	deadline.recovery = recover_device
+	transport.on_reconnect = report_reconnect
+	deadline.reset()
 
-	imaging(round+2, protocol_name, log=log_object)
+	current_date = time.localtime()
+	current_date_string = time.strftime("%m-%d-%Y", current_date)
+	log_file_name = "log_" + expt_name + "_" + current_date_string + ".txt"
+	log_object = open(log_file_name, mode='a+')
+	run_journal = RunJournal("journal_" + expt_name + "_" + current_date_string + ".jsonl")
+	journal('run_started', expt_name=expt_name, num_rounds=num_rounds, protocol=protocol_name,
+		resume_plan=resume_plan)
 
-	log_object.close()
+	plan_control = None # set up in the try block, torn down whatever stops the run
+	status_server = None
+	try:
+		if image_pattern is not None:
+			from drift import DriftMonitor # only needed when online QC is enabled
+			from spots import SpotDetector
+			drift_monitor = DriftMonitor(image_pattern, channel=drift_channel,
+				downsample=drift_downsample, tolerance=drift_tolerance)
+			spot_detector = SpotDetector(image_pattern, spot_channels, sigma=spot_sigma,
+				threshold=spot_threshold, on_round=report_spots)
+
+		if resume_plan is not None:
+			plan = load_plan(resume_plan)
+		else:
+			plan = build_sequencing_plan(num_rounds, protocol_name)
+		errors = validate_plan(plan)
+		if errors:
+			raise ValueError('Invalid plan: ' + '; '.join(errors))
+
+		# Fail now, not in round 1, if a protocol name is wrong or Fusion is not ready
+		protocols = sorted(set(step['protocol'] for step in plan if step['step'] == 'imaging'))
+		if verification_protocol_name is not None:
+			protocols.append(verification_protocol_name)
+		try:
+			fusionrest.arm(protocols)
+		except Exception as ex:
+			raise RuntimeError('Fusion protocols could not be selected: ' + str(ex)) from ex
+
+		if telemetry_rate is not None:
+			from telemetry import PumpTelemetry
+			pump_telemetry = PumpTelemetry(pump, rate=telemetry_rate, on_alarm=report_pump_alarm)
+			pump_telemetry.start()
+
+		if status_port is not None:
+			from status import RunStatus, StatusServer
+			run_status = RunStatus(providers=status_providers())
+			run_status.update(expt_name=expt_name, protocol=protocol_name, steps_total=len(plan),
+				eta=time.time() + plan_duration(plan))
+			status_server = StatusServer(run_status, status_port)
+			fusionrest.default_client().progress_interval = status_progress_interval
+
+		if plan_path is None:
+			plan_path = "plan_" + expt_name + "_" + current_date_string + ".json"
+		pause_control = PauseControl(on_pause=pause_devices, on_resume=resume_devices)
+		plan_control = PlanControl(plan, plan_path,
+			validate_plan, check_state=check_plan_state, control_port=control_port, pause_control=pause_control,
+			on_edit=lambda source, old_plan, new_plan: log_plan_edit(source, old_plan, new_plan, log=log_object))
+		if trace_run:
+			tracing.start()
+		with tracing.span('run', 'run', expt_name=expt_name):
+			run_plan(plan_control, log=log_object)
+		journal('run_finished')
+	except BaseException as ex: # a bad plan or Fusion, a device error, abort, Ctrl-C
+		journal('run_failed', error=type(ex).__name__ + ': ' + str(ex))
+		if isinstance(ex, deadline.Cancelled):
+			stop_acquisition(log=log_object)
+		raise
+	finally:
+		deadline.reset() # the pump and Fusion waits below must not be cancelled
+		try: # never leave the pump running, whatever stopped the run
+			pump.stopFlow()
+		except Exception as ex:
+			print(f"!!!!! Pump could not be stopped: {ex}")
+			print(f"!!!!! Pump could not be stopped: {ex}", file=log_object)
+		tracer = tracing.stop()
+		if tracer is not None:
+			tracer.save("trace_" + expt_name + "_" + current_date_string + ".json")
+			print(tracing.format_summary(tracing.summarize(tracer.chromeTrace())), file=log_object)
+		if plan_control is not None:
+			plan_control.close()
+		pause_control = None
+		if pump_telemetry is not None:
+			pump_telemetry.stop()
+			journal('pump_telemetry', **pump_telemetry.statistics(window=float('inf')))
+			pump_telemetry = None
+		if status_server is not None:
+			status_server.close()
+			fusionrest.default_client().progress_interval = None
+			run_status = None
+
+		finish_drift_check(log=log_object)
+		if spot_detector is not None:
+			spot_detector.close()
+			spot_detector.table.save("spots_" + expt_name + "_" + current_date_string + ".npz")
+			for round, error in spot_detector.errors:
+				print(f"!!!!! Spot detection failed for Round #{round+1}: {error}", file=log_object)
+
+		run_journal.close()
+		run_journal = None
+		log_object.close()
 	return True
 
 
-def flushing(port_for_valve_a, port_for_valve_b):
-	pump.startFlow(speed)
-	if port_for_valve_a == 1:
-		time.sleep(time_pumping[1])
-	elif port_for_valve_a > 1:
-		time.sleep(time_pumping[0])
-	pump.stopFlow()
-	print(f">>>> Valve_a::port_{port_for_valve_a}, valve_b::port_{port_for_valve_b} washing done")
-	print(f">>>> Take the tubing out")
-	os.system("pause")
-
-	pump.startFlow(speed)
-	time.sleep(time_pumping[2])
-	pump.stopFlow()
-	print(f">>>> Valve_a::port_{port_for_valve_a}, valve_b::port_{port_for_valve_b} flushing done")
-
-
-def run_flushing():
-	for port_for_valve_a in range(1, 9):
-		MVPchain.changePort(0, port_for_valve_a)
-		if port_for_valve_a == 1:
-			for port_for_valve_b in range(1, 9):
-				MVPchain.changePort(1, port_for_valve_b)
-				flushing(port_for_valve_a, port_for_valve_b)
-		else:
-			MVPchain.changePort(1, 1)
-			flushing(port_for_valve_a, 1)
+# Automated cleaning cycle: every reagent line (the flush line too) is
+#	washed (with the lines in cleaning solution) and sent to
+#	cleaning_destination, in the order that moves the valves least. The
+#	shared tubing of each valve group is flushed once after the group
+#	instead of after every port. Completed lines are recorded in
+#	cleaning_state_path, so an interrupted cycle resumes where it
+#	stopped. The cycle can be paused, resumed and aborted on the control
+#	socket like a run
+def clean_time(reagent):
+	return time_pumping[1] if len(fluidic_graph.routes[reagent]) > 1 else time_pumping[0]
+
+# Write the cleaning progress (lines done) so that a crash never leaves
+#	a half-written file
+def save_cleaning_state(done, path):
+	save_json(done, path, indent=None)
+
+def run_flushing(log=None, resume=True):
+	global pause_control
+	from pause import PauseControl
+	from plan import start_control_server
+	done = []
+	if resume and os.path.exists(cleaning_state_path):
+		with open(cleaning_state_path) as state_file:
+			done = json.load(state_file)
+	reagents = [reagent for reagent in fluidics_setup if reagent not in done]
+	reagents = fluidic_graph.orderByTravel(reagents, MVPchain.current_port,
+		MVPchain.max_ports_per_valve, destination=cleaning_destination)
+
+	def group(reagent): # valves upstream of the outlet valve share tubing
+		return tuple(valve_id for valve_id, port in fluidic_graph.routes[reagent][1:])
+
+	def pump_line(reagent, seconds):
+		route = fluidic_graph.route(reagent, cleaning_destination)
+		MVPchain.changePorts(fluidic_graph.moves(MVPchain.current_port, route))
+		pump.startFlow(speed)
+		pump_for(seconds, route)
+		pump.stopFlow()
 
+	deadline.reset()
+	pause_control = PauseControl(on_pause=pause_devices, on_resume=resume_devices)
+	control_server = start_control_server(pause_control, control_port) if control_port is not None else None
+	try:
+		for i, reagent in enumerate(reagents):
+			pump_line(reagent, clean_time(reagent))
+			if reagent != 'flush' and (i == len(reagents) - 1 or group(reagents[i+1]) != group(reagent)):
+				pump_line('flush', time_pumping[2]) # shared tubing of the group
+			done.append(reagent)
+			save_cleaning_state(done, cleaning_state_path)
+			print(f">>>>> {reagent} line cleaned ({len(done)}/{len(fluidics_setup)})")
+			print(f">>>>> {reagent} line cleaned ({len(done)}/{len(fluidics_setup)})", file=log)
+			journal('cleaned', reagent=reagent, route=fluidic_graph.route(reagent, cleaning_destination))
+	finally:
+		deadline.reset() # the pump must be stopped even after an abort
+		try:
+			pump.stopFlow()
+		except Exception as ex:
+			print(f"!!!!! Pump could not be stopped: {ex}")
+			print(f"!!!!! Pump could not be stopped: {ex}", file=log)
+		if control_server is not None:
+			control_server.shutdown()
+			control_server.server_close()
+		pause_control = None
+
+	if os.path.exists(cleaning_state_path):
+		os.remove(cleaning_state_path)
 	return True
 
 def run_test():
@@ -485,6 +1259,33 @@ def run_test():
 		os.system("pause")
 	
 	return True
+
+# Run one job of the job queue (see jobs.py)
+#	sequencing: run_sequencing arguments; the plan checkpoint is kept per
+#		job, so an interrupted run resumes where it stopped
+#	flushing: cleaning cycle (resumes from cleaning_state_path)
+#	flow: flow() arguments, e.g. to prime the lines for the next sample
+def run_job(job, interrupted=False):
+	args = dict(job.get('args', {}))
+	kind = job['kind']
+	if kind == 'sequencing':
+		plan_path = "plan_" + args.get('expt_name', " ") + "_" + job['id'] + ".json"
+		if interrupted and os.path.exists(plan_path):
+			args['resume_plan'] = plan_path
+		return run_sequencing(plan_path=plan_path, **args)
+	if kind == 'flushing':
+		return run_flushing(resume=True)
+	if kind == 'flow':
+		try:
+			flow(**args)
+		finally:
+			deadline.reset() # the pump must be stopped even after an abort
+			try: # never leave the pump running, whatever stopped the job
+				pump.stopFlow()
+			except Exception as ex:
+				print(f"!!!!! Pump could not be stopped: {ex}")
+		return True
+	raise ValueError('Unknown job kind: ' + kind)
 	
 
 # --------------------------------------------------------------------------
@@ -496,23 +1297,43 @@ if __name__ == '__main__':
 
 	print('Initializing Fluidics Setup')
 	print('...........................')
-	MVPchain = HamiltonMVP(com_port='COM7', verbose=True)
-	# print(MVPchain.__dict__)
-	# MVPchain.changePort(0, 2)
-	pump = APump(com_port='COM8', verbose=True)
-	
-	# # testing be fore experiment
-	# status = run_test()
+	if broker_port is not None:
+		from broker import BrokerClient
+		broker_client = BrokerClient(broker_port)
+		MVPchain = broker_client.device('valves')
+		pump = broker_client.device('pump')
+		telemetry_rate = None # the broker owns the pump port
+	else:
+		MVPchain = HamiltonMVP(com_port='COM7', verbose=True)
+		# print(MVPchain.__dict__)
+		# MVPchain.changePort(0, 2)
+		pump = APump(com_port='COM8', verbose=True)
+
+	# unattended check of valves, pump, Fusion and the run's protocol
+	if not preflight(imaging_protocol_name):
+		if broker_port is None: # a broker keeps remote control of the pump it owns
+			pump.closeRemote()
+		MVPchain.closeSerialPort()
+		sys.exit('Preflight failed. Exiting...')
 	
-	# # experiment
-	# status = run_sequencing(3, 'Min_5channel', expt_name='3_probe_useqFISHv2_POC')
-	# if status:
-	# 	print(f">>>>> Experiment went smoothly")	 
+	# queued experiments and maintenance, back to back
+	if job_queue_path is not None:
+		from jobs import JobQueue
+		jobs_run = JobQueue(job_queue_path).run(run_job, poll_interval=job_queue_poll)
+		print(f">>>>> {len(jobs_run)} jobs run")
+	else:
+		# # testing be fore experiment
+		# status = run_test()
+		
+		# # experiment
+		# status = run_sequencing(3, imaging_protocol_name, expt_name='3_probe_useqFISHv2_POC')
+		# if status:
+		# 	print(f">>>>> Experiment went smoothly")	 
 
-	# for washing after experiment
-	status = run_flushing()
-	if status:
-		print(f">>>>> System cleaning went smoothly")
+		# for washing after experiment
+		status = run_flushing()
+		if status:
+			print(f">>>>> System cleaning went smoothly")
 
 
 	# minute = 60
@@ -531,5 +1352,6 @@ if __name__ == '__main__':
 	# 	print(f"!!!!! Error running fusion protocol for Round #{round+1}, after stripping")
 	# os.system("pause")
 
-	pump.closeRemote() # stop remote control; enable keypad control
+	if broker_port is None: # a broker keeps remote control of the pump it owns
+		pump.closeRemote() # stop remote control; enable keypad control
 	MVPchain.closeSerialPort() # disconnect MVP valve chain from serial